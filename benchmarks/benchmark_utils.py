@@ -0,0 +1,120 @@
+"""
+Common helpers of the benchmark scripts.
+
+Contains:
+- the repository path setup, so the benchmarks run from any directory
+- timing of a function over calibrated loops
+- latency percentiles
+- JSON report, with the environment the benchmarks ran in
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DICTIONARY_PATH = os.path.join(REPOSITORY_PATH, 'dictDiameter.xml')
+
+if REPOSITORY_PATH not in sys.path:
+    sys.path.insert(0, REPOSITORY_PATH)
+
+
+def git_revision():
+    """
+    :return: commit of the repository checkout, None if unknown
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_PATH,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """
+    :return: dictionary describing where the benchmarks ran
+    """
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def time_function(function, min_time=0.2, repeat=5):
+    """
+    Times a function, calling it in loops long enough to be measured.
+
+    The number of calls per loop is calibrated so that a loop takes
+    at least min_time seconds, then the loop is repeated.
+
+    :param function: function taking no arguments
+    :param min_time: minimum duration of a loop, in seconds
+    :param repeat: number of timed loops
+    :return: dictionary with the calls per loop and the best and median
+    time per call, in nanoseconds, and the calls per second of the best
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 1 << 30:
+            break
+        if elapsed <= 0:
+            number *= 10
+        else:
+            number = max(number * 2,
+                         int(number * min_time * 1.2 / elapsed))
+    loops = sorted(timer.repeat(repeat, number))
+    best = loops[0] / number
+    return {
+        'number': number,
+        'repeat': repeat,
+        'best_ns': best * 1e9,
+        'median_ns': loops[len(loops) // 2] / number * 1e9,
+        'ops_per_sec': 1.0 / best if best else None,
+    }
+
+
+def percentile(sorted_values, fraction):
+    """
+    :param sorted_values: sorted list of measured values
+    :param fraction: percentile as a fraction (0.99 for p99)
+    :return: the nearest-rank percentile, None for no values
+    """
+    if not sorted_values:
+        return None
+    rank = int(fraction * len(sorted_values) + 0.5)
+    return sorted_values[min(max(rank, 1), len(sorted_values)) - 1]
+
+
+def write_report(suite, results, output=None, parameters=None):
+    """
+    Writes the benchmark results as JSON.
+
+    :param suite: name of the benchmark suite
+    :param results: list of result dictionaries, each with a 'name'
+    :param output: path of the JSON file, None for standard output
+    :param parameters: parameters the suite was run with
+    """
+    report = {
+        'suite': suite,
+        'environment': environment(),
+        'parameters': parameters or {},
+        'results': results,
+    }
+    data = json.dumps(report, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+    if output is None:
+        print(data)
+    else:
+        with open(output, 'w') as report_file:
+            report_file.write(data + '\n')
@@ -0,0 +1,277 @@
+"""
+Micro-benchmarks of the libDiameter codec and of the DiameterMessage.
+
+Times, for each AVP type, the hex (encodeAVP, decodeAVP) and binary
+(encodeAVPBin, decodeAVPBin) codec, the encoding and decoding of deeply
+nested Grouped AVPs, the message level functions (splitMsgAVPs,
+stripHdr, createRes and their binary counterparts), the DiameterMessage
+construction in each of its modes, the AVP searches (findAVP and the path
+queries) and the dictionary loading.
+
+Usage:
+    python benchmarks/codec_benchmarks.py [--output results.json]
+"""
+
+import argparse
+
+from benchmark_utils import *
+from libDiameter import *
+import diameter_base
+
+# Sample AVP of each AVP type, as (type, AVP name, value)
+AVP_SAMPLES = [
+    ('OctetString', 'Class', 'charging-class-0123456789'),
+    ('UTF8String', 'Session-Id', 'pgw.asn.test;1525132800;42;7'),
+    ('DiameterIdentity', 'Origin-Host', 'client.asn.test'),
+    ('Integer32', '3GPP-Charging-Id', 123456),
+    ('Integer64', 'Value-Digits', 1234567890123),
+    ('Unsigned32', 'Result-Code', 2001),
+    ('Unsigned64', 'CC-Total-Octets', 12345678901),
+    ('Float32', 'Token-Rate', 1.5),
+    ('Enumerated', 'Accounting-Record-Type', 2),
+    ('Address', 'Host-IP-Address', '10.0.0.1'),
+    ('Address-IPv6', 'Host-IP-Address', '2001:db8::1'),
+    ('IP', 'Framed-IP-Address', '10.1.2.3'),
+    ('Time', 'Event-Timestamp', 1500000000),
+    ('Grouped', 'Vendor-Specific-Application-Id',
+     [('Vendor-Id', 10415), ('Acct-Application-Id', 3)]),
+]
+
+# Depths of the nested Grouped AVP benchmarks
+NESTING_DEPTHS = [1, 4, 8, 16]
+
+
+def encode_value(name, value, encode):
+    """
+    Encodes an AVP, encoding first the children of Grouped AVPs
+    given as (name, value) lists.
+    """
+    if isinstance(value, list):
+        value = [encode_value(child, child_value, encode)
+                 for child, child_value in value]
+    return encode(name, value)
+
+
+def nested_group(depth):
+    """
+    :param depth: number of nested Grouped levels
+    :return: Multiple-Services-Credit-Control value, with a
+    Used-Service-Unit nested depth times, as (name, value) lists
+    """
+    value = [('CC-Total-Octets', 99), ('CC-Time', 3)]
+    for level in range(depth):
+        value = [('Rating-Group', level), ('Used-Service-Unit', value)]
+    return value
+
+
+def build_value(builder, name, value):
+    """
+    Adds an AVP to an AVPBuilder, Grouped values being written
+    straight into the builder.
+
+    :param builder: AVPBuilder the AVP is added to
+    :param name: AVP name
+    :param value: AVP value, (name, value) list for Grouped AVPs
+    """
+    if isinstance(value, list):
+        with builder.group(name):
+            for child_name, child_value in value:
+                build_value(builder, child_name, child_value)
+    else:
+        builder.add(name, value)
+
+
+def build_avp(name, value):
+    """
+    :param name: AVP name
+    :param value: AVP value, (name, value) list for Grouped AVPs
+    :return: the AVP encoded with an AVPBuilder
+    """
+    builder = AVPBuilder()
+    build_value(builder, name, value)
+    return builder.finish()
+
+
+def sample_request_avps(encode):
+    """
+    :param encode: encodeAVP or encodeAVPBin
+    :return: AVPs of an interim Accounting Request
+    """
+    return [
+        encode_value('Session-Id', 'pgw.asn.test;1525132800;42;7', encode),
+        encode_value('Origin-Host', 'pgw.asn.test', encode),
+        encode_value('Origin-Realm', 'asn.test', encode),
+        encode_value('Destination-Realm', 'cdf.asn.test', encode),
+        encode_value('Accounting-Record-Type', 3, encode),
+        encode_value('Accounting-Record-Number', 1, encode),
+        encode_value('Acct-Application-Id', 3, encode),
+        encode_value('User-Name', 'alice@asn.test', encode),
+        encode_value('Acct-Interim-Interval', 300, encode),
+        encode_value('Origin-State-Id', 1, encode),
+        encode_value('Event-Timestamp', 1500000000, encode),
+        encode_value('Subscription-Id', [
+            ('Subscription-Id-Type', 1),
+            ('Subscription-Id-Data', '001010123456789')], encode),
+        encode_value('Multiple-Services-Credit-Control',
+                     nested_group(2), encode),
+    ]
+
+
+def codec_cases():
+    """
+    :return: list of (benchmark name, function) tuples
+    """
+    cases = []
+    for avp_type, name, value in AVP_SAMPLES:
+        hex_avp = encode_value(name, value, encodeAVP)
+        binary_avp = encode_value(name, value, encodeAVPBin)
+        children_hex = value
+        children_binary = value
+        if isinstance(value, list):
+            children_hex = [encodeAVP(*child) for child in value]
+            children_binary = [encodeAVPBin(*child) for child in value]
+        cases.extend([
+            ('encodeAVP/%s' % avp_type,
+             lambda n=name, v=children_hex: encodeAVP(n, v)),
+            ('encodeAVPBin/%s' % avp_type,
+             lambda n=name, v=children_binary: encodeAVPBin(n, v)),
+            ('decodeAVP/%s' % avp_type,
+             lambda a=hex_avp: decodeAVP(a)),
+            ('decodeAVPBin/%s' % avp_type,
+             lambda a=binary_avp: decodeAVPBin(a)),
+        ])
+    return cases
+
+
+def nesting_cases(depths):
+    """
+    :param depths: nesting depths to benchmark
+    :return: list of (benchmark name, function) tuples
+    """
+    cases = []
+    for depth in depths:
+        value = nested_group(depth)
+        name = 'Multiple-Services-Credit-Control'
+        hex_avp = encode_value(name, value, encodeAVP)
+        binary_avp = encode_value(name, value, encodeAVPBin)
+        cases.extend([
+            ('encodeAVP/Grouped-depth-%d' % depth,
+             lambda v=value: encode_value(name, v, encodeAVP)),
+            ('encodeAVPBin/Grouped-depth-%d' % depth,
+             lambda v=value: encode_value(name, v, encodeAVPBin)),
+            ('AVPBuilder/Grouped-depth-%d' % depth,
+             lambda v=value: build_avp(name, v)),
+            ('decodeAVP/Grouped-depth-%d' % depth,
+             lambda a=hex_avp: decodeAVP(a)),
+            ('decodeAVPBin/Grouped-depth-%d' % depth,
+             lambda a=binary_avp: decodeAVPBin(a)),
+        ])
+    return cases
+
+
+def message_cases():
+    """
+    :return: list of (benchmark name, function) tuples
+    """
+    header = HDRItem()
+    header.cmd = diameter_base.cmd_codes['Accounting']
+    header.appId = 3
+    header.HopByHop = 1
+    header.EndToEnd = 1
+    hex_avps = sample_request_avps(encodeAVP)
+    binary_avps = sample_request_avps(encodeAVPBin)
+    hex_message = createReq(header, hex_avps)
+    binary_message = memoryview(createReqBin(header, binary_avps))
+
+    hex_header = HDRItem()
+    stripHdr(hex_header, hex_message)
+    binary_header = HDRItem()
+    stripHdrBin(binary_header, binary_message)
+
+    def strip_hex():
+        stripHdr(HDRItem(), hex_message)
+
+    def strip_binary():
+        stripHdrBin(HDRItem(), binary_message)
+
+    def message_hex():
+        request = HDRItem()
+        stripHdr(request, hex_message)
+        return diameter_base.DiameterMessage(request)
+
+    def message_binary():
+        request = HDRItem()
+        stripHdrBin(request, binary_message)
+        return diameter_base.DiameterMessage(request)
+
+    def message_lazy():
+        request = HDRItem()
+        stripHdrBin(request, binary_message)
+        return diameter_base.DiameterMessage(request, lazy=True)
+
+    def message_lazy_lookup():
+        return message_lazy().avps['Accounting-Record-Type']
+
+    path = compileAVPPath(
+        'Multiple-Services-Credit-Control/Used-Service-Unit/CC-Total-Octets')
+
+    return [
+        ('splitMsgAVPs', lambda: splitMsgAVPs(hex_header.msg)),
+        ('splitMsgAVPsBin', lambda: splitMsgAVPsBin(binary_header.msg)),
+        ('stripHdr', strip_hex),
+        ('stripHdrBin', strip_binary),
+        ('createRes', lambda: createRes(header, hex_avps)),
+        ('createResBin', lambda: createResBin(header, binary_avps)),
+        ('DiameterMessage/hex', message_hex),
+        ('DiameterMessage/binary', message_binary),
+        ('DiameterMessage/lazy', message_lazy),
+        ('DiameterMessage/lazy-one-avp', message_lazy_lookup),
+        ('findAVP', lambda: findAVP('Subscription-Id', hex_avps)),
+        ('findAVPBin/top-level',
+         lambda: findAVPBin('Subscription-Id', binary_header.msg)),
+        ('findAllAVPsBin/nested-path',
+         lambda: findAllAVPsBin(path, binary_header.msg)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of the Diameter codec')
+    parser.add_argument('--output', help='JSON report file (default: stdout)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum duration of a timed loop, in seconds')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed loops per benchmark')
+    parser.add_argument('--filter', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--depths', type=int, nargs='+',
+                        default=NESTING_DEPTHS,
+                        help='nesting depths of the Grouped AVP benchmarks')
+    arguments = parser.parse_args()
+
+    LoadDictionary(DICTIONARY_PATH)
+    cases = [('LoadDictionary', lambda: LoadDictionary(DICTIONARY_PATH)),
+             ('LoadDictionary/uncached',
+              lambda: LoadDictionary(DICTIONARY_PATH, ''))]
+    cases.extend(codec_cases())
+    cases.extend(nesting_cases(arguments.depths))
+    cases.extend(message_cases())
+
+    results = []
+    for name, function in cases:
+        if arguments.filter not in name:
+            continue
+        result = time_function(function, arguments.min_time, arguments.repeat)
+        result['name'] = name
+        results.append(result)
+        sys.stderr.write('%-40s %12.0f ns\n' % (name, result['best_ns']))
+
+    write_report('codec', results, arguments.output, {
+        'min_time': arguments.min_time,
+        'repeat': arguments.repeat,
+        'depths': arguments.depths,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Compares two JSON benchmark reports, flagging the regressions.
+
+Codec results are compared on their best time per call, server results
+on their messages per second and p99 latency. Exits with status 1 when
+any benchmark got slower than the threshold, so it can gate a deploy.
+
+Usage:
+    python benchmarks/compare_benchmarks.py baseline.json current.json
+        [--threshold 0.10]
+"""
+
+import argparse
+import json
+import sys
+
+# Compared metrics: (name, path in the result, True if higher is better)
+METRICS = [
+    ('best_ns', ('best_ns',), False),
+    ('messages_per_sec', ('messages_per_sec',), True),
+    ('p99_ms', ('latency_ms', 'p99'), False),
+]
+
+
+def metric_value(result, path):
+    for key in path:
+        if not isinstance(result, dict) or result.get(key) is None:
+            return None
+        result = result[key]
+    return result
+
+
+def load_results(path):
+    """
+    :param path: path of a JSON benchmark report
+    :return: dictionary of the report results, by benchmark name
+    """
+    with open(path) as report_file:
+        report = json.load(report_file)
+    return dict((result['name'], result) for result in report['results'])
+
+
+def compare(baseline, current, threshold):
+    """
+    :param baseline: results of the reference run, by name
+    :param current: results of the compared run, by name
+    :param threshold: relative change above which a benchmark regressed
+    :return: list of (name, metric, baseline, current, change, regressed)
+    """
+    changes = []
+    for name in sorted(set(baseline) & set(current)):
+        for metric, path, higher_is_better in METRICS:
+            before = metric_value(baseline[name], path)
+            after = metric_value(current[name], path)
+            if not before or after is None:
+                continue
+            change = (after - before) / float(before)
+            if higher_is_better:
+                regressed = change < -threshold
+            else:
+                regressed = change > threshold
+            changes.append((name, metric, before, after, change, regressed))
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare two benchmark reports')
+    parser.add_argument('baseline', help='JSON report of the reference run')
+    parser.add_argument('current', help='JSON report of the compared run')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative change considered a regression')
+    arguments = parser.parse_args()
+
+    changes = compare(load_results(arguments.baseline),
+                      load_results(arguments.current),
+                      arguments.threshold)
+    regressions = 0
+    for name, metric, before, after, change, regressed in changes:
+        regressions += regressed
+        print('%-40s %-16s %14.3f %14.3f %+7.1f%%%s' % (
+            name, metric, before, after, change * 100,
+            '  REGRESSION' if regressed else ''))
+    if regressions:
+        print('%d regression(s) above %.0f%%' % (
+            regressions, arguments.threshold * 100))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+"""
+Loopback macro-benchmarks of the Diameter servers.
+
+Starts a DiameterServer (or an AsyncDiameterServer) in a child process,
+then drives it from DiameterClient connections at a fixed concurrency:
+each concurrency slot keeps exactly one request outstanding, sending
+the next one as soon as the answer is received (closed loop).
+Reports the answered messages per second and the p50, p99 and p999
+latencies, measured after a warm-up period.
+
+Usage:
+    python benchmarks/server_benchmarks.py [--server async]
+        [--concurrency 1 16 64] [--output results.json]
+"""
+
+import argparse
+import signal
+import socket
+import threading
+
+from benchmark_utils import *
+from diameter_async_server import *
+from diameter_client import *
+
+SERVERS = {
+    'sync': DiameterServer,
+    'async': AsyncDiameterServer,
+}
+
+
+def watchdog_request(client, sequence):
+    """
+    :return: header and AVPs of a Device Watchdog Request
+    """
+    request = client.generate_generic_request(
+        diameter_base.cmd_codes['Device-Watchdog'])
+    request['avps'].append(encodeAVPBin('Origin-State-Id', 1))
+    return request['header'], request['avps']
+
+
+def accounting_request(client, sequence):
+    """
+    :return: header and AVPs of an EVENT Accounting Request
+    """
+    header = HDRItem()
+    header.cmd = diameter_base.cmd_codes['Accounting']
+    header.flags = DIAMETER_HDR_PROXIABLE
+    header.appId = 3
+    avps = [
+        encodeAVPBin('Session-Id', '%s;%d;%d' % (
+            client.origin_host, id(client), sequence)),
+        encodeAVPBin('Origin-Host', client.origin_host),
+        encodeAVPBin('Origin-Realm', client.origin_realm),
+        encodeAVPBin('Destination-Realm', client.destination_realm),
+        encodeAVPBin('Accounting-Record-Type', 1),
+        encodeAVPBin('Accounting-Record-Number', 0),
+        encodeAVPBin('Acct-Application-Id', 3),
+    ]
+    return header, avps
+
+
+MESSAGES = {
+    'dwr': watchdog_request,
+    'acr': accounting_request,
+}
+
+
+def start_server(arguments):
+    """
+    Runs the benchmarked server in a child process.
+
+    :return: pid of the server process
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server = SERVERS[arguments.server](
+                port=arguments.port, max_clients=arguments.connections + 1,
+                workers=arguments.workers)
+            logging.getLogger().setLevel(arguments.log_level)
+            server.start()
+        finally:
+            os._exit(0)
+    return pid
+
+
+def wait_for_server(port, timeout=10.0):
+    """
+    Waits until the server accepts connections.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def run_slot(client, make_request, stop_at, warmup_until, latencies, errors):
+    """
+    Closed loop of one concurrency slot: sends a request,
+    waits for its answer and sends the next one.
+    """
+    sequence = 0
+    while time.time() < stop_at:
+        sequence += 1
+        header, avps = make_request(client, sequence)
+        pending = client.send_request(header, avps)
+        try:
+            pending.result()
+        except Exception:
+            errors.append(sequence)
+            continue
+        if pending.sent_at >= warmup_until:
+            latencies.append(pending.latency())
+
+
+def run_level(clients, arguments, concurrency):
+    """
+    Drives the server at the given concurrency.
+
+    :return: result dictionary of the run
+    """
+    latencies = []
+    errors = []
+    started = time.time()
+    warmup_until = started + arguments.warmup
+    stop_at = warmup_until + arguments.duration
+    slots = []
+    for slot in range(concurrency):
+        thread = threading.Thread(target=run_slot, args=(
+            clients[slot % len(clients)], MESSAGES[arguments.message],
+            stop_at, warmup_until, latencies, errors))
+        thread.daemon = True
+        thread.start()
+        slots.append(thread)
+    for thread in slots:
+        thread.join()
+
+    latencies.sort()
+    milliseconds = [latency * 1000.0 for latency in latencies]
+    return {
+        'name': 'loopback/%s/%s/c%d' % (
+            arguments.server, arguments.message, concurrency),
+        'server': arguments.server,
+        'message': arguments.message,
+        'concurrency': concurrency,
+        'connections': len(clients),
+        'messages': len(latencies),
+        'errors': len(errors),
+        'messages_per_sec': len(latencies) / float(arguments.duration),
+        'latency_ms': {
+            'p50': percentile(milliseconds, 0.50),
+            'p99': percentile(milliseconds, 0.99),
+            'p999': percentile(milliseconds, 0.999),
+            'max': milliseconds[-1] if milliseconds else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Loopback benchmarks of the Diameter servers')
+    parser.add_argument('--server', choices=sorted(SERVERS), default='sync')
+    parser.add_argument('--message', choices=sorted(MESSAGES), default='dwr')
+    parser.add_argument('--port', type=int, default=13868)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of server worker processes')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='number of client connections')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 16, 64],
+                        help='outstanding requests, one run for each')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='measured seconds of each run')
+    parser.add_argument('--warmup', type=float, default=2.0,
+                        help='seconds of each run not measured')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='logging level of the server')
+    parser.add_argument('--output', help='JSON report file (default: stdout)')
+    arguments = parser.parse_args()
+
+    # The server and the clients load the dictionary from the repository
+    os.chdir(REPOSITORY_PATH)
+    server_pid = start_server(arguments)
+    logging.getLogger().setLevel(logging.WARNING)
+    clients = []
+    results = []
+    try:
+        wait_for_server(arguments.port)
+        for connection in range(arguments.connections):
+            client = DiameterClient(port=arguments.port)
+            client.start()
+            clients.append(client)
+        for concurrency in arguments.concurrency:
+            result = run_level(clients, arguments, concurrency)
+            results.append(result)
+            sys.stderr.write('%-30s %10.0f msg/s  p50 %.3f ms  p99 %.3f ms\n' % (
+                result['name'], result['messages_per_sec'],
+                result['latency_ms']['p50'] or 0,
+                result['latency_ms']['p99'] or 0))
+    finally:
+        for client in clients:
+            client.close()
+        os.kill(server_pid, signal.SIGINT)
+        os.waitpid(server_pid, 0)
+
+    write_report('server', results, arguments.output, {
+        'server': arguments.server,
+        'message': arguments.message,
+        'workers': arguments.workers,
+        'connections': arguments.connections,
+        'duration': arguments.duration,
+        'warmup': arguments.warmup,
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+"""
+Accounting session management, for the Rf accounting (ACR/ACA) answers.
+
+Contains:
+- accounting record types
+- accounting session record
+- timer wheel used to expire the stale sessions
+- bounded session store, keyed by Session-Id
+"""
+
+import math
+import struct
+import threading
+import time
+
+import libDiameter
+
+# Values of the Accounting-Record-Type AVP
+EVENT_RECORD = 1
+START_RECORD = 2
+INTERIM_RECORD = 3
+STOP_RECORD = 4
+
+accounting_record_types = {
+    EVENT_RECORD: 'EVENT_RECORD',
+    START_RECORD: 'START_RECORD',
+    INTERIM_RECORD: 'INTERIM_RECORD',
+    STOP_RECORD: 'STOP_RECORD',
+}
+
+
+def enumerated_value(value, avp_name=None):
+    """
+    Enumerated AVPs are decoded as their raw 4 bytes by default,
+    as their code or as their enum name (see setEnumDecoding),
+    this returns them as an integer.
+
+    :param value: decoded Enumerated AVP value
+    :param avp_name: name of the AVP, needed to look up enum names
+    :return: integer value of the AVP
+    """
+    if isinstance(value, (int, long)):
+        return value
+    if avp_name is not None:
+        code = libDiameter.dictENUMname2code(avp_name, value)
+        if code is not None:
+            return code
+    return struct.unpack("!I", value)[0]
+
+
+class AccountingSession(object):
+    """
+    State kept for an open accounting session.
+
+    Uses __slots__ instead of a per instance dictionary,
+    keeping the memory used by millions of open sessions low.
+    """
+
+    __slots__ = ('session_id', 'origin_host', 'started', 'updated',
+                 'expires', 'record_number', 'interim_interval',
+                 'interim_records', 'bucket')
+
+    def __init__(self, session_id, origin_host, now):
+        """
+        :param session_id: Session-Id of the accounting session
+        :param origin_host: Origin-Host of the peer that opened it
+        :param now: time the session was opened
+        """
+        self.session_id = session_id
+        self.origin_host = origin_host
+        self.started = now
+        self.updated = now
+        self.expires = now
+        self.record_number = 0
+        self.interim_interval = 0
+        self.interim_records = 0
+        # Timer wheel bucket holding the session, None if not scheduled
+        self.bucket = None
+
+    def __repr__(self):
+        return '<AccountingSession %s from %s, %d records>' % (
+            self.session_id, self.origin_host, self.record_number)
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel, grouping the sessions by expiry time.
+
+    Each bucket holds the sessions expiring in one tick (resolution
+    seconds) of a revolution, so scheduling and cancelling a session
+    only moves it between two sets. Advancing the wheel only visits
+    the buckets of the elapsed ticks; sessions expiring in a later
+    revolution stay in their bucket until then.
+    """
+
+    def __init__(self, slots=4096, resolution=1.0, now=None):
+        """
+        :param slots: number of buckets of the wheel
+        :param resolution: seconds covered by each bucket
+        :param now: current time, time.time() by default
+        """
+        if now is None:
+            now = time.time()
+        self.slots = slots
+        self.resolution = resolution
+        self.buckets = [set() for _ in range(slots)]
+        # Next tick to be processed when advancing the wheel
+        self.tick = int(now / resolution)
+
+    def schedule(self, session, expires):
+        """
+        Schedules (or re-schedules) the expiry of a session.
+
+        :param session: AccountingSession to expire
+        :param expires: time at which the session expires
+        """
+        self.cancel(session)
+        # First tick ending at or after expires, so a processed bucket
+        # only holds due sessions (or sessions of a later revolution),
+        # never into a tick that was already processed
+        tick = max(int(math.ceil(expires / self.resolution)), self.tick)
+        session.expires = expires
+        session.bucket = tick % self.slots
+        self.buckets[session.bucket].add(session)
+
+    def cancel(self, session):
+        """
+        :param session: AccountingSession not to expire anymore
+        """
+        if session.bucket is not None:
+            self.buckets[session.bucket].discard(session)
+            session.bucket = None
+
+    def advance(self, now):
+        """
+        Processes the ticks elapsed until now.
+
+        :param now: current time
+        :return: list of the expired sessions, removed from the wheel
+        """
+        expired = []
+        last_tick = int(now / self.resolution)
+        if last_tick < self.tick:
+            return expired
+        # Visiting more than one revolution would check the same buckets
+        first_tick = max(self.tick, last_tick - self.slots + 1)
+        for tick in range(first_tick, last_tick + 1):
+            bucket = self.buckets[tick % self.slots]
+            if not bucket:
+                continue
+            due = [session for session in bucket if session.expires <= now]
+            for session in due:
+                bucket.discard(session)
+                session.bucket = None
+            expired.extend(due)
+        self.tick = last_tick + 1
+        return expired
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+
+class SessionStore:
+    """
+    Bounded store of the open accounting sessions, keyed by Session-Id.
+
+    Sessions are opened by START records (or by INTERIM records whose
+    START was lost), refreshed by INTERIM records and closed by STOP
+    records. A session not updated in time (twice its
+    Acct-Interim-Interval, or the session timeout if there is none)
+    is considered stale and expired by the timer wheel.
+    When max_sessions are open no new session is accepted,
+    so the memory used stays bounded under any load.
+    """
+
+    def __init__(self, max_sessions=1000000, session_timeout=3600,
+                 interim_grace=2, resolution=1.0):
+        """
+        :param max_sessions: maximum number of open sessions
+        :param session_timeout: seconds after which a session
+        without interim interval is expired
+        :param interim_grace: number of interim intervals
+        after which a session without updates is expired
+        :param resolution: expiry timer resolution, in seconds
+        """
+        self.max_sessions = max_sessions
+        self.session_timeout = session_timeout
+        self.interim_grace = interim_grace
+        self.sessions = {}
+        self.timers = TimerWheel(resolution=resolution)
+        self.lock = threading.Lock()
+        self.opened = 0
+        # Sessions opened by an INTERIM record, their START being lost
+        self.recovered = 0
+        self.closed = 0
+        self.expired = 0
+        self.rejected = 0
+
+    def _timeout(self, session):
+        if session.interim_interval:
+            return session.interim_interval * self.interim_grace
+        return self.session_timeout
+
+    def _update(self, session, record_number, interim_interval, now,
+                interim=False):
+        session.updated = now
+        if interim:
+            session.interim_records += 1
+        if record_number is not None:
+            session.record_number = record_number
+        if interim_interval:
+            session.interim_interval = interim_interval
+        self.timers.schedule(session, now + self._timeout(session))
+
+    def expire(self, now=None):
+        """
+        Removes the stale sessions.
+
+        :param now: current time, time.time() by default
+        :return: list of the expired sessions
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            return self._expire(now)
+
+    def _expire(self, now):
+        expired = self.timers.advance(now)
+        for session in expired:
+            del self.sessions[session.session_id]
+        self.expired += len(expired)
+        return expired
+
+    def start(self, session_id, origin_host, record_number=None,
+              interim_interval=0, now=None):
+        """
+        Opens a session, or refreshes it if already open
+        (e.g. on a retransmitted START).
+
+        :param session_id: Session-Id of the session
+        :param origin_host: Origin-Host of the peer
+        :param record_number: Accounting-Record-Number of the record
+        :param interim_interval: Acct-Interim-Interval, 0 if none
+        :param now: current time, time.time() by default
+        :return: the AccountingSession, None if the store is full
+        """
+        return self._open(session_id, origin_host, record_number,
+                          interim_interval, now, False)
+
+    def interim(self, session_id, origin_host, record_number=None,
+                interim_interval=0, now=None):
+        """
+        Refreshes a session, opening it if its START was not received.
+
+        :return: the AccountingSession, None if the store is full
+        """
+        return self._open(session_id, origin_host, record_number,
+                          interim_interval, now, True)
+
+    def _open(self, session_id, origin_host, record_number,
+              interim_interval, now, interim):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self._expire(now)
+            session = self.sessions.get(session_id)
+            if session is None:
+                if len(self.sessions) >= self.max_sessions:
+                    self.rejected += 1
+                    return None
+                session = AccountingSession(session_id, origin_host, now)
+                self.sessions[session_id] = session
+                if interim:
+                    self.recovered += 1
+                else:
+                    self.opened += 1
+            self._update(session, record_number, interim_interval, now,
+                         interim)
+            return session
+
+    def stop(self, session_id, record_number=None, now=None):
+        """
+        Closes a session.
+
+        :param session_id: Session-Id of the session
+        :param record_number: Accounting-Record-Number of the record
+        :param now: current time, time.time() by default
+        :return: the closed AccountingSession, None if it was not open
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self._expire(now)
+            session = self.sessions.pop(session_id, None)
+            if session is None:
+                return None
+            self.timers.cancel(session)
+            session.updated = now
+            if record_number is not None:
+                session.record_number = record_number
+            self.closed += 1
+            return session
+
+    def get(self, session_id):
+        """
+        :param session_id: Session-Id of the session
+        :return: the open AccountingSession, None if not open
+        """
+        return self.sessions.get(session_id)
+
+    def stats(self):
+        """
+        :return: dictionary with the session counters
+        """
+        return {
+            'open': len(self.sessions),
+            'opened': self.opened,
+            'recovered': self.recovered,
+            'closed': self.closed,
+            'expired': self.expired,
+            'rejected': self.rejected,
+        }
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
@@ -0,0 +1,253 @@
+"""
+Module implementing an event driven Diameter server.
+
+All the peer connections are served by a single event loop (asyncore,
+polling the sockets), instead of one thread per connection, so the server
+can terminate thousands of concurrent peer connections.
+The responses are generated by the same cmd_code_responses handlers
+as for the threaded DiameterServer.
+"""
+
+import asyncore
+import errno
+from diameter_server import *
+
+# Errors meaning there is nothing to read yet on a non blocking socket
+_RETRY_ERRORS = (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR)
+
+
+class DiameterPeerChannel(asyncore.dispatcher):
+    """
+    Event loop channel for a single peer connection.
+
+    Incoming data is split into Diameter requests by the peer's framer,
+    and the responses are queued into an output buffer, written whenever
+    the socket accepts more data. While the output buffer is above the
+    server's write buffer limit the peer is not read from anymore, so a
+    peer not reading its answers can not make the server queue
+    an unbounded amount of data (backpressure).
+    """
+
+    def __init__(self, server, connection, address):
+        """
+        :param server: AsyncDiameterServer the connection belongs to
+        :param connection: socket connection to the peer
+        :param address: address of the peer
+        """
+
+        asyncore.dispatcher.__init__(self, connection, map=server.socket_map)
+        self.server = server
+        self.address = address
+        self.framer = DiameterFramer(server.buffer_size)
+        self.outgoing = bytearray()
+        self.open = True
+        server.metrics.connection_opened()
+
+    def readable(self):
+        return len(self.outgoing) < self.server.write_buffer_limit
+
+    def writable(self):
+        return len(self.outgoing) > 0
+
+    def handle_read(self):
+        try:
+            received = self.framer.recv_from(self.socket)
+        except socket.error as error:
+            if error.args[0] in _RETRY_ERRORS:
+                return
+            self.handle_close()
+            return
+        # no data found (closed socket)
+        if received == 0:
+            self.handle_close()
+            return
+        try:
+            for request_info in self.framer.messages():
+                logging.debug("Handling request for address %s", self.address)
+                self.write(self.server.generate_response(request_info,
+                                                         self.address))
+        except DiameterFramingError as error:
+            logging.error("Closing connection to %s: %s", self.address, error)
+            self.handle_close()
+            return
+        if self.outgoing:
+            # Try sending right away, instead of waiting for the next poll
+            self.handle_write()
+
+    def write(self, data):
+        """
+        Queues data to be sent to the peer.
+
+        :param data: encoded Diameter message
+        """
+
+        self.outgoing += data
+
+    def handle_write(self):
+        sending = time.time()
+        sent = self.send(self.outgoing)
+        if sent:
+            del self.outgoing[:sent]
+            self.server.metrics.record_stage('send', time.time() - sending)
+
+    def handle_close(self):
+        logging.info("Disconnected from %s", self.address)
+        self.close()
+
+    def close(self):
+        if self.open:
+            self.open = False
+            self.server.metrics.connection_closed()
+        asyncore.dispatcher.close(self)
+
+
+class DiameterListener(asyncore.dispatcher):
+    """
+    Event loop channel accepting the incoming peer connections.
+    """
+
+    def __init__(self, server, reuse_port=False):
+        """
+        :param server: AsyncDiameterServer accepting the connections
+        :param reuse_port: set SO_REUSEPORT, allowing several processes
+        to bind the same port
+        """
+
+        asyncore.dispatcher.__init__(self, map=server.socket_map)
+        self.server = server
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.bind((server.host, server.port))
+        self.listen(min(server.max_clients, socket.SOMAXCONN))
+
+    def handle_accept(self):
+        accepted = self.accept()
+        if accepted is None:
+            return
+        incoming_connection, peer_address = accepted
+        if self.server.active_connections() >= self.server.max_clients:
+            logging.warning("Refusing connection from %s, too many peers",
+                            peer_address)
+            incoming_connection.close()
+            return
+        logging.info('Connected to %s', peer_address)
+        DiameterPeerChannel(self.server, incoming_connection, peer_address)
+
+
+class AsyncDiameterServer(DiameterServer):
+    """
+    Diameter Server serving every peer connection from one event loop.
+    """
+
+    def __init__(self,
+                 host="127.0.0.1",
+                 port=3868,
+                 buffer_size=4096,
+                 max_clients=10000,
+                 origin_host='server.asn.test',
+                 origin_realm='asn.test',
+                 workers=1,
+                 reuse_port=True,
+                 write_buffer_limit=1048576,
+                 cdr_writer=None,
+                 metrics_port=None,
+                 tracer=None,
+                 recorder=None):
+        """
+        Same as the DiameterServer, with max_clients being enforced
+        as the limit of concurrently connected peers.
+
+        :param host: host of the server
+        :param port: port used for connection
+        :param buffer_size: initial size of each peer's receive buffer
+        :param max_clients: maximum number of peers connected at a time
+        :param origin_host: Diameter Origin Host
+        :param origin_realm: Diameter Origin Realm
+        :param workers: number of worker processes
+        :param reuse_port: each worker binds its own socket on the port
+        with SO_REUSEPORT, instead of sharing a single listening socket
+        :param write_buffer_limit: bytes queued for a peer above which
+        the peer is not read from until its answers are sent
+        :param cdr_writer: CDRWriter writing the completed accounting
+        sessions and events as CDRs, None to not write any
+        :param metrics_port: local port serving the metrics in the
+        Prometheus text format, None to not serve them
+        :param tracer: MessageTracer capturing a sample of the decoded
+        exchanges, None to not capture any
+        :param recorder: PcapWriter recording every request and answer,
+        None to not record the traffic
+        """
+
+        self.socket_map = {}
+        self.listener = None
+        DiameterServer.__init__(self, host, port, buffer_size, max_clients,
+                                origin_host, origin_realm, workers,
+                                reuse_port, cdr_writer, metrics_port, tracer,
+                                recorder)
+        self.write_buffer_limit = write_buffer_limit
+
+    def register_gauges(self):
+        """
+        Registers the gauges read with the server's metrics,
+        adding the bytes queued for the peers.
+        """
+
+        DiameterServer.register_gauges(self)
+        self.metrics.gauge('diameter_write_queue_bytes',
+                           self.queued_bytes,
+                           'Answer bytes queued for the peers')
+
+    def queued_bytes(self):
+        """
+        :return: number of answer bytes waiting to be sent to the peers
+        """
+        return sum(len(channel.outgoing)
+                   for channel in self.socket_map.values()
+                   if isinstance(channel, DiameterPeerChannel))
+
+    def active_connections(self):
+        """
+        :return: number of currently connected peers
+        """
+        return len(self.socket_map) - (self.listener is not None)
+
+    def listen(self, reuse_port=False):
+        """
+        Starts listening on the pre-defined port,
+        without serving the connections yet.
+
+        :param reuse_port: set SO_REUSEPORT, allowing several processes
+        to bind the same port
+        """
+
+        self.listener = DiameterListener(self, reuse_port)
+
+    def serve(self, timeout=30.0, count=None):
+        """
+        Runs the event loop, serving the listening socket
+        and every connected peer.
+
+        :param timeout: poll timeout, in seconds
+        :param count: number of loop iterations (None runs forever)
+        """
+
+        asyncore.loop(timeout=timeout, use_poll=True,
+                      map=self.socket_map, count=count)
+
+    def close(self):
+        """
+        Closes the listening socket and every peer connection,
+        writes the queued CDRs and stops serving the metrics.
+        """
+
+        asyncore.close_all(map=self.socket_map)
+        self.listener = None
+        if self.cdr_writer is not None:
+            self.cdr_writer.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.recorder is not None:
+            self.recorder.close()
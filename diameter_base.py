@@ -4,21 +4,35 @@ Base/Common information for the Diameter implementation used.
 Contains:
 - command codes mapping
 - result codes mapping
-- Diameter message object
-- method used to decode hex AVPs into a dictionary
+- Diameter message object, with optional lazy AVP decoding
+- ordered AVP container, keeping the repeated AVPs
+- method used to decode hex or binary AVPs into an AVP container
 """
 
+import array
+import collections
+import struct
+import libDiameter
 from libDiameter import *
 
 cmd_codes = {
     'Capability-Exchange': 257,
     'Re-Auth': 258,
+    'Accounting': 271,
+    'Credit-Control': 272,
     'Device-Watchdog': 280,
 }
 
 result_codes = {
     'DIAMETER_SUCCESS': 2001,
+    'DIAMETER_OUT_OF_SPACE': 4002,
+    'DIAMETER_END_USER_SERVICE_DENIED': 4010,
+    'DIAMETER_CREDIT_LIMIT_REACHED': 4012,
+    'DIAMETER_UNKNOWN_SESSION_ID': 5002,
+    'DIAMETER_INVALID_AVP_VALUE': 5004,
+    'DIAMETER_MISSING_AVP': 5005,
     'DIAMETER_UNABLE_TO_COMPLY': 5012,
+    'DIAMETER_USER_UNKNOWN': 5030,
 }
 
 standard_avp_values = {
@@ -28,12 +42,267 @@ standard_avp_values = {
     'Acct-Application-Id': 3,
 }
 
+# AVP header (code, flags and length) and vendor fields
+AVP_HEADER = struct.Struct("!II")
+AVP_VENDOR = struct.Struct("!I")
+
+
+class LazyAVPGroup(collections.Sequence):
+    """
+    Grouped AVP value decoded on demand.
+
+    Behaves as the list of (name, value) tuples returned for Grouped AVPs
+    by decodeAVPBin, but the child AVPs are only located when the group
+    is first accessed, and each child value is decoded (and cached)
+    only when it is read. Grouped children are LazyAVPGroup objects too.
+    """
+
+    def __init__(self, raw_msg, start, end):
+        """
+        :param raw_msg: buffer holding the grouped AVP
+        :param start: offset of the grouped AVP data in the buffer
+        :param end: offset where the grouped AVP data ends
+        """
+        self.raw_msg = raw_msg
+        self.start = start
+        self.end = end
+        self._children = None
+
+    def _index(self):
+        if self._children is None:
+            self._children = [
+                [offset, None]
+                for offset, length in indexAVPsBin(
+                    self.raw_msg, self.start, self.end)]
+        return self._children
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in
+                    range(*position.indices(len(self)))]
+        child = self._index()[position]
+        if child[1] is None:
+            child[1] = decode_lazy_avp(self.raw_msg, child[0])
+        return child[1]
+
+    def __len__(self):
+        return len(self._index())
+
+    def get(self, name, default=None):
+        """
+        Returns the value of the first child AVP with the given name.
+
+        :param name: AVP name
+        :param default: value returned if the AVP is not present
+        """
+        for field, value in self:
+            if field == name:
+                return value
+        return default
+
+    def __eq__(self, other):
+        if isinstance(other, (list, LazyAVPGroup)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class AVPList(collections.MutableMapping):
+    """
+    Ordered container of the AVPs of a message, keeping every occurrence
+    of repeated AVPs (Host-IP-Address, Multiple-Services-Credit-Control...).
+
+    The AVP headers are read in a single pass into parallel arrays holding
+    the code, vendor, flags, offset and length of each AVP in the buffer,
+    while the AVP names are indexed to their positions. Values are decoded
+    upfront, or in lazy mode the first time they are read (Grouped values
+    then being LazyAVPGroup objects), and cached afterwards.
+
+    As a mapping, an AVP name gives its last occurrence, as the plain
+    dictionary of AVPs did; getall returns every occurrence of a name and
+    allitems every AVP, in the message order. Setting a name replaces all
+    of its occurrences, while add appends another one.
+    """
+
+    def __init__(self, raw_msg=None, lazy=False):
+        """
+        :param raw_msg: buffer (memoryview) holding the message AVPs,
+        None for an empty container
+        :param lazy: decode AVP values on first access instead of upfront
+        """
+        self.raw_msg = raw_msg
+        self.lazy = lazy
+        self.codes = array.array('I')
+        self.vendors = array.array('I')
+        self.flags = array.array('B')
+        self.offsets = array.array('I')
+        self.lengths = array.array('I')
+        # Decoded value of each AVP, None until decoded
+        self._values = []
+        # Positions of the AVPs, by name
+        self._positions = {}
+        if raw_msg is None:
+            return
+        codes, vendors, flags = self.codes, self.vendors, self.flags
+        offsets, lengths, values = self.offsets, self.lengths, self._values
+        avp_decoders = libDiameter.dict_avp_decoders
+        unpack_header = AVP_HEADER.unpack_from
+        unpack_vendor = AVP_VENDOR.unpack_from
+        offset = 0
+        end = len(raw_msg)
+        while offset + 8 <= end:
+            code, flags_length = unpack_header(raw_msg, offset)
+            length = flags_length & 0x00FFFFFF
+            if length < 8:
+                # Malformed AVP, stop instead of looping forever
+                break
+            start = offset + 8
+            vendor = 0
+            if flags_length & (DIAMETER_FLAG_VENDOR << 24):
+                vendor = unpack_vendor(raw_msg, start)[0]
+                start += 4
+            decoder = avp_decoders.get((code, vendor))
+            if decoder is None:
+                decoder = getAVPDecoder(code, vendor)
+            name, avp_type, decode = decoder
+            positions = self._positions.get(name)
+            if positions is None:
+                self._positions[name] = [len(self._values)]
+            else:
+                positions.append(len(self._values))
+            codes.append(code)
+            vendors.append(vendor)
+            flags.append(flags_length >> 24)
+            offsets.append(offset)
+            lengths.append(length)
+            if lazy:
+                values.append(None)
+            else:
+                values.append(decode(raw_msg, start, offset + length))
+            offset += (length + 3) & ~3
+
+    def _decode(self, position):
+        value = self._values[position]
+        # AVPs added after decoding have no length in the buffer
+        if value is None and self.lengths[position]:
+            offset = self.offsets[position]
+            start = offset + 8
+            if self.flags[position] & DIAMETER_FLAG_VENDOR:
+                start += 4
+            end = offset + self.lengths[position]
+            name, avp_type, decode = getAVPDecoder(
+                self.codes[position], self.vendors[position])
+            if self.lazy and avp_type == "Grouped":
+                value = LazyAVPGroup(self.raw_msg, start, end)
+            else:
+                value = decode(self.raw_msg, start, end)
+            self._values[position] = value
+        return value
+
+    def __getitem__(self, name):
+        return self._decode(self._positions[name][-1])
+
+    def getall(self, name):
+        """
+        :param name: AVP name
+        :return: list of the values of every occurrence of the AVP,
+        in the message order (empty if the AVP is not present)
+        """
+        return [self._decode(position)
+                for position in self._positions.get(name, ())]
+
+    def allitems(self):
+        """
+        :return: list of (name, value) tuples of every AVP,
+        in the message order
+        """
+        names = [None] * len(self._values)
+        for name, positions in self._positions.iteritems():
+            for position in positions:
+                names[position] = name
+        return [(name, self._decode(position))
+                for position, name in enumerate(names)
+                if name is not None]
+
+    def add(self, name, value):
+        """
+        Appends an AVP, keeping the previous occurrences of its name.
+
+        :param name: AVP name
+        :param value: AVP value
+        """
+        avp = libDiameter.dict_avp_byname.get(name)
+        if avp is not None and avp.vendor is not None:
+            self.codes.append(int(avp.code))
+            self.vendors.append(int(avp.vendor))
+        else:
+            self.codes.append(0)
+            self.vendors.append(0)
+        # Not found in the buffer
+        self.flags.append(0)
+        self.offsets.append(0)
+        self.lengths.append(0)
+        self._positions.setdefault(name, []).append(len(self._values))
+        self._values.append(value)
+
+    def __setitem__(self, name, value):
+        self._positions.pop(name, None)
+        self.add(name, value)
+
+    def __delitem__(self, name):
+        del self._positions[name]
+
+    def __iter__(self):
+        # Distinct names, in the order of their first occurrence
+        firsts = sorted((positions[0], name)
+                        for name, positions in self._positions.iteritems())
+        return iter([name for position, name in firsts])
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def decode_lazy_avp(raw_msg, offset):
+    """
+    Decodes the AVP at the given offset, leaving Grouped AVPs undecoded.
+
+    :param raw_msg: buffer holding the AVP
+    :param offset: offset of the AVP in the buffer
+    :return: (name, value) tuple, value being a LazyAVPGroup for groups
+    """
+    code, flags_length = AVP_HEADER.unpack_from(raw_msg, offset)
+    start = offset + 8
+    end = offset + (flags_length & 0x00FFFFFF)
+    vendor = 0
+    if flags_length & (DIAMETER_FLAG_VENDOR << 24):
+        vendor = AVP_VENDOR.unpack_from(raw_msg, start)[0]
+        start += 4
+    # per-AVP decoder, e.g. decoding enum names (see setEnumDecoding)
+    name, avp_type, decode = getAVPDecoder(code, vendor)
+    if avp_type == "Grouped":
+        return name, LazyAVPGroup(raw_msg, start, end)
+    return name, decode(raw_msg, start, end)
+
 
 class DiameterMessage:
     """
     Diameter Message object, containing header info and AVPs
     """
-    def __init__(self, request_data=None):
+    def __init__(self, request_data=None, lazy=False):
         """
         Object encompassing a Diameter Protocol message.
 
@@ -46,11 +315,26 @@ class DiameterMessage:
         - application Id
         - Hop by Hop ID and End to End info
 
-        The object also contains in a dictionary structure the AVP values,
-        using key:value pairs between the attribute-value pairs.
+        The object also contains the AVP values in an AVPList, a mapping
+        of the AVP names to their values which keeps every occurrence
+        of the repeated AVPs (see AVPList.getall).
+
+        The header can come either from stripHdr (hex encoded AVPs) or
+        from stripHdrBin (AVPs as a memoryview over the received buffer),
+        in which case the AVPs are decoded without any hex conversion.
+
+        In lazy mode only the AVP headers are read when the object is
+        created, and `avps` decodes each value on first access. Grouped
+        values are then LazyAVPGroup objects, decoding their children
+        only when iterated or indexed. This keeps the cost of routing on
+        the header or on a few AVPs close to the header parse alone.
+        The buffer must not be modified while in use.
+
+        :param request_data: HDRItem filled in by stripHdr or stripHdrBin
+        :param lazy: decode AVP values on first access instead of upfront
         """
 
-        self.avps = {}
+        self.avps = AVPList()
         if request_data:
             self.version = request_data.ver
             self.flags = request_data.flags
@@ -59,24 +343,61 @@ class DiameterMessage:
             self.application_Id = request_data.appId
             self.HopByHop = request_data.HopByHop
             self.EndToEnd = request_data.EndToEnd
-            self.hex_msg = request_data.msg
-            self.hex_avps = splitMsgAVPs(self.hex_msg)
-            # decoding AVP info and setting them up into a dictionary
-            for hex_avp in self.hex_avps:
-                field, value = decodeAVP(hex_avp)
-                self.avps[field] = value
+            if isinstance(request_data.msg, memoryview):
+                # decoding AVP info straight from the binary message
+                self.raw_msg = request_data.msg
+            else:
+                self.hex_msg = request_data.msg
+                self.raw_msg = memoryview(self.hex_msg.decode("hex"))
+            self.avps = AVPList(self.raw_msg, lazy)
+
+    def avp_values(self, name):
+        """
+        Returns every occurrence of an AVP, e.g. the Multiple-Services-
+        Credit-Control AVPs, indexing avps by name giving the last one.
+
+        :param name: name of the AVP
+        :return: list of the AVP values, in the message order
+        """
+        return self.avps.getall(name)
+
+    def path_values(self, path):
+        """
+        Returns the values of the AVPs found at a path of nested AVP
+        names, e.g. 'Multiple-Services-Credit-Control/Used-Service-Unit/
+        CC-Total-Octets', read straight from the received buffer
+        (see findAllAVPsBin): only these values are decoded.
+
+        :param path: AVP names separated by '/', or an AVPPath
+        returned by compileAVPPath
+        :return: list of the AVP values, in the message order
+        """
+        if hasattr(self, 'raw_msg'):
+            return findAllAVPsBin(path, self.raw_msg)
+        # Message built locally, walking the decoded AVPs
+        if isinstance(path, AVPPath):
+            path = path.path
+        names = path.split('/')
+        items = self.avps.allitems()
+        for name in names[:-1]:
+            items = [child for field, value in items if field == name
+                     for child in value]
+        return [value for field, value in items if field == names[-1]]
 
 
 def decode_avp_list(avp_list):
     """
-    Decodes a list of AVPs and returns a dictionary having
-    AVP names as key with the actual value for dictionary values.
+    Decodes a list of AVPs into an AVPList, mapping the
+    AVP names to their values (keeping the repeated AVPs).
+
+    Hex encoded AVPs are given as strings, while binary AVPs
+    (as returned by splitMsgAVPsBin or encodeAVPBin) are given
+    as memoryview or bytearray objects.
 
     :param avp_list: list of encoded AVPs
-    :return: dictionary of decoded AVPs
+    :return: AVPList of the decoded AVPs
     """
-    decoded_avps = dict()
-    for avp in avp_list:
-        field, value = decodeAVP(avp)
-        decoded_avps[field] = value
-    return decoded_avps
+    avps = [avp.decode("hex") if isinstance(avp, str) else avp
+            for avp in avp_list]
+    # single buffer holding the AVPs one after the other
+    return AVPList(memoryview(joinAVPsBin(avps)))
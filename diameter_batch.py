@@ -0,0 +1,201 @@
+"""
+Batch decoding of captured Diameter traffic, for offline analysis.
+
+Takes a buffer of concatenated Diameter messages (e.g. a capture dump)
+and decodes it into columns, one value per message:
+- message boundaries are found by hopping from one length field
+  to the next, without looking at the AVPs
+- the 20-byte headers are decoded in a single vectorized pass,
+  as a NumPy structured array gathered from the message offsets
+- only the AVPs of the selected columns are decoded: the other AVPs
+  are skipped from their code, without any dictionary lookup
+
+NumPy is optional: without it, the header fields are decoded
+with struct and every column is returned as a list.
+"""
+
+import struct
+from diameter_base import *
+from diameter_framing import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Header columns, in the order of the header fields
+HEADER_COLUMNS = ('version', 'length', 'flags', 'command_code',
+                  'application_id', 'hop_by_hop', 'end_to_end')
+
+# AVP columns decoded by default
+DEFAULT_AVP_COLUMNS = ('Session-Id', 'Origin-Host', 'Result-Code')
+
+if numpy is not None:
+    # Diameter header, as 5 big endian 32-bit words
+    HEADER_DTYPE = numpy.dtype([
+        ('version_length', '>u4'),
+        ('flags_command_code', '>u4'),
+        ('application_id', '>u4'),
+        ('hop_by_hop', '>u4'),
+        ('end_to_end', '>u4'),
+    ])
+
+
+def message_offsets(buffer):
+    """
+    Finds the boundaries of the messages of a buffer.
+
+    A truncated message at the end of the buffer is left out.
+
+    :param buffer: concatenated Diameter messages
+    :return: (offsets, lengths) lists of the whole messages
+    :raise DiameterFramingError: on an invalid message length,
+    after which the following boundaries can not be found
+    """
+    offsets = []
+    lengths = []
+    offset = 0
+    size = len(buffer)
+    while offset + DIAMETER_HEADER_LENGTH <= size:
+        length = struct.unpack_from("!I", buffer, offset)[0] & 0x00FFFFFF
+        if length < DIAMETER_HEADER_LENGTH:
+            raise DiameterFramingError(
+                "Invalid message length %d at offset %d" % (length, offset))
+        if offset + length > size:
+            break
+        offsets.append(offset)
+        lengths.append(length)
+        offset += length
+    return offsets, lengths
+
+
+def decode_headers(buffer, offsets):
+    """
+    Decodes the headers of the messages at the given offsets.
+
+    :param buffer: concatenated Diameter messages
+    :param offsets: offsets of the messages in the buffer
+    :return: dictionary of the header columns (HEADER_COLUMNS),
+    NumPy arrays if NumPy is available, lists otherwise
+    """
+    if numpy is not None:
+        data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+        # Gathering the 20 bytes of every header into one contiguous array
+        indexes = numpy.asarray(offsets, dtype=numpy.intp)[:, None] + \
+            numpy.arange(DIAMETER_HEADER_LENGTH)
+        headers = data[indexes].view(HEADER_DTYPE).reshape(-1)
+        version_length = headers['version_length']
+        flags_command_code = headers['flags_command_code']
+        return {
+            'version': (version_length >> 24).astype(numpy.uint8),
+            'length': (version_length & 0x00FFFFFF).astype(numpy.uint32),
+            'flags': (flags_command_code >> 24).astype(numpy.uint8),
+            'command_code':
+                (flags_command_code & 0x00FFFFFF).astype(numpy.uint32),
+            'application_id': headers['application_id'].astype(numpy.uint32),
+            'hop_by_hop': headers['hop_by_hop'].astype(numpy.uint32),
+            'end_to_end': headers['end_to_end'].astype(numpy.uint32),
+        }
+
+    columns = dict((name, []) for name in HEADER_COLUMNS)
+    unpack_header = struct.Struct("!IIIII").unpack_from
+    for offset in offsets:
+        (version_length, flags_command_code, application_id,
+         hop_by_hop, end_to_end) = unpack_header(buffer, offset)
+        columns['version'].append(version_length >> 24)
+        columns['length'].append(version_length & 0x00FFFFFF)
+        columns['flags'].append(flags_command_code >> 24)
+        columns['command_code'].append(flags_command_code & 0x00FFFFFF)
+        columns['application_id'].append(application_id)
+        columns['hop_by_hop'].append(hop_by_hop)
+        columns['end_to_end'].append(end_to_end)
+    return columns
+
+
+def avp_column_keys(avp_names):
+    """
+    :param avp_names: names of the AVP columns
+    :return: dictionary of (name, decode function) by
+    (AVP code, vendor code)
+    """
+    keys = {}
+    for name in avp_names:
+        avp = AVPItem()
+        dictAVPname2code(avp, name, '')
+        code, vendor = int(avp.code), int(avp.vendor)
+        # per-AVP decoder, e.g. decoding enum names (see setEnumDecoding)
+        keys[(code, vendor)] = (name, getAVPDecoder(code, vendor)[2])
+    return keys
+
+
+def decode_avp_columns(buffer, offsets, lengths, avp_names):
+    """
+    Decodes the values of the selected top level AVPs of every message.
+
+    :param buffer: concatenated Diameter messages
+    :param offsets: offsets of the messages in the buffer
+    :param lengths: lengths of the messages
+    :param avp_names: names of the AVPs to decode
+    :return: dictionary of a list per AVP name, holding the AVP value of
+    each message (its first occurrence), None if the message has none
+    """
+    keys = avp_column_keys(avp_names)
+    codes = set(code for code, vendor in keys)
+    columns = dict((name, [None] * len(offsets)) for name in avp_names)
+    unpack_avp_header = struct.Struct("!II").unpack_from
+    unpack_vendor = struct.Struct("!I").unpack_from
+    # Reading through struct, which also accepts mmap objects
+    message = buffer
+
+    for index in range(len(offsets)):
+        offset = offsets[index] + DIAMETER_HEADER_LENGTH
+        end = offsets[index] + lengths[index]
+        while offset + 8 <= end:
+            code, flags_length = unpack_avp_header(message, offset)
+            avp_length = flags_length & 0x00FFFFFF
+            if avp_length < 8:
+                # Malformed AVP, skipping the rest of the message
+                break
+            if code in codes:
+                start = offset + 8
+                vendor = 0
+                if flags_length & (DIAMETER_FLAG_VENDOR << 24):
+                    vendor = unpack_vendor(message, start)[0]
+                    start += 4
+                column = keys.get((code, vendor))
+                if column is not None:
+                    name, decode = column
+                    values = columns[name]
+                    if values[index] is None:
+                        values[index] = decode(
+                            message, start, offset + avp_length)
+            offset += (avp_length + 3) & ~3
+    return columns
+
+
+def decode_batch(buffer, avp_names=DEFAULT_AVP_COLUMNS):
+    """
+    Decodes a buffer of concatenated messages into columns.
+
+    The dictionary must have been loaded with LoadDictionary.
+
+    :param buffer: concatenated Diameter messages (str, bytearray or mmap)
+    :param avp_names: names of the AVP columns to decode
+    :return: dictionary of the columns: the header columns
+    (HEADER_COLUMNS), 'offset', and a column for every AVP name.
+    With NumPy these are arrays, the AVP columns being object arrays
+    (None where a message has no such AVP), otherwise lists.
+    """
+    offsets, lengths = message_offsets(buffer)
+    columns = decode_headers(buffer, offsets)
+    avp_columns = decode_avp_columns(buffer, offsets, lengths, avp_names)
+    if numpy is not None:
+        columns['offset'] = numpy.asarray(offsets, dtype=numpy.int64)
+        for name, values in avp_columns.items():
+            column = numpy.empty(len(values), dtype=object)
+            column[:] = values
+            columns[name] = column
+    else:
+        columns['offset'] = offsets
+        columns.update(avp_columns)
+    return columns
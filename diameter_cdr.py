@@ -0,0 +1,383 @@
+"""
+Charging Data Records (CDR) output, for the completed accounting sessions.
+
+The request handlers only queue the records: a writer thread takes them
+from a bounded queue in batches and appends each batch to the current
+CDR file with a single write, so a slow disk never stalls the handlers.
+When the queue is full the record is refused, and the caller gets a
+backpressure signal instead of waiting.
+
+Contains:
+- CDR record structure
+- text (JSON lines) and binary (length-prefixed) record formats
+- rotating, append-only, batched CDR file writer
+- reader for the written CDR files
+"""
+
+import collections
+import json
+import logging
+import os
+import Queue
+import struct
+import threading
+import time
+
+CDRecord = collections.namedtuple(
+    'CDRecord',
+    'record_type session_id origin_host started closed '
+    'record_number interim_records')
+
+# Binary record layout: fixed size fields, followed by the session id
+# and origin host (UTF-8, each prefixed by its 2-byte length).
+# Each record is prefixed by its 4-byte length.
+_BINARY_FIXED = struct.Struct("!BddII")
+_BINARY_LENGTH = struct.Struct("!I")
+_BINARY_STRING = struct.Struct("!H")
+
+# fsync policies of the CDR files
+FSYNC_NEVER = 'never'        # left to the operating system
+FSYNC_ROTATE = 'rotate'      # when closing a file
+FSYNC_INTERVAL = 'interval'  # at most once every fsync_interval seconds
+FSYNC_BATCH = 'batch'        # after every written batch
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_ROTATE, FSYNC_INTERVAL, FSYNC_BATCH)
+
+
+def _text(value):
+    if value is None:
+        return u''
+    if isinstance(value, str):
+        # OctetString / DiameterIdentity values are not always UTF-8
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def encode_text_record(record):
+    """
+    :param record: CDRecord
+    :return: the record as a JSON line
+    """
+    fields = record._asdict()
+    fields['session_id'] = _text(record.session_id)
+    fields['origin_host'] = _text(record.origin_host)
+    return json.dumps(fields, sort_keys=True) + '\n'
+
+
+def encode_binary_record(record):
+    """
+    :param record: CDRecord
+    :return: the record in the length-prefixed binary format
+    """
+    session_id = _text(record.session_id).encode('utf-8')
+    origin_host = _text(record.origin_host).encode('utf-8')
+    data = (_BINARY_FIXED.pack(record.record_type, record.started,
+                               record.closed, record.record_number,
+                               record.interim_records) +
+            _BINARY_STRING.pack(len(session_id)) + session_id +
+            _BINARY_STRING.pack(len(origin_host)) + origin_host)
+    return _BINARY_LENGTH.pack(len(data)) + data
+
+
+def decode_binary_record(data):
+    """
+    :param data: binary record, without its length prefix
+    :return: CDRecord
+    """
+    fixed = _BINARY_FIXED.unpack_from(data, 0)
+    offset = _BINARY_FIXED.size
+    strings = []
+    for _ in range(2):
+        length = _BINARY_STRING.unpack_from(data, offset)[0]
+        offset += _BINARY_STRING.size
+        strings.append(data[offset:offset + length].decode('utf-8'))
+        offset += length
+    return CDRecord(fixed[0], strings[0], strings[1], fixed[1], fixed[2],
+                    fixed[3], fixed[4])
+
+
+def read_cdr_file(path):
+    """
+    Reads the records of a CDR file, in either format
+    (binary files have the .bin extension).
+
+    :param path: path of the CDR file
+    :return: generator of CDRecord
+    """
+    with open(path, 'rb') as cdr_file:
+        if not path.endswith('.bin'):
+            for line in cdr_file:
+                fields = json.loads(line)
+                yield CDRecord(**dict((str(name), value)
+                                      for name, value in fields.items()))
+            return
+        data = cdr_file.read()
+    offset = 0
+    while offset + _BINARY_LENGTH.size <= len(data):
+        length = _BINARY_LENGTH.unpack_from(data, offset)[0]
+        offset += _BINARY_LENGTH.size
+        if offset + length > len(data):
+            # Partially written last record
+            break
+        yield decode_binary_record(data[offset:offset + length])
+        offset += length
+
+
+class CDRWriter:
+    """
+    Asynchronous writer of the CDRs into rotating, append-only files.
+
+    The files are named <prefix>-<pid>-<timestamp>-<sequence>.cdr
+    (.bin for the binary format), so several worker processes can write
+    into the same directory. A file is rotated once it grows over
+    max_file_size. The writer thread is started on the first submitted
+    record, and started again in a forked worker process.
+    """
+
+    def __init__(self,
+                 directory='cdr',
+                 prefix='cdr',
+                 binary=False,
+                 max_file_size=64 * 1024 * 1024,
+                 max_queue=100000,
+                 batch_size=1024,
+                 flush_interval=1.0,
+                 fsync=FSYNC_INTERVAL,
+                 fsync_interval=1.0):
+        """
+        :param directory: directory the CDR files are written in
+        :param prefix: prefix of the CDR file names
+        :param binary: use the length-prefixed binary format
+        instead of JSON lines
+        :param max_file_size: size (bytes) above which files are rotated
+        :param max_queue: maximum number of records waiting to be written
+        :param batch_size: maximum number of records written at once
+        :param flush_interval: seconds the writer waits for a batch
+        to fill up before writing it
+        :param fsync: fsync policy, one of FSYNC_POLICIES
+        :param fsync_interval: seconds between fsync calls,
+        for the FSYNC_INTERVAL policy
+        """
+
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy %r" % (fsync,))
+        self.directory = directory
+        self.prefix = prefix
+        self.binary = binary
+        self.encode = encode_text_record
+        self.extension = '.cdr'
+        if binary:
+            self.encode = encode_binary_record
+            self.extension = '.bin'
+        self.max_file_size = max_file_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.queue = Queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.running = False
+        self.cdr_file = None
+        self.file_name = None
+        self.file_size = 0
+        self.sequence = 0
+        self.last_fsync = 0.0
+        # Records written since the last fsync of the current file
+        self.dirty = False
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+
+    def submit(self, record):
+        """
+        Queues a record for writing, without blocking.
+
+        :param record: CDRecord
+        :return: False if the queue is full and the record was refused
+        (backpressure), True otherwise
+        """
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def congested(self):
+        """
+        :return: True while the queue is full, new records being refused
+        """
+        return self.queue.full()
+
+    def start(self):
+        """
+        Starts the writer thread of the current process.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # Forked: the parent's thread and open file are not ours
+                self.queue = Queue.Queue(self.queue.maxsize)
+                self.cdr_file = None
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.pid = os.getpid()
+            self.running = True
+            self.thread = threading.Thread(target=self.run,
+                                           name='cdr-writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """
+        Writes the queued records, closes the current file
+        and stops the writer thread.
+        """
+        thread = self.thread
+        if thread is None or self.pid != os.getpid():
+            return
+        self.running = False
+        try:
+            # Wakes up the writer thread waiting for records
+            self.queue.put_nowait(None)
+        except Queue.Full:
+            pass
+        thread.join()
+        self.thread = None
+        self.pid = None
+
+    def run(self):
+        """
+        Writer thread: writes the queued records in batches.
+
+        A batch that cannot be written (disk full, I/O error) is counted
+        as failed and the writer goes on with the next one, in a new file.
+        """
+        while self.running or not self.queue.empty():
+            batch = self.next_batch()
+            try:
+                if batch:
+                    self.write_batch(batch)
+                elif self.fsync == FSYNC_INTERVAL:
+                    self.sync()
+            except Exception:
+                logging.exception("Failed writing %d CDRs to %s",
+                                  len(batch), self.file_name)
+                self.failed += len(batch)
+                self.abandon_file()
+        try:
+            self.close_file()
+        except Exception:
+            logging.exception("Failed closing %s", self.file_name)
+            self.abandon_file()
+
+    def next_batch(self):
+        """
+        :return: list of up to batch_size queued records,
+        empty if none was queued during the flush interval
+        """
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except Queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        # Skipping the wake up markers of stop()
+        return [record for record in batch if record is not None]
+
+    def write_batch(self, batch):
+        """
+        Appends a batch of records to the current file, with one write.
+
+        :param batch: list of CDRecord
+        """
+        data = ''.join([self.encode(record) for record in batch])
+        if self.cdr_file is None or (
+                self.file_size and
+                self.file_size + len(data) > self.max_file_size):
+            self.rotate()
+        self.cdr_file.write(data)
+        self.cdr_file.flush()
+        self.file_size += len(data)
+        self.written += len(batch)
+        self.batches += 1
+        self.dirty = True
+        if self.fsync == FSYNC_BATCH:
+            os.fsync(self.cdr_file.fileno())
+            self.dirty = False
+        elif self.fsync == FSYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        """
+        fsyncs the current file, if records were written to it and
+        fsync_interval elapsed since the last fsync.
+        """
+        if self.cdr_file is None or not self.dirty:
+            return
+        now = time.time()
+        if now - self.last_fsync >= self.fsync_interval:
+            os.fsync(self.cdr_file.fileno())
+            self.last_fsync = now
+            self.dirty = False
+
+    def rotate(self):
+        """
+        Closes the current file and opens the next one.
+        """
+        self.close_file()
+        self.sequence += 1
+        self.file_name = os.path.join(self.directory, '%s-%d-%s-%04d%s' % (
+            self.prefix, os.getpid(), time.strftime('%Y%m%d%H%M%S'),
+            self.sequence, self.extension))
+        self.cdr_file = open(self.file_name, 'ab')
+        self.file_size = 0
+        logging.info("Writing CDRs to %s", self.file_name)
+
+    def close_file(self):
+        """
+        Closes the current file, syncing it unless the policy is never.
+        """
+        if self.cdr_file is None:
+            return
+        self.cdr_file.flush()
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(self.cdr_file.fileno())
+        self.cdr_file.close()
+        self.cdr_file = None
+        self.dirty = False
+
+    def abandon_file(self):
+        """
+        Drops the current file after a failed write, as it may end with
+        a partial record: the next batch is written to a new file.
+        """
+        cdr_file, self.cdr_file = self.cdr_file, None
+        self.dirty = False
+        if cdr_file is None:
+            return
+        try:
+            cdr_file.close()
+        except (IOError, OSError):
+            pass
+
+    def stats(self):
+        """
+        :return: dictionary with the writer counters
+        """
+        return {
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'batches': self.batches,
+            'file': self.file_name,
+        }
@@ -2,12 +2,110 @@
 Module implementing a Diameter client able to send requests
 and decode and interpret the response based on the received information.
 
+Requests are pipelined over the client connection: each one gets its
+own Hop-by-Hop identifier, and a reader thread matches the received
+answers to the pending requests based on it, so many requests
+can be outstanding on the same connection.
+
 Using the libDiameter library, as well as the dictDiameter .xml dictionary
 """
 
+import heapq
+import itertools
+import random
+import select
+import threading
+from diameter_framing import *
 from diameter_responses import *
 
 
+class DiameterTimeout(Exception):
+    """
+    Raised when no answer was received for a request in time.
+    """
+
+
+class DiameterConnectionClosed(Exception):
+    """
+    Raised for the requests pending when the connection is closed.
+    """
+
+
+class PendingRequest:
+    """
+    Request sent by the client and waiting for its answer.
+
+    Completed by the client's reader thread when the answer with the same
+    Hop-by-Hop identifier is received, or when the request times out.
+    """
+
+    def __init__(self, hop_by_hop, end_to_end, timeout, callback=None):
+        """
+        :param hop_by_hop: Hop-by-Hop identifier of the request
+        :param end_to_end: End-to-End identifier of the request
+        :param timeout: seconds to wait for the answer
+        :param callback: function called with this object once completed
+        """
+
+        self.hop_by_hop = hop_by_hop
+        self.end_to_end = end_to_end
+        self.sent_at = time.time()
+        self.deadline = self.sent_at + timeout
+        self.completed_at = None
+        self.callback = callback
+        self.answer = None
+        self.error = None
+        self.event = threading.Event()
+
+    def done(self):
+        """
+        :return: True once the answer was received, or the request failed
+        """
+        return self.event.is_set()
+
+    def latency(self):
+        """
+        :return: seconds between sending the request and completing it
+        """
+        if self.completed_at is None:
+            return None
+        return self.completed_at - self.sent_at
+
+    def complete(self, answer=None, error=None):
+        """
+        Sets the outcome of the request and runs its callback.
+
+        :param answer: DiameterMessage received as answer
+        :param error: exception, when the request failed
+        """
+
+        self.completed_at = time.time()
+        self.answer = answer
+        self.error = error
+        self.event.set()
+        if self.callback is not None:
+            try:
+                self.callback(self)
+            except Exception:
+                logging.exception("Request callback failed")
+
+    def result(self, timeout=None):
+        """
+        Waits for the answer of the request.
+
+        :param timeout: seconds to wait (None waits until the request
+        completes, which it does at the latest when it times out)
+        :return: the answer, as a DiameterMessage
+        """
+
+        if not self.event.wait(timeout):
+            raise DiameterTimeout(
+                "No answer for Hop-by-Hop %d" % self.hop_by_hop)
+        if self.error is not None:
+            raise self.error
+        return self.answer
+
+
 class DiameterClient:
     """
     Object used to generate the Diameter Client.
@@ -19,7 +117,8 @@ class DiameterClient:
                  origin_host='client.asn.test',
                  origin_realm='asn.test',
                  destination_host='server.asn.test',
-                 destination_realm='asn.test'):
+                 destination_realm='asn.test',
+                 request_timeout=10.0):
         """
         The client establishes a socket connection to server's host address
         at the specified port, and sends the desired Diameter Requests
@@ -29,6 +128,7 @@ class DiameterClient:
         :param port: port for socket connection
         :param origin_host: Diameter Origin Host
         :param origin_realm: Diameter Origin Realm
+        :param request_timeout: default seconds to wait for an answer
         """
 
         self.host = host
@@ -37,7 +137,33 @@ class DiameterClient:
         self.origin_realm = origin_realm
         self.destination_host = destination_host
         self.destination_realm = destination_realm
+        self.request_timeout = request_timeout
         self.connection = None
+        self.reader = None
+
+        # Pending requests by Hop-by-Hop, and their deadlines
+        self.pending = {}
+        self.deadlines = []
+        self.pending_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+
+        # Hop-by-Hop starts at a random value, End-to-End has its high
+        # 12 bits set from the current time and the low 20 bits random
+        self.hop_by_hop = itertools.count(random.randint(0, 0xFFFFFFFF))
+        self.end_to_end = itertools.count(
+            ((int(time.time()) & 0xFFF) << 20) | random.randint(0, 0xFFFFF))
+
+    def next_hop_by_hop(self):
+        """
+        :return: a new Hop-by-Hop identifier
+        """
+        return next(self.hop_by_hop) & 0xFFFFFFFF
+
+    def next_end_to_end(self):
+        """
+        :return: a new End-to-End identifier
+        """
+        return next(self.end_to_end) & 0xFFFFFFFF
 
     def generate_generic_request(self, command_code):
         """
@@ -51,6 +177,8 @@ class DiameterClient:
         # Creating the Diameter Message object to base the request on
         diameter_request = diameter_base.DiameterMessage()
         diameter_request.command_code = command_code
+        diameter_request.HopByHop = self.next_hop_by_hop()
+        diameter_request.EndToEnd = self.next_end_to_end()
         diameter_request.avps['Origin-Host'] = self.origin_host
         diameter_request.avps['Origin-Realm'] = self.origin_realm
         diameter_request.avps['Destination-Host'] = self.destination_host
@@ -77,35 +205,219 @@ class DiameterClient:
         """
 
         # Create the Diameter message by joining the header and the AVPs
-        request_message = createReq(header, avps)
+        request_message = createReqBin(header, avps)
 
         # send the cer message using the socket connection
-        connection.send(request_message.decode('hex'))
-        # receiving the response for the request
-        response_data = connection.recv(4096)
+        connection.sendall(request_message)
+        # receiving the response for the request, until complete
+        framer = DiameterFramer()
+        response_data = None
+        while response_data is None:
+            if framer.recv_from(connection) == 0:
+                raise DiameterConnectionClosed("Connection closed by peer")
+            for response_data in framer.messages():
+                break
 
         # Creating a CEA header to be removed during message decapsulation
         response = HDRItem()
-        stripHdr(response, response_data.encode("hex"))
+        stripHdrBin(response, response_data)
         # Generating the received AVPs from the CEA message
-        response_avps = splitMsgAVPs(response.msg)
+        response_avps = splitMsgAVPsBin(response.msg)
         # returning the decoded AVPs
         return diameter_base.decode_avp_list(response_avps)
 
+    def send_request(self, header, avps, callback=None, timeout=None):
+        """
+        Sends a Diameter Request without waiting for its answer.
+
+        The request gets a new Hop-by-Hop identifier (and an End-to-End
+        identifier, if the header has none), used to match its answer.
+
+        :param header: Diameter message header
+        :param avps: Diameter message's AVPs, binary encoded
+        :param callback: function called with the PendingRequest
+        once the answer is received or the request times out.
+        It runs in the reader thread, so it should not block.
+        :param timeout: seconds to wait for the answer
+        :return: PendingRequest, completed when the answer is received
+        """
+
+        with self.pending_lock:
+            if self.reader is None:
+                self.start_reader()
+        if timeout is None:
+            timeout = self.request_timeout
+        header.HopByHop = self.next_hop_by_hop()
+        if not header.EndToEnd:
+            header.EndToEnd = self.next_end_to_end()
+        request_message = createReqBin(header, avps)
+
+        pending = PendingRequest(
+            header.HopByHop, header.EndToEnd, timeout, callback)
+        with self.pending_lock:
+            self.pending[pending.hop_by_hop] = pending
+            heapq.heappush(self.deadlines,
+                           (pending.deadline, pending.hop_by_hop))
+        try:
+            with self.send_lock:
+                self.connection.sendall(request_message)
+        except socket.error as error:
+            with self.pending_lock:
+                self.pending.pop(pending.hop_by_hop, None)
+                self.drop_finished_deadlines()
+            pending.complete(error=error)
+        return pending
+
+    def exchange(self, header, avps, connection=None):
+        """
+        Sends a Diameter Request and waits for its answer.
+
+        Requests on the client's own connection are pipelined with
+        the other outstanding requests, while requests on another
+        connection are sent and answered one at a time.
+
+        :param header: Diameter message header
+        :param avps: Diameter message's AVPs, binary encoded
+        :param connection: socket connection, the client's one by default
+        :return: dictionary containing the response AVPs
+        """
+
+        if connection is None or connection is self.connection:
+            return self.send_request(header, avps).result().avps
+        return self.send_diameter_request(header, avps, connection)
+
+    def outstanding(self):
+        """
+        :return: number of requests waiting for their answer
+        """
+        return len(self.pending)
+
+    def start_reader(self):
+        """
+        Starts the thread reading the answers from the client connection.
+        """
+
+        self.reader = threading.Thread(
+            target=self.read_answers, args=(self.connection,))
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_answers(self, connection):
+        """
+        Reader loop, completing the pending requests with their answers
+        and expiring the ones not answered in time.
+
+        :param connection: socket connection the answers are read from
+        """
+
+        framer = DiameterFramer()
+        error = DiameterConnectionClosed("Connection closed")
+        try:
+            while True:
+                wait = self.expire_requests()
+                if not select.select([connection], [], [], wait)[0]:
+                    continue
+                if framer.recv_from(connection) == 0:
+                    break
+                for message in framer.messages():
+                    self.complete_request(message)
+        except (socket.error, select.error, DiameterFramingError) as failure:
+            logging.error("Reading answers failed: %s", failure)
+            error = DiameterConnectionClosed(str(failure))
+        finally:
+            with self.pending_lock:
+                pending = self.pending.values()
+                self.pending = {}
+                self.deadlines = []
+                self.reader = None
+            for request in pending:
+                request.complete(error=error)
+
+    def complete_request(self, message):
+        """
+        Completes the pending request a received answer belongs to.
+
+        :param message: received Diameter message
+        """
+
+        # The message is a view over the framer buffer, overwritten by
+        # the next read, while the answer is kept by the caller
+        answer = HDRItem()
+        stripHdrBin(answer, memoryview(message).tobytes())
+        if answer.flags & DIAMETER_HDR_REQUEST:
+            logging.warning("Ignoring request %d received from peer",
+                            answer.cmd)
+            return
+        with self.pending_lock:
+            pending = self.pending.pop(answer.HopByHop, None)
+            self.drop_finished_deadlines()
+        if pending is None:
+            logging.warning("Answer for unknown Hop-by-Hop %d",
+                            answer.HopByHop)
+            return
+        pending.complete(diameter_base.DiameterMessage(answer))
+
+    def drop_finished_deadlines(self):
+        """
+        Removes the deadlines of the requests no longer pending, so the
+        answered requests are not kept until their timeout: the finished
+        ones on top of the heap are popped, and the heap is compacted
+        once the finished entries outnumber the pending ones.
+
+        Must be called holding pending_lock.
+        """
+
+        deadlines = self.deadlines
+        while deadlines and not self.is_pending(*deadlines[0]):
+            heapq.heappop(deadlines)
+        if len(deadlines) > 2 * len(self.pending):
+            self.deadlines = [entry for entry in deadlines
+                              if self.is_pending(*entry)]
+            heapq.heapify(self.deadlines)
+
+    def is_pending(self, deadline, hop_by_hop):
+        """
+        :param deadline: deadline of a request
+        :param hop_by_hop: Hop-by-Hop identifier of the request
+        :return: True while the request is waiting for its answer
+        """
+
+        pending = self.pending.get(hop_by_hop)
+        return pending is not None and pending.deadline == deadline
+
+    def expire_requests(self):
+        """
+        Fails the pending requests whose deadline passed.
+
+        :return: seconds until the next deadline (at most one second)
+        """
+
+        now = time.time()
+        expired = []
+        with self.pending_lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, hop_by_hop = heapq.heappop(self.deadlines)
+                if self.is_pending(deadline, hop_by_hop):
+                    expired.append(self.pending.pop(hop_by_hop))
+            wait = 1.0
+            if self.deadlines:
+                wait = min(wait, self.deadlines[0][0] - now)
+        for pending in expired:
+            pending.complete(error=DiameterTimeout(
+                "No answer for Hop-by-Hop %d" % pending.hop_by_hop))
+        return max(wait, 0.0)
+
     def send_cer(self, connection=None):
         """
         Method used to send the Capability Exchange Request message
-        Encodes in Hex each AVP, appends them to the Diameter header,
+        Encodes each AVP, appends them to the Diameter header,
         build a Diameter message based on those values,
         and sends them to the already established socket connection.
 
-        :param connection: socket connection
+        :param connection: socket connection, the client's one by default
         :return: dictionary of received AVPs
         """
 
-        if not connection:
-            connection = self.connection
-
         # Generating a standard Diameter request
         generic_request = self.generate_generic_request(
             diameter_base.cmd_codes['Capability-Exchange'])
@@ -114,37 +426,34 @@ class DiameterClient:
         cer_avps = generic_request['avps']
 
         # Appending the CER specific AVPs
-        cer_avps.append(encodeAVP(
+        cer_avps.append(encodeAVPBin(
             'Vendor-Id',
             diameter_base.standard_avp_values['Vendor-Id']))
-        cer_avps.append(encodeAVP(
+        cer_avps.append(encodeAVPBin(
             'Product-Name', diameter_base.standard_avp_values['Product-Name']))
-        cer_avps.append(encodeAVP('Origin-State-Id', 1))
-        cer_avps.append(encodeAVP(
+        cer_avps.append(encodeAVPBin('Origin-State-Id', 1))
+        cer_avps.append(encodeAVPBin(
             'Supported-Vendor-Id',
             diameter_base.standard_avp_values['Supported-Vendor-Id']))
-        cer_avps.append(encodeAVP(
+        cer_avps.append(encodeAVPBin(
             'Acct-Application-Id',
             diameter_base.standard_avp_values['Acct-Application-Id']))
 
         # returning a dictionary of the received AVPs
-        avps_dict = self.send_diameter_request(cer_header, cer_avps, connection)
+        avps_dict = self.exchange(cer_header, cer_avps, connection)
         return avps_dict
 
     def send_invalid_message(self, connection=None):
         """
         Method used to send an invalid Diameter Request message
-        Encodes in Hex each AVP, appends them to the Diameter header,
+        Encodes each AVP, appends them to the Diameter header,
         build a Diameter message based on those values,
         and sends them to the already established socket connection.
 
-        :param connection: socket connection
+        :param connection: socket connection, the client's one by default
         :return: dictionary of received AVPs
         """
 
-        if not connection:
-            connection = self.connection
-
         # Generating a standard Diameter request
         generic_request = self.generate_generic_request(
             diameter_base.cmd_codes['Re-Auth'])
@@ -153,27 +462,24 @@ class DiameterClient:
         invalid_message_avps = generic_request['avps']
 
         # Appending to the generic request an additional AVP
-        invalid_message_avps.append(encodeAVP('Vendor-Id', 11))
+        invalid_message_avps.append(encodeAVPBin('Vendor-Id', 11))
 
         # returning a dictionary of the received AVPs
-        avps_dict = self.send_diameter_request(
+        avps_dict = self.exchange(
             invalid_message_header, invalid_message_avps, connection)
         return avps_dict
 
     def send_dwr(self, connection=None):
         """
         Method used to send an invalid Diameter Request message
-        Encodes in Hex each AVP, appends them to the Diameter header,
+        Encodes each AVP, appends them to the Diameter header,
         build a Diameter message based on those values,
         and sends them to the already established socket connection.
 
-        :param connection: socket connection
+        :param connection: socket connection, the client's one by default
         :return: list of received AVPs
         """
 
-        if not connection:
-            connection = self.connection
-
         # Generating a standard Diameter request
         generic_request = self.generate_generic_request(
             diameter_base.cmd_codes['Device-Watchdog'])
@@ -182,10 +488,10 @@ class DiameterClient:
         dwr_avps = generic_request['avps']
 
         # Appending to the generic message the DWR specific AVPs
-        dwr_avps.append(encodeAVP('Origin-State-Id', 1))
+        dwr_avps.append(encodeAVPBin('Origin-State-Id', 1))
 
         # returning a dictionary of the received AVPs
-        avps_dict = self.send_diameter_request(dwr_header, dwr_avps, connection)
+        avps_dict = self.exchange(dwr_header, dwr_avps, connection)
         return avps_dict
 
     def start(self):
@@ -194,10 +500,31 @@ class DiameterClient:
 
         Establishes a socket connection to the server,
         to be used by the client in order to able to send Diameter Requests,
-        and loads the standard Diameter Dictionary.
+        loads the standard Diameter Dictionary
+        and starts reading the answers from the connection.
         """
 
         # Establishing the socket connection to the server
         self.connection = Connect(self.host, self.port)
         # Loading the Diameter dictionary for messages, codes and AVPs
         LoadDictionary("dictDiameter.xml")
+        self.start_reader()
+
+    def close(self):
+        """
+        Closes the connection to the server,
+        failing the requests still waiting for an answer.
+        """
+
+        if self.connection is None:
+            return
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        # The reader stops on the shutdown, failing the pending requests
+        reader = self.reader
+        if reader is not None:
+            reader.join()
+        self.connection.close()
+        self.connection = None
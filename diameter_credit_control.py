@@ -0,0 +1,491 @@
+"""
+Online charging state, for the Credit-Control (CCR/CCA) answers (Gy/Ro).
+
+Contains:
+- credit control request types and requested actions
+- service unit types and their parsing
+- subscriber accounts, holding a balance per unit type
+- credit control sessions, holding a reservation per rating group
+- sharded store of the accounts and sessions
+
+Accounts are spread over shards by subscriber, each shard having its
+own lock, and a session lives in the shard of its subscriber: reserving
+or debiting units takes a single lock, held for a few dictionary updates,
+and requests for different subscribers rarely wait for each other.
+"""
+
+import threading
+import time
+from diameter_accounting import *
+
+# Values of the CC-Request-Type AVP
+INITIAL_REQUEST = 1
+UPDATE_REQUEST = 2
+TERMINATION_REQUEST = 3
+EVENT_REQUEST = 4
+
+credit_control_request_types = {
+    INITIAL_REQUEST: 'INITIAL_REQUEST',
+    UPDATE_REQUEST: 'UPDATE_REQUEST',
+    TERMINATION_REQUEST: 'TERMINATION_REQUEST',
+    EVENT_REQUEST: 'EVENT_REQUEST',
+}
+
+# Values of the Requested-Action AVP, for EVENT requests
+DIRECT_DEBITING = 0
+REFUND_ACCOUNT = 1
+CHECK_BALANCE = 2
+PRICE_ENQUIRY = 3
+
+# Unit types of the Requested, Granted and Used-Service-Unit AVPs
+TOTAL_OCTETS = 'CC-Total-Octets'
+TIME = 'CC-Time'
+SERVICE_SPECIFIC_UNITS = 'CC-Service-Specific-Units'
+UNIT_TYPES = (TOTAL_OCTETS, TIME, SERVICE_SPECIFIC_UNITS)
+
+# Balances of the accounts created on the first use of a subscriber
+DEFAULT_BALANCES = {
+    TOTAL_OCTETS: 10 * 1024 * 1024 * 1024,
+    TIME: 36000,
+    SERVICE_SPECIFIC_UNITS: 100000,
+}
+
+# Units granted when a request does not say how many it needs
+DEFAULT_QUOTAS = {
+    TOTAL_OCTETS: 10 * 1024 * 1024,
+    TIME: 600,
+    SERVICE_SPECIFIC_UNITS: 10,
+}
+
+
+def service_units(avps):
+    """
+    Reads the amount of a Requested or Used-Service-Unit AVP.
+    Input and output octets add up as total octets, when no total
+    is given.
+
+    :param avps: decoded Grouped value, as (name, value) tuples
+    :return: (unit type, amount), (None, 0) without any known unit
+    """
+    units = dict(avps)
+    for unit in UNIT_TYPES:
+        if unit in units:
+            return unit, units[unit]
+    if 'CC-Input-Octets' in units or 'CC-Output-Octets' in units:
+        return TOTAL_OCTETS, (units.get('CC-Input-Octets', 0)
+                              + units.get('CC-Output-Octets', 0))
+    return None, 0
+
+
+class CreditControlError(Exception):
+    """
+    Raised when a credit control operation is refused.
+
+    The result_code attribute is the name of the Result-Code
+    the request is answered with.
+    """
+
+    def __init__(self, result_code, message=None):
+        Exception.__init__(self, message or result_code)
+        self.result_code = result_code
+
+
+class CreditAccount(object):
+    """
+    Balances of a subscriber, by unit type.
+
+    The balances are the units still available, the units reserved
+    by the open sessions being counted apart until they are used.
+    """
+
+    __slots__ = ('subscriber', 'balances', 'reserved')
+
+    def __init__(self, subscriber, balances):
+        """
+        :param subscriber: Subscription-Id-Data of the subscriber
+        :param balances: available units, by unit type
+        """
+        self.subscriber = subscriber
+        self.balances = dict(balances)
+        self.reserved = dict.fromkeys(self.balances, 0)
+
+    def reserve(self, unit, amount):
+        self.balances[unit] = self.balances.get(unit, 0) - amount
+        self.reserved[unit] = self.reserved.get(unit, 0) + amount
+
+    def release(self, unit, amount):
+        self.reserved[unit] -= amount
+        self.balances[unit] += amount
+
+    def debit(self, unit, amount):
+        # Units used beyond the reservation can not be charged anymore
+        self.balances[unit] = max(self.balances.get(unit, 0) - amount, 0)
+
+    def __repr__(self):
+        return '<CreditAccount %s %s>' % (self.subscriber, self.balances)
+
+
+class CreditSession(object):
+    """
+    State kept for an open credit control session.
+
+    Uses __slots__ instead of a per instance dictionary,
+    keeping the memory used by many open sessions low.
+    """
+
+    __slots__ = ('session_id', 'account', 'reservations', 'updated',
+                 'expires', 'bucket')
+
+    def __init__(self, session_id, account, now):
+        """
+        :param session_id: Session-Id of the credit control session
+        :param account: CreditAccount charged by the session
+        :param now: time the session was opened
+        """
+        self.session_id = session_id
+        self.account = account
+        # Reserved (unit type, amount), by rating group
+        self.reservations = {}
+        self.updated = now
+        self.expires = now
+        # Timer wheel bucket holding the session, None if not scheduled
+        self.bucket = None
+
+    def __repr__(self):
+        return '<CreditSession %s for %s, %d reservations>' % (
+            self.session_id, self.account.subscriber,
+            len(self.reservations))
+
+
+class CreditShard:
+    """
+    Accounts and sessions of a part of the subscribers, behind one lock.
+    """
+
+    def __init__(self, resolution):
+        self.lock = threading.Lock()
+        self.accounts = {}
+        self.sessions = {}
+        self.timers = TimerWheel(resolution=resolution)
+        self.opened = 0
+        self.closed = 0
+        self.expired = 0
+        self.rejected = 0
+
+
+class CreditControlStore:
+    """
+    Sharded store of the subscriber accounts and credit control sessions.
+
+    INITIAL requests open a session, UPDATE requests debit the units used
+    from each rating group's reservation and reserve new units, and
+    TERMINATION requests debit the last units used, release what is left
+    of the reservations and close the session.
+    A session not updated within its validity time (times the grace
+    factor) is expired, its reservations going back to the balances.
+    """
+
+    def __init__(self, shards=64, default_balances=DEFAULT_BALANCES,
+                 default_quotas=DEFAULT_QUOTAS, validity_time=1800,
+                 validity_grace=2, max_sessions=1000000, resolution=1.0):
+        """
+        :param shards: number of shards, each with its own lock
+        :param default_balances: balances of the accounts created on the
+        first use of a subscriber, None to refuse unknown subscribers
+        :param default_quotas: units granted, by unit type, when
+        a request does not say how many units it needs
+        :param validity_time: seconds the granted units are valid for
+        :param validity_grace: number of validity times after which
+        a session without updates is expired
+        :param max_sessions: maximum number of open sessions
+        :param resolution: expiry timer resolution, in seconds
+        """
+        self.shards = [CreditShard(resolution) for _ in range(shards)]
+        self.default_balances = default_balances
+        self.default_quotas = default_quotas
+        self.validity_time = validity_time
+        self.validity_grace = validity_grace
+        self.max_shard_sessions = max(max_sessions // shards, 1)
+        # Shard of each open session; single dictionary operations
+        # being atomic, it is shared by the shards without a lock
+        self.session_shards = {}
+
+    def _shard(self, subscriber):
+        return self.shards[hash(subscriber) % len(self.shards)]
+
+    def _account(self, shard, subscriber):
+        account = shard.accounts.get(subscriber)
+        if account is None:
+            if self.default_balances is None:
+                raise CreditControlError('DIAMETER_USER_UNKNOWN',
+                                         'Unknown subscriber %s' % subscriber)
+            account = CreditAccount(subscriber, self.default_balances)
+            shard.accounts[subscriber] = account
+        return account
+
+    def _session(self, session_id):
+        shard = self.session_shards.get(session_id)
+        if shard is None:
+            raise CreditControlError('DIAMETER_UNKNOWN_SESSION_ID',
+                                     'Unknown session %s' % session_id)
+        return shard
+
+    def _close(self, shard, session):
+        account = session.account
+        for unit, amount in session.reservations.values():
+            account.release(unit, amount)
+        session.reservations.clear()
+        shard.timers.cancel(session)
+        del shard.sessions[session.session_id]
+        self.session_shards.pop(session.session_id, None)
+
+    def _expire(self, shard, now):
+        expired = shard.timers.advance(now)
+        for session in expired:
+            self._close(shard, session)
+        shard.expired += len(expired)
+        return expired
+
+    def _grant(self, session, rating_group, unit, requested):
+        account = session.account
+        if not requested:
+            requested = self.default_quotas.get(unit, 0)
+        available = account.balances.get(unit, 0)
+        granted = min(requested, max(available, 0))
+        if granted:
+            account.reserve(unit, granted)
+            session.reservations[rating_group] = (unit, granted)
+        # The last units of the balance were granted
+        return granted, granted < requested or granted == available
+
+    def provision(self, subscriber, balances):
+        """
+        Creates a subscriber account, or sets some of its balances.
+
+        :param subscriber: Subscription-Id-Data of the subscriber
+        :param balances: available units, by unit type
+        :return: the CreditAccount
+        """
+        shard = self._shard(subscriber)
+        with shard.lock:
+            account = shard.accounts.get(subscriber)
+            if account is None:
+                account = CreditAccount(subscriber, balances)
+                shard.accounts[subscriber] = account
+            else:
+                account.balances.update(balances)
+            return account
+
+    def balance(self, subscriber):
+        """
+        :param subscriber: Subscription-Id-Data of the subscriber
+        :return: available units by unit type, None if unknown
+        """
+        shard = self._shard(subscriber)
+        with shard.lock:
+            account = shard.accounts.get(subscriber)
+            if account is None:
+                return None
+            return dict(account.balances)
+
+    def open(self, session_id, subscriber, now=None):
+        """
+        Opens a session, or refreshes it if already open
+        (e.g. on a retransmitted INITIAL request).
+
+        :param session_id: Session-Id of the session
+        :param subscriber: Subscription-Id-Data of the subscriber
+        :param now: current time, time.time() by default
+        :return: the CreditSession
+        :raise CreditControlError: unknown subscriber, or store full
+        """
+        if now is None:
+            now = time.time()
+        shard = self._shard(subscriber)
+        with shard.lock:
+            self._expire(shard, now)
+            session = shard.sessions.get(session_id)
+            if session is None:
+                if len(shard.sessions) >= self.max_shard_sessions:
+                    shard.rejected += 1
+                    raise CreditControlError('DIAMETER_OUT_OF_SPACE',
+                                             'Too many open sessions')
+                session = CreditSession(
+                    session_id, self._account(shard, subscriber), now)
+                shard.sessions[session_id] = session
+                self.session_shards[session_id] = shard
+                shard.opened += 1
+            session.updated = now
+            shard.timers.schedule(
+                session, now + self.validity_time * self.validity_grace)
+            return session
+
+    def charge(self, session_id, services, now=None):
+        """
+        Debits the units used by each service from its reservation,
+        then reserves the units it requests.
+
+        :param session_id: Session-Id of an open session
+        :param services: (rating group, used unit type, used amount,
+        requested unit type, requested amount) tuples, the requested
+        amount being None when no units are requested and 0 when the
+        default quota is requested
+        :param now: current time, time.time() by default
+        :return: (rating group, unit type, granted amount, final units)
+        of each service requesting units, final units being True when
+        the grant exhausted the balance
+        :raise CreditControlError: unknown session
+        """
+        if now is None:
+            now = time.time()
+        shard = self._session(session_id)
+        grants = []
+        with shard.lock:
+            self._expire(shard, now)
+            session = shard.sessions.get(session_id)
+            if session is None:
+                raise CreditControlError('DIAMETER_UNKNOWN_SESSION_ID',
+                                         'Session %s expired' % session_id)
+            account = session.account
+            for rating_group, used_unit, used, unit, requested in services:
+                reservation = session.reservations.pop(rating_group, None)
+                if reservation is not None:
+                    account.release(*reservation)
+                if used_unit is not None and used:
+                    account.debit(used_unit, used)
+                if requested is None:
+                    continue
+                if unit is None:
+                    unit = reservation[0] if reservation else TOTAL_OCTETS
+                granted, final = self._grant(session, rating_group, unit,
+                                             requested)
+                grants.append((rating_group, unit, granted, final))
+            session.updated = now
+            shard.timers.schedule(
+                session, now + self.validity_time * self.validity_grace)
+        return grants
+
+    def terminate(self, session_id, services=(), now=None):
+        """
+        Debits the last units used, releases the reservations left
+        and closes the session.
+
+        :param session_id: Session-Id of an open session
+        :param services: services of the request, as given to charge()
+        :param now: current time, time.time() by default
+        :return: the closed CreditSession
+        :raise CreditControlError: unknown session
+        """
+        if now is None:
+            now = time.time()
+        shard = self._session(session_id)
+        with shard.lock:
+            self._expire(shard, now)
+            session = shard.sessions.get(session_id)
+            if session is None:
+                raise CreditControlError('DIAMETER_UNKNOWN_SESSION_ID',
+                                         'Session %s expired' % session_id)
+            for rating_group, used_unit, used, unit, requested in services:
+                reservation = session.reservations.pop(rating_group, None)
+                if reservation is not None:
+                    session.account.release(*reservation)
+                if used_unit is not None and used:
+                    session.account.debit(used_unit, used)
+            self._close(shard, session)
+            session.updated = now
+            shard.closed += 1
+            return session
+
+    def event(self, subscriber, action, services):
+        """
+        One-time charging of an EVENT request, without any session.
+
+        Direct debiting charges the requested units of every service,
+        or none of them if the balance is too low. Refunds credit them
+        back, and balance checks only verify they are available.
+
+        :param subscriber: Subscription-Id-Data of the subscriber
+        :param action: Requested-Action of the request
+        :param services: services of the request, as given to charge()
+        :return: (rating group, unit type, granted amount, False)
+        of each debited service
+        :raise CreditControlError: unknown subscriber, balance too low,
+        or unknown action
+        """
+        requested = [(rating_group, unit or TOTAL_OCTETS,
+                      amount or self.default_quotas.get(unit or TOTAL_OCTETS,
+                                                        0))
+                     for rating_group, used_unit, used, unit, amount
+                     in services if amount is not None]
+        shard = self._shard(subscriber)
+        with shard.lock:
+            account = self._account(shard, subscriber)
+            if action == DIRECT_DEBITING or action == CHECK_BALANCE:
+                needed = {}
+                for rating_group, unit, amount in requested:
+                    needed[unit] = needed.get(unit, 0) + amount
+                for unit, amount in needed.items():
+                    if account.balances.get(unit, 0) < amount:
+                        raise CreditControlError(
+                            'DIAMETER_CREDIT_LIMIT_REACHED',
+                            'Not enough %s for %s' % (unit, subscriber))
+                if action == CHECK_BALANCE:
+                    return []
+                for unit, amount in needed.items():
+                    account.debit(unit, amount)
+                return [(rating_group, unit, amount, False)
+                        for rating_group, unit, amount in requested]
+            elif action == REFUND_ACCOUNT:
+                for rating_group, unit, amount in requested:
+                    account.balances[unit] = \
+                        account.balances.get(unit, 0) + amount
+                return []
+            elif action == PRICE_ENQUIRY:
+                return []
+            raise CreditControlError('DIAMETER_INVALID_AVP_VALUE',
+                                     'Unknown Requested-Action %s' % action)
+
+    def get(self, session_id):
+        """
+        :param session_id: Session-Id of the session
+        :return: the open CreditSession, None if not open
+        """
+        shard = self.session_shards.get(session_id)
+        if shard is None:
+            return None
+        return shard.sessions.get(session_id)
+
+    def expire(self, now=None):
+        """
+        Removes the stale sessions, releasing their reservations.
+
+        :param now: current time, time.time() by default
+        :return: list of the expired sessions
+        """
+        if now is None:
+            now = time.time()
+        expired = []
+        for shard in self.shards:
+            with shard.lock:
+                expired.extend(self._expire(shard, now))
+        return expired
+
+    def stats(self):
+        """
+        :return: dictionary with the session counters
+        """
+        stats = dict.fromkeys(
+            ('open', 'opened', 'closed', 'expired', 'rejected'), 0)
+        for shard in self.shards:
+            stats['open'] += len(shard.sessions)
+            stats['opened'] += shard.opened
+            stats['closed'] += shard.closed
+            stats['expired'] += shard.expired
+            stats['rejected'] += shard.rejected
+        return stats
+
+    def __len__(self):
+        return len(self.session_shards)
+
+    def __contains__(self, session_id):
+        return session_id in self.session_shards
@@ -0,0 +1,133 @@
+"""
+Framing of Diameter messages received over a stream (TCP) connection.
+
+TCP does not preserve message boundaries: a single read can return
+part of a message, or several pipelined messages at once.
+The framer keeps the received bytes in a reusable buffer, reads the
+3-byte length from each Diameter header and yields whole messages,
+keeping any partial tail for the next read.
+"""
+
+import struct
+
+# Smallest valid message is a Diameter header without AVPs
+DIAMETER_HEADER_LENGTH = 20
+# Message length is a 24-bit field
+DIAMETER_MAX_LENGTH = 0x00FFFFFF
+
+
+class DiameterFramingError(Exception):
+    """
+    Raised when the received stream can not be split into Diameter messages.
+
+    After a framing error the message boundaries are lost,
+    so the connection should be closed.
+    """
+
+
+class DiameterFramer:
+    """
+    Receive buffer splitting a byte stream into Diameter messages.
+    """
+
+    def __init__(self, buffer_size=4096):
+        """
+        The buffer is allocated once and reused between reads, the pending
+        data being moved to its start when there is no more free space.
+        It only grows when a single message is larger than the buffer.
+
+        :param buffer_size: initial size of the receive buffer
+        """
+
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # Received data not yet returned as messages is buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+    def pending(self):
+        """
+        :return: number of received bytes not yet returned as messages
+        """
+        return self.end - self.start
+
+    def _make_room(self):
+        """
+        Ensures there is free space at the end of the buffer,
+        by compacting the pending data or by growing the buffer
+        when the pending message does not fit.
+        """
+
+        if self.end < len(self.buffer):
+            return
+        pending = self.end - self.start
+        needed = pending + 1
+        if pending >= 4:
+            # Length of the pending message is already known
+            needed = max(needed, struct.unpack_from(
+                "!I", self.buffer, self.start)[0] & DIAMETER_MAX_LENGTH)
+        if needed > len(self.buffer):
+            # Messages already returned keep referencing the old buffer
+            buffer = bytearray(max(needed, 2 * len(self.buffer)))
+            buffer[0:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        elif self.start:
+            # Regions may overlap, so copy through a temporary string
+            self.buffer[0:pending] = self.view[self.start:self.end].tobytes()
+        self.start = 0
+        self.end = pending
+
+    def recv_from(self, connection):
+        """
+        Receives data from a socket directly into the buffer.
+
+        :param connection: socket connection to read from
+        :return: number of bytes received, 0 if the peer closed the connection
+        """
+
+        self._make_room()
+        received = connection.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        """
+        Appends data received by other means (e.g. by an event loop).
+
+        :param data: received bytes
+        """
+
+        offset = 0
+        while offset < len(data):
+            self._make_room()
+            chunk = min(len(data) - offset, len(self.buffer) - self.end)
+            self.buffer[self.end:self.end + chunk] = data[offset:offset + chunk]
+            self.end += chunk
+            offset += chunk
+
+    def messages(self):
+        """
+        Yields every complete message available in the buffer.
+
+        The messages are memoryview slices of the receive buffer,
+        so they are only valid until the next recv_from or feed call.
+        Partial messages are kept in the buffer for the next read.
+
+        :return: generator of complete Diameter messages
+        """
+
+        while self.end - self.start >= 4:
+            header = struct.unpack_from("!I", self.buffer, self.start)[0]
+            length = header & DIAMETER_MAX_LENGTH
+            if header >> 24 != 1 or length < DIAMETER_HEADER_LENGTH:
+                raise DiameterFramingError(
+                    "Invalid Diameter header (version %d, length %d)"
+                    % (header >> 24, length))
+            if self.end - self.start < length:
+                break
+            message = self.view[self.start:self.start + length]
+            self.start += length
+            yield message
+        if self.start == self.end:
+            self.start = self.end = 0
@@ -0,0 +1,315 @@
+"""
+Latency histogram, in the style of the HDR (High Dynamic Range) Histogram.
+
+Recorded values are integers (e.g. microseconds), counted into buckets
+whose width grows with the value, so every value is recorded with the
+same relative precision (significant decimal digits) over the whole
+range, with a fixed amount of memory and O(1) recording.
+
+Values can be recorded corrected for coordinated omission: when a value
+is larger than the expected interval between two requests, the requests
+that would have been sent meanwhile (but were not, the generator waiting
+for the slow answer) are recorded too, with linearly decreasing values.
+
+The percentile distribution output uses the HdrHistogram text format
+(.hgrm), readable by the HdrHistogram plotting tools.
+"""
+
+import math
+
+
+class LatencyHistogram:
+    """
+    Histogram of integer values, with a given number of significant digits.
+    """
+
+    def __init__(self, lowest=1, highest=3600 * 1000 * 1000,
+                 significant_digits=3):
+        """
+        :param lowest: lowest discernible value (at least 1)
+        :param highest: highest trackable value, larger values
+        being recorded as this one
+        :param significant_digits: decimal digits of precision (1 to 5)
+        """
+        if lowest < 1 or highest < 2 * lowest:
+            raise ValueError("Invalid histogram range %d-%d"
+                             % (lowest, highest))
+        if not 1 <= significant_digits <= 5:
+            raise ValueError("Significant digits must be between 1 and 5")
+        self.lowest = lowest
+        self.highest = highest
+        self.significant_digits = significant_digits
+
+        largest_single_unit = 2 * 10 ** significant_digits
+        self.unit_magnitude = int(math.floor(math.log(lowest, 2)))
+        self.sub_bucket_count_magnitude = int(
+            math.ceil(math.log(largest_single_unit, 2)))
+        self.sub_bucket_half_count_magnitude = \
+            self.sub_bucket_count_magnitude - 1
+        self.sub_bucket_count = 1 << self.sub_bucket_count_magnitude
+        self.sub_bucket_half_count = self.sub_bucket_count >> 1
+        self.sub_bucket_mask = \
+            (self.sub_bucket_count - 1) << self.unit_magnitude
+
+        smallest_untrackable = self.sub_bucket_count << self.unit_magnitude
+        self.bucket_count = 1
+        while smallest_untrackable <= highest:
+            smallest_untrackable <<= 1
+            self.bucket_count += 1
+        self.counts = [0] * ((self.bucket_count + 1)
+                             * self.sub_bucket_half_count)
+
+        self.total_count = 0
+        self.min_value = None
+        self.max_value = 0
+        self.total = 0
+        self.clamped = 0
+
+    def _bucket_index(self, value):
+        return ((value | self.sub_bucket_mask).bit_length()
+                - self.unit_magnitude
+                - (self.sub_bucket_half_count_magnitude + 1))
+
+    def _counts_index(self, value):
+        bucket_index = self._bucket_index(value)
+        sub_bucket_index = value >> (bucket_index + self.unit_magnitude)
+        bucket_base = (bucket_index + 1) << \
+            self.sub_bucket_half_count_magnitude
+        return bucket_base + sub_bucket_index - self.sub_bucket_half_count
+
+    def _value_from_index(self, index):
+        bucket_index = (index >> self.sub_bucket_half_count_magnitude) - 1
+        sub_bucket_index = (index & (self.sub_bucket_half_count - 1)) + \
+            self.sub_bucket_half_count
+        if bucket_index < 0:
+            sub_bucket_index -= self.sub_bucket_half_count
+            bucket_index = 0
+        return sub_bucket_index << (bucket_index + self.unit_magnitude)
+
+    def lowest_equivalent_value(self, value):
+        """
+        :return: smallest value counted in the same bucket as value
+        """
+        bucket_index = self._bucket_index(value)
+        sub_bucket_index = value >> (bucket_index + self.unit_magnitude)
+        return sub_bucket_index << (bucket_index + self.unit_magnitude)
+
+    def equivalent_range(self, value):
+        """
+        :return: width of the bucket value is counted in
+        """
+        bucket_index = self._bucket_index(value)
+        sub_bucket_index = value >> (bucket_index + self.unit_magnitude)
+        if sub_bucket_index >= self.sub_bucket_count:
+            bucket_index += 1
+        return 1 << (self.unit_magnitude + bucket_index)
+
+    def highest_equivalent_value(self, value):
+        """
+        :return: largest value counted in the same bucket as value
+        """
+        return (self.lowest_equivalent_value(value)
+                + self.equivalent_range(value) - 1)
+
+    def record_value(self, value, count=1):
+        """
+        Records a value.
+
+        :param value: recorded value, values below 0 being recorded as 0
+        :param count: number of times the value is recorded
+        """
+        value = int(value)
+        if value < 0:
+            value = 0
+        if value > self.highest:
+            value = self.highest
+            self.clamped += count
+        self.counts[self._counts_index(value)] += count
+        self.total_count += count
+        self.total += value * count
+        if self.min_value is None or value < self.min_value:
+            self.min_value = value
+        if value > self.max_value:
+            self.max_value = value
+
+    def record_corrected_value(self, value, expected_interval):
+        """
+        Records a value, correcting for coordinated omission.
+
+        :param value: recorded value
+        :param expected_interval: expected interval between two values
+        (e.g. between two requests at the target rate), 0 to not correct
+        """
+        self.record_value(value)
+        if expected_interval <= 0:
+            return
+        missing = value - expected_interval
+        while missing >= expected_interval:
+            self.record_value(missing)
+            missing -= expected_interval
+
+    def add(self, other):
+        """
+        Adds the values recorded by another histogram with the same layout.
+
+        :param other: LatencyHistogram to add
+        """
+        if len(other.counts) != len(self.counts) or \
+                other.unit_magnitude != self.unit_magnitude:
+            raise ValueError("Histograms have different layouts")
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total_count += other.total_count
+        self.total += other.total
+        self.clamped += other.clamped
+        if other.min_value is not None and (
+                self.min_value is None or other.min_value < self.min_value):
+            self.min_value = other.min_value
+        self.max_value = max(self.max_value, other.max_value)
+
+    def reset(self):
+        """
+        Clears all the recorded values.
+        """
+        self.counts = [0] * len(self.counts)
+        self.total_count = 0
+        self.min_value = None
+        self.max_value = 0
+        self.total = 0
+        self.clamped = 0
+
+    def mean(self):
+        """
+        :return: mean of the recorded values, 0 if there are none
+        """
+        if not self.total_count:
+            return 0.0
+        return self.total / float(self.total_count)
+
+    def stddev(self):
+        """
+        :return: standard deviation of the recorded values,
+        computed from the buckets' middle values
+        """
+        if not self.total_count:
+            return 0.0
+        mean = self.mean()
+        deviation = 0.0
+        for index, count in enumerate(self.counts):
+            if count:
+                value = self._value_from_index(index)
+                middle = self.lowest_equivalent_value(value) + \
+                    (self.equivalent_range(value) >> 1)
+                deviation += (middle - mean) ** 2 * count
+        return math.sqrt(deviation / self.total_count)
+
+    def value_at_percentile(self, percentile):
+        """
+        :param percentile: percentile, between 0 and 100
+        :return: value at the percentile (highest equivalent value
+        of its bucket), 0 if no value was recorded
+        """
+        if not self.total_count:
+            return 0
+        percentile = min(max(percentile, 0.0), 100.0)
+        count_at_percentile = max(
+            int(percentile / 100.0 * self.total_count + 0.5), 1)
+        cumulated = 0
+        for index, count in enumerate(self.counts):
+            cumulated += count
+            if cumulated >= count_at_percentile:
+                value = self._value_from_index(index)
+                if percentile == 0.0:
+                    return self.lowest_equivalent_value(value)
+                return min(self.highest_equivalent_value(value),
+                           self.max_value)
+        return self.max_value
+
+    def percentiles(self, percentiles=(50, 90, 99, 99.9, 99.99)):
+        """
+        :param percentiles: requested percentiles, between 0 and 100
+        :return: dictionary of the value at each percentile
+        """
+        return dict((percentile, self.value_at_percentile(percentile))
+                    for percentile in percentiles)
+
+    def iter_percentiles(self, ticks_per_half_distance=5):
+        """
+        Iterates over the percentile levels used by the HdrHistogram
+        output: the steps get finer as the percentile gets closer to 100.
+
+        :return: generator of (value, percentile, cumulated count)
+        """
+        if not self.total_count:
+            return
+        percentile_to_iterate_to = 0.0
+        cumulated = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            cumulated += count
+            value = min(self.highest_equivalent_value(
+                self._value_from_index(index)), self.max_value)
+            if cumulated == self.total_count:
+                # The levels would get infinitely close to 100
+                yield value, percentile_to_iterate_to, cumulated
+                yield value, 100.0, cumulated
+                return
+            current = 100.0 * cumulated / self.total_count
+            while percentile_to_iterate_to <= current:
+                yield value, percentile_to_iterate_to, cumulated
+                half_distance = 2 ** int(math.log(
+                    100.0 / (100.0 - percentile_to_iterate_to), 2) + 1)
+                ticks = ticks_per_half_distance * half_distance
+                percentile_to_iterate_to += 100.0 / ticks
+
+    def output_percentile_distribution(self, output, scale=1.0,
+                                       ticks_per_half_distance=5):
+        """
+        Writes the percentile distribution in the HdrHistogram text format.
+
+        :param output: file object to write to
+        :param scale: divisor of the values (1000.0 prints microseconds
+        as milliseconds)
+        :param ticks_per_half_distance: percentile steps per halving
+        of the distance to 100%
+        """
+        output.write('%12s %14s %10s %14s\n\n' % (
+            'Value', 'Percentile', 'TotalCount', '1/(1-Percentile)'))
+        for value, percentile, cumulated in self.iter_percentiles(
+                ticks_per_half_distance):
+            fraction = percentile / 100.0
+            if fraction < 1.0:
+                output.write('%12.3f %2.12f %10d %14.2f\n' % (
+                    value / scale, fraction, cumulated,
+                    1.0 / (1.0 - fraction)))
+            else:
+                output.write('%12.3f %2.12f %10d\n' % (
+                    value / scale, fraction, cumulated))
+        output.write('#[Mean    = %12.3f, StdDeviation   = %12.3f]\n' % (
+            self.mean() / scale, self.stddev() / scale))
+        output.write('#[Max     = %12.3f, Total count    = %12d]\n' % (
+            self.max_value / scale, self.total_count))
+        output.write('#[Buckets = %12d, SubBuckets     = %12d]\n' % (
+            self.bucket_count, self.sub_bucket_count))
+
+    def to_dict(self, scale=1.0,
+                percentiles=(50, 90, 99, 99.9, 99.99, 100)):
+        """
+        :param scale: divisor of the values
+        :param percentiles: reported percentiles
+        :return: dictionary summarizing the recorded values
+        """
+        return {
+            'count': self.total_count,
+            'min': (self.min_value or 0) / scale,
+            'max': self.max_value / scale,
+            'mean': self.mean() / scale,
+            'stddev': self.stddev() / scale,
+            'clamped': self.clamped,
+            'percentiles': dict(
+                ('p%s' % ('%g' % percentile).replace('.', '_'),
+                 self.value_at_percentile(percentile) / scale)
+                for percentile in percentiles),
+        }
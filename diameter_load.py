@@ -0,0 +1,379 @@
+"""
+Diameter traffic generator, built on the DiameterClient.
+
+Each connection first exchanges a CER, then sends the requests of the
+scenario's session flows (e.g. accounting START, INTERIMs and STOP),
+keeping a number of sessions open and interleaving their requests.
+A session is bound to a connection, so its requests are answered
+in order.
+
+The rate is controlled open-loop: every request has an intended send
+time, given by the target rate, and is sent then whether or not the
+previous answers were received. Latencies are measured from the intended
+send time rather than from the actual one, so a server stalling the
+generator (coordinated omission) shows in the recorded latencies,
+instead of delaying the requests that would have measured it.
+"""
+
+import collections
+import functools
+import threading
+from diameter_client import *
+from diameter_histogram import *
+
+# Values of the CC-Request-Type AVP
+INITIAL_REQUEST = 1
+UPDATE_REQUEST = 2
+TERMINATION_REQUEST = 3
+
+
+def accounting_flow(client, session_id, interims):
+    """
+    Accounting session: START, interims INTERIM and STOP records.
+
+    :param client: DiameterClient sending the requests
+    :param session_id: Session-Id of the session
+    :param interims: number of INTERIM records
+    :return: generator of (header, AVPs) of the session's requests
+    """
+    record_types = [2] + [3] * interims + [4]
+    for record_number, record_type in enumerate(record_types):
+        header = HDRItem()
+        header.cmd = diameter_base.cmd_codes['Accounting']
+        header.flags = DIAMETER_HDR_PROXIABLE
+        header.appId = 3
+        yield header, [
+            encodeAVPBin('Session-Id', session_id),
+            encodeAVPBin('Origin-Host', client.origin_host),
+            encodeAVPBin('Origin-Realm', client.origin_realm),
+            encodeAVPBin('Destination-Realm', client.destination_realm),
+            encodeAVPBin('Accounting-Record-Type', record_type),
+            encodeAVPBin('Accounting-Record-Number', record_number),
+            encodeAVPBin('Acct-Application-Id', 3),
+            encodeAVPBin('Acct-Interim-Interval', 300),
+            encodeAVPBin('Event-Timestamp', int(time.time())),
+        ]
+
+
+def credit_control_flow(client, session_id, updates):
+    """
+    Credit-Control session: INITIAL, updates UPDATE
+    and TERMINATION requests, each for one rating group,
+    charging a subscriber derived from the Session-Id.
+
+    :param client: DiameterClient sending the requests
+    :param session_id: Session-Id of the session
+    :param updates: number of UPDATE requests
+    :return: generator of (header, AVPs) of the session's requests
+    """
+    request_types = [INITIAL_REQUEST] + [UPDATE_REQUEST] * updates + \
+        [TERMINATION_REQUEST]
+    subscriber = '447%09d' % (hash(session_id) % 1000000000)
+    for request_number, request_type in enumerate(request_types):
+        header = HDRItem()
+        header.cmd = diameter_base.cmd_codes['Credit-Control']
+        header.flags = DIAMETER_HDR_PROXIABLE
+        header.appId = 4
+        units = []
+        if request_type != TERMINATION_REQUEST:
+            units.append(encodeAVPBin('Requested-Service-Unit', [
+                encodeAVPBin('CC-Total-Octets', 1048576)]))
+        if request_type != INITIAL_REQUEST:
+            units.append(encodeAVPBin('Used-Service-Unit', [
+                encodeAVPBin('CC-Total-Octets', 524288)]))
+        yield header, [
+            encodeAVPBin('Session-Id', session_id),
+            encodeAVPBin('Origin-Host', client.origin_host),
+            encodeAVPBin('Origin-Realm', client.origin_realm),
+            encodeAVPBin('Destination-Realm', client.destination_realm),
+            encodeAVPBin('Auth-Application-Id', 4),
+            encodeAVPBin('Service-Context-Id', '32251@3gpp.org'),
+            encodeAVPBin('CC-Request-Type', request_type),
+            encodeAVPBin('CC-Request-Number', request_number),
+            encodeAVPBin('Subscription-Id', [
+                encodeAVPBin('Subscription-Id-Type', 0),
+                encodeAVPBin('Subscription-Id-Data', subscriber)]),
+            encodeAVPBin('Multiple-Services-Credit-Control',
+                         [encodeAVPBin('Rating-Group', 1)] + units),
+        ]
+
+
+def watchdog_flow(client, session_id, count):
+    """
+    Device Watchdog Requests, not bound to a session.
+
+    :param client: DiameterClient sending the requests
+    :param session_id: unused, watchdogs have no session
+    :param count: number of DWRs
+    :return: generator of (header, AVPs) of the requests
+    """
+    for _ in range(max(count, 1)):
+        request = client.generate_generic_request(
+            diameter_base.cmd_codes['Device-Watchdog'])
+        request['avps'].append(encodeAVPBin('Origin-State-Id', 1))
+        yield request['header'], request['avps']
+
+
+# Session flow of each scenario, given the client, the Session-Id
+# and the number of intermediate requests of each session
+scenarios = {
+    'acr': accounting_flow,
+    'ccr': credit_control_flow,
+    'dwr': watchdog_flow,
+}
+
+
+class LoadConnection:
+    """
+    Connection of the load generator, sending its share of the load.
+    """
+
+    def __init__(self, generator, index):
+        """
+        :param generator: LoadGenerator the connection belongs to
+        :param index: connection number
+        """
+
+        self.generator = generator
+        self.index = index
+        self.client = DiameterClient(
+            generator.host, generator.port,
+            origin_host=generator.origin_host,
+            origin_realm=generator.origin_realm,
+            destination_realm=generator.destination_realm,
+            request_timeout=generator.request_timeout)
+        # Latency from the intended send time, and from the actual one
+        # (service time), in microseconds
+        self.histogram = LatencyHistogram()
+        self.service_histogram = LatencyHistogram()
+        self.sent = 0
+        self.answered = 0
+        self.errors = 0
+        self.sessions_started = 0
+        self.result_codes = collections.Counter()
+        self.sender = None
+
+    def start(self):
+        """
+        Connects to the peer and exchanges the capabilities.
+        """
+
+        self.client.start()
+        cea_avps = self.client.send_cer()
+        result_code = cea_avps.get('Result-Code')
+        if result_code != diameter_base.result_codes['DIAMETER_SUCCESS']:
+            raise RuntimeError("Capabilities exchange failed with %s"
+                               % (result_code,))
+
+    def new_session(self):
+        """
+        :return: request generator of a new session of the scenario
+        """
+
+        self.sessions_started += 1
+        session_id = '%s;%d;%d;%d' % (
+            self.client.origin_host, int(self.generator.started),
+            self.index, self.sessions_started)
+        return self.generator.scenario(
+            self.client, session_id, self.generator.session_requests)
+
+    def completed(self, intended, pending):
+        """
+        Records the outcome of a request. Runs in the reader thread.
+
+        :param intended: time the request should have been sent at
+        :param pending: completed PendingRequest
+        """
+
+        if pending.error is not None:
+            self.errors += 1
+            return
+        self.answered += 1
+        self.result_codes[pending.answer.avps.get('Result-Code')] += 1
+        if intended < self.generator.record_from:
+            return
+        self.histogram.record_value(
+            (pending.completed_at - intended) * 1000000)
+        self.service_histogram.record_value(pending.latency() * 1000000)
+
+    def run(self, rate, first_send, end):
+        """
+        Sender loop, sending the requests at their intended times.
+
+        :param rate: requests per second sent over this connection
+        :param first_send: intended time of the first request
+        :param end: time after which no request is sent anymore
+        """
+
+        interval = 1.0 / rate
+        sessions = collections.deque(
+            self.new_session()
+            for _ in range(self.generator.open_sessions))
+        sequence = 0
+        while True:
+            intended = first_send + sequence * interval
+            if intended >= end:
+                break
+            delay = intended - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            session = sessions.popleft()
+            try:
+                header, avps = next(session)
+            except StopIteration:
+                session = self.new_session()
+                header, avps = next(session)
+            sessions.append(session)
+            self.client.send_request(
+                header, avps,
+                callback=functools.partial(self.completed, intended))
+            self.sent += 1
+            sequence += 1
+
+    def start_sender(self, rate, first_send, end):
+        """
+        Starts the sender loop in its own thread.
+        """
+
+        self.sender = threading.Thread(
+            target=self.run, args=(rate, first_send, end))
+        self.sender.daemon = True
+        self.sender.start()
+
+    def wait(self, timeout):
+        """
+        Waits for the sender to finish and the answers to be received.
+
+        :param timeout: seconds to wait for the outstanding answers
+        """
+
+        self.sender.join()
+        deadline = time.time() + timeout
+        while self.client.outstanding() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        """
+        Closes the connection, failing the requests still outstanding.
+        """
+
+        self.client.close()
+
+
+class LoadGenerator:
+    """
+    Open-loop Diameter load generator.
+    """
+
+    def __init__(self,
+                 host='127.0.0.1',
+                 port=3868,
+                 scenario='acr',
+                 rate=1000.0,
+                 duration=10.0,
+                 warmup=0.0,
+                 connections=1,
+                 open_sessions=100,
+                 session_requests=1,
+                 origin_host='client.asn.test',
+                 origin_realm='asn.test',
+                 destination_realm='asn.test',
+                 request_timeout=10.0):
+        """
+        :param host: host of the peer
+        :param port: port of the peer
+        :param scenario: name of the scenario, a key of scenarios
+        :param rate: target rate, in requests per second
+        :param duration: seconds during which requests are sent
+        :param warmup: seconds at the start not recorded in the latencies
+        :param connections: number of connections, sharing the rate
+        :param open_sessions: sessions kept open by each connection
+        :param session_requests: intermediate requests of each session
+        (INTERIMs, UPDATEs)
+        :param origin_host: Diameter Origin Host of the generator
+        :param origin_realm: Diameter Origin Realm of the generator
+        :param destination_realm: Diameter Destination Realm
+        :param request_timeout: seconds to wait for each answer
+        """
+
+        self.host = host
+        self.port = port
+        self.scenario = scenarios[scenario]
+        self.scenario_name = scenario
+        self.rate = rate
+        self.duration = duration
+        self.warmup = warmup
+        self.open_sessions = open_sessions
+        self.session_requests = session_requests
+        self.origin_host = origin_host
+        self.origin_realm = origin_realm
+        self.destination_realm = destination_realm
+        self.request_timeout = request_timeout
+        self.started = time.time()
+        self.record_from = self.started
+        self.connections = [LoadConnection(self, index)
+                            for index in range(connections)]
+
+    def run(self):
+        """
+        Connects, sends the load and waits for the last answers.
+
+        :return: summary of the run, as returned by results()
+        """
+
+        for connection in self.connections:
+            connection.start()
+        # Every connection gets its share of the rate, shifted in time
+        # so that the requests are spread evenly between them
+        connection_rate = self.rate / len(self.connections)
+        self.started = time.time()
+        self.record_from = self.started + self.warmup
+        end = self.started + self.warmup + self.duration
+        for connection in self.connections:
+            connection.start_sender(
+                connection_rate,
+                self.started + connection.index / self.rate, end)
+        try:
+            for connection in self.connections:
+                connection.wait(self.request_timeout)
+        finally:
+            for connection in self.connections:
+                connection.close()
+        return self.results()
+
+    def histograms(self):
+        """
+        :return: latency and service time histograms of all connections
+        """
+
+        latency = LatencyHistogram()
+        service = LatencyHistogram()
+        for connection in self.connections:
+            latency.add(connection.histogram)
+            service.add(connection.service_histogram)
+        return latency, service
+
+    def results(self):
+        """
+        :return: dictionary summarizing the run, latencies in milliseconds
+        """
+
+        latency, service = self.histograms()
+        result_codes = collections.Counter()
+        for connection in self.connections:
+            result_codes.update(connection.result_codes)
+        return {
+            'scenario': self.scenario_name,
+            'target_rate': self.rate,
+            'achieved_rate': latency.total_count / float(self.duration),
+            'duration': self.duration,
+            'connections': len(self.connections),
+            'sent': sum(c.sent for c in self.connections),
+            'answered': sum(c.answered for c in self.connections),
+            'errors': sum(c.errors for c in self.connections),
+            'sessions': sum(c.sessions_started for c in self.connections),
+            'result_codes': dict((str(code), count)
+                                 for code, count in result_codes.items()),
+            'latency_ms': latency.to_dict(1000.0),
+            'service_time_ms': service.to_dict(1000.0),
+        }
@@ -0,0 +1,372 @@
+"""
+Server instrumentation: counters, gauges and latency histograms.
+
+Contains:
+- per-thread metrics accumulators, updated without any lock
+- registry aggregating them into snapshots
+- Prometheus text format rendering of a snapshot
+- local HTTP endpoint serving the metrics
+
+Each thread handling requests updates its own accumulator, so recording
+a request only costs a few integer increments and histogram updates.
+The accumulators are only summed when a snapshot is taken, and the
+accumulator of a finished connection thread is folded into the totals.
+"""
+
+import BaseHTTPServer
+import StringIO
+import struct
+import threading
+
+from diameter_histogram import *
+
+# Stages of the request processing whose latency is recorded
+STAGES = ('decode', 'handle', 'send')
+
+# Stage latencies are recorded in microseconds, up to a minute
+STAGE_HISTOGRAM_HIGHEST = 60 * 1000 * 1000
+STAGE_HISTOGRAM_DIGITS = 2
+
+# Quantiles of the stage latencies exported by the endpoint
+EXPORTED_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+# Code of the Result-Code AVP
+RESULT_CODE_AVP = 268
+
+
+def new_stage_histogram():
+    return LatencyHistogram(1, STAGE_HISTOGRAM_HIGHEST,
+                            STAGE_HISTOGRAM_DIGITS)
+
+
+def answer_result_code(message):
+    """
+    Reads the Result-Code of an encoded answer,
+    without decoding the other AVPs.
+
+    :param message: encoded Diameter answer
+    :return: the Result-Code, None if the answer has none
+    """
+    length = min(len(message), struct.unpack_from("!I", message, 0)[0]
+                 & 0x00FFFFFF)
+    offset = 20
+    while offset + 12 <= length:
+        code, flags_length = struct.unpack_from("!II", message, offset)
+        avp_length = flags_length & 0x00FFFFFF
+        if avp_length < 8:
+            return None
+        if code == RESULT_CODE_AVP and not flags_length & 0x80000000:
+            return struct.unpack_from("!I", message, offset + 8)[0]
+        offset += (avp_length + 3) & ~3
+    return None
+
+
+class ThreadMetrics:
+    """
+    Metrics accumulated by a single thread.
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.answers = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections_opened = 0
+        self.connections_closed = 0
+        self.stages = dict((stage, new_stage_histogram())
+                           for stage in STAGES)
+
+    def add(self, other):
+        """
+        Adds the metrics accumulated by another thread.
+
+        :param other: ThreadMetrics to add
+        """
+        for command_code, count in other.requests.items():
+            self.requests[command_code] = \
+                self.requests.get(command_code, 0) + count
+        for key, count in other.answers.items():
+            self.answers[key] = self.answers.get(key, 0) + count
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.connections_opened += other.connections_opened
+        self.connections_closed += other.connections_closed
+        for stage, histogram in other.stages.items():
+            self.stages[stage].add(histogram)
+
+
+class MetricsRegistry:
+    """
+    Metrics of a server: per-thread accumulators and gauges.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.accumulators = []
+        # Totals of the accumulators of finished threads
+        self.retired = ThreadMetrics()
+        self.gauges = []
+
+    def accumulator(self):
+        """
+        :return: ThreadMetrics of the calling thread
+        """
+        try:
+            return self.local.metrics
+        except AttributeError:
+            metrics = ThreadMetrics()
+            with self.lock:
+                self.accumulators.append(metrics)
+            self.local.metrics = metrics
+            return metrics
+
+    def retire(self):
+        """
+        Folds the calling thread's accumulator into the totals.
+        To be called by threads about to finish.
+        """
+        metrics = getattr(self.local, 'metrics', None)
+        if metrics is None:
+            return
+        del self.local.metrics
+        with self.lock:
+            self.accumulators.remove(metrics)
+            self.retired.add(metrics)
+
+    def record_request(self, command_code, result_code, bytes_in, bytes_out,
+                       timings):
+        """
+        Records a handled request into the calling thread's accumulator.
+
+        :param command_code: command code of the request
+        :param result_code: Result-Code of the answer, None if none
+        :param bytes_in: size of the request
+        :param bytes_out: size of the answer
+        :param timings: (stage, seconds) tuples
+        """
+        metrics = self.accumulator()
+        metrics.requests[command_code] = \
+            metrics.requests.get(command_code, 0) + 1
+        key = (command_code, result_code)
+        metrics.answers[key] = metrics.answers.get(key, 0) + 1
+        metrics.bytes_in += bytes_in
+        metrics.bytes_out += bytes_out
+        for stage, seconds in timings:
+            metrics.stages[stage].record_value(seconds * 1000000)
+
+    def record_stage(self, stage, seconds):
+        """
+        Records the latency of a processing stage.
+
+        :param stage: name of the stage, one of STAGES
+        :param seconds: duration of the stage
+        """
+        self.accumulator().stages[stage].record_value(seconds * 1000000)
+
+    def connection_opened(self):
+        self.accumulator().connections_opened += 1
+
+    def connection_closed(self):
+        self.accumulator().connections_closed += 1
+
+    def total(self, attribute):
+        """
+        Sums a single counter over all the threads,
+        cheaper than a whole snapshot.
+
+        :param attribute: name of the ThreadMetrics counter
+        :return: total value of the counter
+        """
+        with self.lock:
+            accumulators = [self.retired] + self.accumulators
+        return sum(getattr(metrics, attribute) for metrics in accumulators)
+
+    def gauge(self, name, function, description):
+        """
+        Registers a gauge, read when taking snapshots.
+
+        :param name: metric name
+        :param function: function returning the current value
+        :param description: help text of the metric
+        """
+        self.gauges.append((name, function, description))
+
+    def totals(self):
+        """
+        :return: ThreadMetrics with the totals of all the threads
+        """
+        totals = ThreadMetrics()
+        with self.lock:
+            totals.add(self.retired)
+            accumulators = list(self.accumulators)
+        for metrics in accumulators:
+            totals.add(metrics)
+        return totals
+
+    def snapshot(self):
+        """
+        :return: dictionary with the current value of every metric,
+        latencies being LatencyHistogram objects (microseconds)
+        """
+        totals = self.totals()
+        gauges = {}
+        for name, function, description in self.gauges:
+            try:
+                gauges[name] = function()
+            except Exception:
+                gauges[name] = None
+        return {
+            'requests': totals.requests,
+            'answers': totals.answers,
+            'bytes_in': totals.bytes_in,
+            'bytes_out': totals.bytes_out,
+            'connections_opened': totals.connections_opened,
+            'connections_closed': totals.connections_closed,
+            'stages': totals.stages,
+            'gauges': gauges,
+        }
+
+    def render(self):
+        """
+        :return: the current metrics, in the Prometheus text format
+        """
+        return render_prometheus(self.snapshot(), dict(
+            (name, description) for name, function, description
+            in self.gauges))
+
+
+def render_prometheus(snapshot, gauge_descriptions=None):
+    """
+    Renders a metrics snapshot in the Prometheus text exposition format.
+
+    :param snapshot: dictionary returned by MetricsRegistry.snapshot()
+    :param gauge_descriptions: help text of each gauge, by name
+    :return: the metrics, as text
+    """
+    gauge_descriptions = gauge_descriptions or {}
+    lines = []
+
+    def metric(name, metric_type, description, samples):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        for labels, value in samples:
+            if labels:
+                lines.append('%s{%s} %s' % (name, ','.join(
+                    '%s="%s"' % label for label in labels), value))
+            else:
+                lines.append('%s %s' % (name, value))
+
+    metric('diameter_requests_total', 'counter',
+           'Diameter requests handled, by command code',
+           [((('command_code', command_code),), count)
+            for command_code, count in sorted(snapshot['requests'].items())])
+    metric('diameter_answers_total', 'counter',
+           'Diameter answers sent, by command code and result code',
+           [((('command_code', command_code),
+              ('result_code', '' if result_code is None else result_code)),
+             count)
+            for (command_code, result_code), count
+            in sorted(snapshot['answers'].items())])
+    metric('diameter_received_bytes_total', 'counter',
+           'Bytes of the handled requests', [((), snapshot['bytes_in'])])
+    metric('diameter_sent_bytes_total', 'counter',
+           'Bytes of the sent answers', [((), snapshot['bytes_out'])])
+    metric('diameter_connections_total', 'counter',
+           'Peer connections accepted',
+           [((), snapshot['connections_opened'])])
+
+    samples = []
+    for stage in STAGES:
+        histogram = snapshot['stages'][stage]
+        for quantile in EXPORTED_QUANTILES:
+            samples.append(((('stage', stage), ('quantile', quantile)),
+                            histogram.value_at_percentile(quantile * 100)
+                            / 1000000.0))
+    metric('diameter_stage_seconds', 'summary',
+           'Latency of the request processing stages', samples)
+    for stage in STAGES:
+        histogram = snapshot['stages'][stage]
+        lines.append('diameter_stage_seconds_sum{stage="%s"} %s'
+                     % (stage, histogram.total / 1000000.0))
+        lines.append('diameter_stage_seconds_count{stage="%s"} %s'
+                     % (stage, histogram.total_count))
+
+    for name, value in sorted(snapshot['gauges'].items()):
+        if value is None:
+            continue
+        metric(name, 'gauge', gauge_descriptions.get(name, name),
+               [((), value)])
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the registry's metrics on GET /metrics,
+    and the captured message traces on GET /traces.
+    """
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            body = self.server.registry.render()
+        elif path == '/traces' and self.server.tracer is not None:
+            traces = StringIO.StringIO()
+            self.server.tracer.dump(traces)
+            body = traces.getvalue()
+        else:
+            self.send_error(404)
+            return
+        if isinstance(body, unicode):
+            # Decoded names and values make the traces unicode text
+            body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint serving the metrics in the Prometheus text format.
+    """
+
+    def __init__(self, registry, host='127.0.0.1', port=9090, tracer=None):
+        """
+        :param registry: MetricsRegistry to serve
+        :param host: host the endpoint listens on
+        :param port: port the endpoint listens on
+        :param tracer: MessageTracer whose captures are served,
+        None to not serve any
+        """
+        self.http_server = BaseHTTPServer.HTTPServer(
+            (host, port), MetricsRequestHandler)
+        self.http_server.registry = registry
+        self.http_server.tracer = tracer
+        self.thread = None
+
+    def start(self):
+        """
+        Serves the metrics from a background thread.
+        """
+        self.thread = threading.Thread(target=self.http_server.serve_forever,
+                                       name='metrics-endpoint')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops serving the metrics.
+        """
+        if self.thread is None:
+            return
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        self.thread.join()
+        self.thread = None
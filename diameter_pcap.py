@@ -0,0 +1,663 @@
+"""
+Recording and replaying Diameter traffic, as pcap/pcapng captures.
+
+Contains:
+- capture reader, for pcap and pcapng files, streaming the packets
+  from a memory mapped file so captures larger than memory can be read
+- TCP reassembly of the Diameter connections, yielding whole messages
+- pcap writer, recording messages as synthesized IPv4/IPv6 TCP packets
+- replay driver, sending the captured requests to a target at their
+  original timing, or at a multiple of it
+"""
+
+import collections
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+from diameter_framing import *
+
+# Diameter port, whose TCP streams are reassembled by default
+DIAMETER_PORT = 3868
+
+# Link layer types (LINKTYPE_*) understood by the reader
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+# Magic numbers of the pcap global header, with their timestamp divisor
+PCAP_MAGICS = {
+    0xa1b2c3d4: ('<', 1000000.0),
+    0xd4c3b2a1: ('>', 1000000.0),
+    0xa1b23c4d: ('<', 1000000000.0),
+    0x4d3cb2a1: ('>', 1000000000.0),
+}
+
+# pcapng block types
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAPNG_INTERFACE_DESCRIPTION = 1
+PCAPNG_PACKET = 2
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_OPTION_TSRESOL = 9
+
+# TCP flags
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+
+# Out of order segments kept per stream before giving up on a gap
+MAX_PENDING_SEGMENTS = 256
+
+# Largest TCP payload of the written packets
+MAX_SEGMENT_SIZE = 65535 - 60
+
+# Packet read from a capture: timestamp (seconds), link type and data
+CapturedPacket = collections.namedtuple(
+    'CapturedPacket', ['timestamp', 'linktype', 'data'])
+
+# Diameter message reassembled from a capture, the source and
+# destination being (address, port) tuples
+CapturedMessage = collections.namedtuple(
+    'CapturedMessage', ['timestamp', 'source', 'destination', 'message'])
+
+# TCP segment decoded from a packet
+TcpSegment = collections.namedtuple(
+    'TcpSegment', ['source', 'destination', 'sequence', 'flags', 'payload'])
+
+
+class CaptureError(Exception):
+    """
+    Raised when a file is not a readable pcap or pcapng capture.
+    """
+
+
+def map_capture(path):
+    """
+    Memory maps a capture file, read only.
+
+    :param path: path of the capture
+    :return: (file, mmap) of the capture, to be closed by the caller
+    """
+    capture_file = open(path, 'rb')
+    if os.fstat(capture_file.fileno()).st_size == 0:
+        capture_file.close()
+        raise CaptureError("Empty capture %s" % path)
+    return capture_file, mmap.mmap(capture_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+
+
+def iter_pcap_packets(data):
+    """
+    Reads the packets of a pcap capture.
+
+    :param data: capture contents (mmap, str or bytearray)
+    :return: generator of CapturedPacket
+    """
+    magic = struct.unpack_from('<I', data, 0)[0]
+    if magic not in PCAP_MAGICS:
+        raise CaptureError("Not a pcap capture (magic %08x)" % magic)
+    order, divisor = PCAP_MAGICS[magic]
+    linktype = struct.unpack_from(order + 'I', data, 20)[0] & 0x0FFFFFFF
+    record_header = struct.Struct(order + 'IIII')
+    offset = 24
+    size = len(data)
+    while offset + record_header.size <= size:
+        seconds, fraction, captured, length = \
+            record_header.unpack_from(data, offset)
+        offset += record_header.size
+        if offset + captured > size:
+            # Capture cut while writing the last packet
+            break
+        yield CapturedPacket(seconds + fraction / divisor, linktype,
+                             data[offset:offset + captured])
+        offset += captured
+
+
+def _pcapng_resolution(data, order, offset, end):
+    """
+    :return: timestamp divisor of an interface, from its options
+    """
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(order + 'HH', data, offset)
+        if code == 0:
+            break
+        if code == PCAPNG_OPTION_TSRESOL and length >= 1:
+            resolution = ord(data[offset + 4:offset + 5])
+            if resolution & 0x80:
+                return float(2 ** (resolution & 0x7F))
+            return float(10 ** resolution)
+        offset += 4 + ((length + 3) & ~3)
+    return 1000000.0
+
+
+def iter_pcapng_packets(data):
+    """
+    Reads the packets of a pcapng capture, of every section and interface.
+
+    :param data: capture contents (mmap, str or bytearray)
+    :return: generator of CapturedPacket
+    """
+    order = '<'
+    interfaces = []
+    timestamp = 0.0
+    offset = 0
+    size = len(data)
+    while offset + 12 <= size:
+        block_type = struct.unpack_from(order + 'I', data, offset)[0]
+        if block_type == PCAPNG_SECTION_HEADER:
+            # Each section has its own byte order and interfaces
+            magic = struct.unpack_from('<I', data, offset + 8)[0]
+            if magic == PCAPNG_BYTE_ORDER_MAGIC:
+                order = '<'
+            elif magic == struct.unpack('>I', struct.pack(
+                    '<I', PCAPNG_BYTE_ORDER_MAGIC))[0]:
+                order = '>'
+            else:
+                raise CaptureError("Invalid pcapng byte order magic")
+            interfaces = []
+        block_length = struct.unpack_from(order + 'I', data, offset + 4)[0]
+        if block_length < 12 or offset + block_length > size:
+            break
+        body = offset + 8
+        if block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            linktype = struct.unpack_from(order + 'H', data, body)[0]
+            interfaces.append((linktype, _pcapng_resolution(
+                data, order, body + 8, offset + block_length - 4)))
+        elif block_type in (PCAPNG_ENHANCED_PACKET, PCAPNG_PACKET):
+            if block_type == PCAPNG_ENHANCED_PACKET:
+                interface, high, low, captured = struct.unpack_from(
+                    order + 'IIII', data, body)
+            else:
+                interface, drops, high, low, captured = struct.unpack_from(
+                    order + 'HHIII', data, body)
+            if interface < len(interfaces):
+                linktype, divisor = interfaces[interface]
+                timestamp = ((high << 32) | low) / divisor
+                start = body + 20
+                yield CapturedPacket(timestamp, linktype,
+                                     data[start:start + captured])
+        elif block_type == PCAPNG_SIMPLE_PACKET and interfaces:
+            length = struct.unpack_from(order + 'I', data, body)[0]
+            captured = min(length, block_length - 16)
+            # Simple packets have no timestamp of their own
+            yield CapturedPacket(timestamp, interfaces[0][0],
+                                 data[body + 4:body + 4 + captured])
+        offset += block_length
+
+
+def iter_packets(data):
+    """
+    Reads the packets of a capture, pcap or pcapng.
+
+    :param data: capture contents (mmap, str or bytearray)
+    :return: generator of CapturedPacket
+    """
+    if len(data) < 24:
+        raise CaptureError("Capture too short")
+    if struct.unpack_from('<I', data, 0)[0] == PCAPNG_SECTION_HEADER:
+        return iter_pcapng_packets(data)
+    return iter_pcap_packets(data)
+
+
+def _network_layer(linktype, packet):
+    """
+    :return: (IP version, offset of the IP header), None if not IP
+    """
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype = struct.unpack_from('!H', packet, offset)[0]
+        # Skipping the VLAN tags
+        while ethertype in (0x8100, 0x88A8) and len(packet) >= offset + 6:
+            offset += 4
+            ethertype = struct.unpack_from('!H', packet, offset)[0]
+        offset += 2
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype = struct.unpack_from('!H', packet, 14)[0]
+        offset = 16
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype = struct.unpack_from('!H', packet, 0)[0]
+        offset = 20
+    elif linktype == LINKTYPE_NULL:
+        # Address family, in the byte order of the capturing host
+        family = struct.unpack_from('<I', packet, 0)[0]
+        if family > 0xFFFF:
+            family = struct.unpack_from('>I', packet, 0)[0]
+        ethertype = 0x0800 if family == socket.AF_INET else 0x86DD
+        offset = 4
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        offset = 0
+        ethertype = 0x0800 if ord(packet[0:1]) >> 4 == 4 else 0x86DD
+    else:
+        return None
+    if ethertype == 0x0800:
+        return 4, offset
+    if ethertype == 0x86DD:
+        return 6, offset
+    return None
+
+
+def decode_tcp_segment(linktype, packet):
+    """
+    Decodes the TCP segment carried by a captured packet.
+
+    :param linktype: link layer type of the capture
+    :param packet: captured packet data
+    :return: TcpSegment, None if the packet is not a TCP segment
+    (or a fragment of one)
+    """
+    if len(packet) < 20:
+        return None
+    network = _network_layer(linktype, packet)
+    if network is None:
+        return None
+    version, offset = network
+    if version == 4:
+        if len(packet) < offset + 20:
+            return None
+        header_length = (ord(packet[offset:offset + 1]) & 0x0F) * 4
+        total_length, fragment, protocol = struct.unpack_from(
+            '!2xH2xHxB', packet, offset)
+        if protocol != 6 or fragment & 0x3FFF:
+            return None
+        family = socket.AF_INET
+        source = packet[offset + 12:offset + 16]
+        destination = packet[offset + 16:offset + 20]
+        end = min(offset + total_length, len(packet))
+        offset += header_length
+    else:
+        if len(packet) < offset + 40:
+            return None
+        payload_length, next_header = struct.unpack_from(
+            '!4xHB', packet, offset)
+        family = socket.AF_INET6
+        source = packet[offset + 8:offset + 24]
+        destination = packet[offset + 24:offset + 40]
+        end = min(offset + 40 + payload_length, len(packet))
+        offset += 40
+        # Skipping the hop-by-hop, routing and destination options
+        while next_header in (0, 43, 60) and offset + 8 <= end:
+            next_header, length = struct.unpack_from('!BB', packet, offset)
+            offset += (length + 1) * 8
+        if next_header != 6:
+            return None
+    if offset + 20 > end:
+        return None
+    source_port, destination_port, sequence, data_offset, flags = \
+        struct.unpack_from('!HHI4xBB', packet, offset)
+    payload = packet[offset + (data_offset >> 4) * 4:end]
+    return TcpSegment(
+        (socket.inet_ntop(family, source), source_port),
+        (socket.inet_ntop(family, destination), destination_port),
+        sequence, flags, payload)
+
+
+class TcpStream:
+    """
+    One direction of a TCP connection, reassembled into Diameter messages.
+
+    Segments are put back in sequence order, retransmitted data being
+    dropped. When a gap can not be filled (the missing segment was not
+    captured), the message boundaries are lost: the stream then waits
+    for a segment starting with a plausible Diameter header.
+    """
+
+    def __init__(self):
+        self.next_sequence = None
+        self.pending = {}
+        self.framer = DiameterFramer()
+        self.synchronized = True
+
+    def add(self, sequence, flags, payload):
+        """
+        Adds a captured segment.
+
+        :param sequence: TCP sequence number of the segment
+        :param flags: TCP flags of the segment
+        :param payload: TCP payload of the segment
+        :return: list of the messages completed by the segment
+        """
+        if flags & TCP_SYN:
+            self.next_sequence = (sequence + 1) & 0xFFFFFFFF
+            return []
+        if not payload:
+            return []
+        if self.next_sequence is None:
+            # Connection established before the capture started
+            self.next_sequence = sequence
+            self.synchronized = False
+        ahead = (sequence - self.next_sequence) & 0xFFFFFFFF
+        if ahead >= 0x80000000:
+            # Retransmitted data, possibly overlapping new data
+            overlap = (self.next_sequence - sequence) & 0xFFFFFFFF
+            if overlap >= len(payload):
+                return []
+            payload = payload[overlap:]
+        elif ahead:
+            self.pending[sequence] = payload
+            if len(self.pending) <= MAX_PENDING_SEGMENTS:
+                return []
+            # The missing data was not captured, skipping it
+            self.next_sequence = min(
+                self.pending, key=lambda pending: (
+                    pending - self.next_sequence) & 0xFFFFFFFF)
+            payload = self.pending.pop(self.next_sequence)
+            self.framer = DiameterFramer()
+            self.synchronized = False
+        messages = self._append(payload)
+        while self.next_sequence in self.pending:
+            messages.extend(self._append(
+                self.pending.pop(self.next_sequence)))
+        return messages
+
+    def _append(self, payload):
+        self.next_sequence = (self.next_sequence + len(payload)) & 0xFFFFFFFF
+        if not self.synchronized:
+            if not plausible_header(payload):
+                return []
+            self.synchronized = True
+        self.framer.feed(payload)
+        messages = []
+        try:
+            for message in self.framer.messages():
+                messages.append(message.tobytes())
+        except DiameterFramingError:
+            self.framer = DiameterFramer()
+            self.synchronized = False
+        return messages
+
+
+def plausible_header(data):
+    """
+    :param data: bytes expected to start with a Diameter header
+    :return: True if they look like the start of a Diameter message
+    """
+    if len(data) < DIAMETER_HEADER_LENGTH:
+        return False
+    header, flags_code = struct.unpack_from('!II', data, 0)
+    length = header & DIAMETER_MAX_LENGTH
+    return (header >> 24 == 1 and length >= DIAMETER_HEADER_LENGTH
+            and not length & 3 and not (flags_code >> 24) & 0x0F)
+
+
+def iter_messages(data, ports=(DIAMETER_PORT,)):
+    """
+    Reassembles the Diameter messages of a capture's TCP streams.
+
+    :param data: capture contents (mmap, str or bytearray)
+    :param ports: TCP ports of the Diameter connections
+    :return: generator of CapturedMessage, in capture order
+    """
+    streams = {}
+    for packet in iter_packets(data):
+        segment = decode_tcp_segment(packet.linktype, packet.data)
+        if segment is None or (segment.source[1] not in ports
+                               and segment.destination[1] not in ports):
+            continue
+        flow = (segment.source, segment.destination)
+        stream = streams.get(flow)
+        if stream is None:
+            stream = streams[flow] = TcpStream()
+        for message in stream.add(segment.sequence, segment.flags,
+                                  segment.payload):
+            yield CapturedMessage(packet.timestamp, segment.source,
+                                  segment.destination, message)
+        if segment.flags & (TCP_FIN | TCP_RST):
+            del streams[flow]
+
+
+def read_capture(path, ports=(DIAMETER_PORT,)):
+    """
+    Reads the Diameter messages of a capture file,
+    streamed from a memory mapping of the file.
+
+    :param path: path of the pcap or pcapng capture
+    :param ports: TCP ports of the Diameter connections
+    :return: generator of CapturedMessage, in capture order
+    """
+    capture_file, data = map_capture(path)
+    try:
+        for message in iter_messages(data, ports):
+            yield message
+    finally:
+        data.close()
+        capture_file.close()
+
+
+def _checksum(header):
+    total = sum(struct.unpack('!%dH' % (len(header) // 2), header))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+class PcapWriter:
+    """
+    Records Diameter messages into a pcap capture.
+
+    Each message is written as TCP packets (IPv4 or IPv6, LINKTYPE_RAW)
+    of the connection between its source and destination, with
+    consistent sequence numbers, so the capture can be read back by
+    read_capture or dissected by Wireshark.
+
+    The file is opened on the first write. A forked worker process writes
+    into its own file, <name>-<pid><extension>, next to the parent's one.
+    """
+
+    def __init__(self, path, snaplen=262144):
+        """
+        :param path: path of the capture file
+        :param snaplen: largest packet size declared in the capture
+        """
+        self.path = path
+        self.snaplen = snaplen
+        self.lock = threading.Lock()
+        self.creator_pid = os.getpid()
+        self.pid = None
+        self.capture_file = None
+        # Next sequence number of each direction of each connection
+        self.sequences = {}
+        self.identification = 0
+        self.written = 0
+
+    def _open(self):
+        path = self.path
+        if os.getpid() != self.creator_pid:
+            root, extension = os.path.splitext(path)
+            path = '%s-%d%s' % (root, os.getpid(), extension)
+        self.capture_file = open(path, 'wb')
+        self.capture_file.write(struct.pack(
+            '<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, self.snaplen, LINKTYPE_RAW))
+        self.pid = os.getpid()
+        self.sequences = {}
+
+    def _ip_header(self, source, destination, length):
+        self.identification = (self.identification + 1) & 0xFFFF
+        if ':' in source[0]:
+            return struct.pack(
+                '!IHBB16s16s', 6 << 28, length, 6, 64,
+                socket.inet_pton(socket.AF_INET6, source[0]),
+                socket.inet_pton(socket.AF_INET6, destination[0]))
+        header = struct.pack(
+            '!BBHHHBBH4s4s', 0x45, 0, 20 + length, self.identification,
+            0x4000, 64, 6, 0, socket.inet_aton(source[0]),
+            socket.inet_aton(destination[0]))
+        return header[:10] + struct.pack('!H', _checksum(header)) + \
+            header[12:]
+
+    def write_packet(self, timestamp, packet):
+        """
+        Writes a raw IP packet.
+
+        :param timestamp: capture time of the packet, in seconds
+        :param packet: IP packet
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self._open()
+            self._write(timestamp, packet)
+
+    def _write(self, timestamp, packet):
+        seconds = int(timestamp)
+        self.capture_file.write(struct.pack(
+            '<IIII', seconds, int((timestamp - seconds) * 1000000),
+            len(packet), len(packet)))
+        self.capture_file.write(packet)
+
+    def write_message(self, source, destination, message, timestamp=None):
+        """
+        Writes a Diameter message sent over a TCP connection.
+
+        :param source: (address, port) of the sender
+        :param destination: (address, port) of the receiver
+        :param message: encoded Diameter message
+        :param timestamp: time the message was sent, time.time() by default
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        message = bytes(bytearray(message))
+        with self.lock:
+            if self.pid != os.getpid():
+                self._open()
+            flow = (source, destination)
+            sequence = self.sequences.get(flow, 1)
+            acknowledged = self.sequences.get((destination, source), 1)
+            for offset in range(0, len(message), MAX_SEGMENT_SIZE):
+                payload = message[offset:offset + MAX_SEGMENT_SIZE]
+                tcp_header = struct.pack(
+                    '!HHIIBBHHH', source[1], destination[1], sequence,
+                    acknowledged, 5 << 4, TCP_PSH | TCP_ACK, 65535, 0, 0)
+                self._write(timestamp, self._ip_header(
+                    source, destination, len(tcp_header) + len(payload))
+                    + tcp_header + payload)
+                sequence = (sequence + len(payload)) & 0xFFFFFFFF
+            self.sequences[flow] = sequence
+            self.written += 1
+
+    def flush(self):
+        with self.lock:
+            if self.capture_file is not None and self.pid == os.getpid():
+                self.capture_file.flush()
+
+    def close(self):
+        """
+        Closes the capture file of the current process.
+        """
+        with self.lock:
+            if self.capture_file is not None and self.pid == os.getpid():
+                self.capture_file.close()
+            self.capture_file = None
+            self.pid = None
+
+
+def is_request(message):
+    """
+    :param message: encoded Diameter message
+    :return: True if the message is a request
+    """
+    return bool(ord(message[4:5]) & 0x80)
+
+
+class ReplayConnection:
+    """
+    Connection to the replay target, standing for one captured connection.
+    Answers are read and counted by a reader thread.
+    """
+
+    def __init__(self, host, port, timeout):
+        self.socket = socket.create_connection((host, port), timeout)
+        self.socket.settimeout(None)
+        self.answers = 0
+        self.reader = threading.Thread(target=self.read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read(self):
+        framer = DiameterFramer()
+        while True:
+            try:
+                if framer.recv_from(self.socket) == 0:
+                    break
+                for message in framer.messages():
+                    self.answers += 1
+            except (socket.error, DiameterFramingError):
+                break
+
+    def send(self, message):
+        self.socket.sendall(message)
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        self.reader.join(5.0)
+        self.socket.close()
+
+
+def replay(messages, host='127.0.0.1', port=DIAMETER_PORT, speed=1.0,
+           connect_timeout=10.0, answer_timeout=5.0):
+    """
+    Sends captured requests to a target, each captured connection
+    being replayed over its own connection to the target.
+
+    :param messages: CapturedMessage iterable, e.g. from read_capture
+    :param host: host of the target
+    :param port: port of the target
+    :param speed: timing multiplier, 2.0 replaying twice as fast as
+    captured, 0 sending as fast as possible
+    :param connect_timeout: seconds to wait for each connection
+    :param answer_timeout: seconds to wait for the answers once the
+    last request is sent
+    :return: dictionary with the replay statistics
+    """
+    connections = {}
+    sent = 0
+    late = 0.0
+    first_timestamp = None
+    started = time.time()
+    try:
+        for captured in messages:
+            if not is_request(captured.message):
+                continue
+            if first_timestamp is None:
+                first_timestamp = captured.timestamp
+                started = time.time()
+            if speed > 0:
+                due = started + (captured.timestamp - first_timestamp) / speed
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    late = max(late, -delay)
+            flow = (captured.source, captured.destination)
+            connection = connections.get(flow)
+            if connection is None:
+                connection = connections[flow] = ReplayConnection(
+                    host, port, connect_timeout)
+            connection.send(captured.message)
+            sent += 1
+        deadline = time.time() + answer_timeout
+        while sum(c.answers for c in connections.values()) < sent and \
+                time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        for connection in connections.values():
+            connection.close()
+    duration = time.time() - started
+    return {
+        'sent': sent,
+        'answered': sum(c.answers for c in connections.values()),
+        'connections': len(connections),
+        'duration': duration,
+        'max_late_seconds': late,
+    }
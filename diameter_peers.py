@@ -0,0 +1,927 @@
+"""
+Peer table of a Diameter client (RFC 6733), sending requests over
+several connections to each of its peers.
+
+Contains:
+- peers with several transport connections each, every connection
+  being opened with a Capabilities Exchange (CER/CEA)
+- least outstanding balancing: a request is sent on the open connection
+  with the fewest requests waiting for their answer
+- RFC 3539 watchdog of every connection: a DWR is sent after Tw seconds
+  without any message received, the connection is suspect when the DWR
+  is not answered within Tw, and closed (then reconnected) when it
+  still is not after another Tw
+- failover: the requests pending on a failed or suspect connection are
+  sent again on another open connection, with the T flag set
+
+A single scheduler thread reads the messages of every connection and
+runs all the timers (request deadlines, watchdogs and reconnections),
+so the number of threads does not grow with the number of peers.
+"""
+
+import os
+from diameter_client import *
+
+# Connection states
+CLOSED = 'closed'
+# Connected, waiting for the Capabilities-Exchange-Answer
+CONNECTING = 'connecting'
+OPEN = 'open'
+# Watchdog not answered, no new requests are sent on the connection
+SUSPECT = 'suspect'
+
+# Tw is randomized by up to this many seconds (RFC 3539 section 3.4.1)
+WATCHDOG_JITTER = 2.0
+
+
+class PeerRequest(PendingRequest):
+    """
+    Request sent through the peer table, keeping its encoded message
+    so it can be sent again on another connection.
+    """
+
+    def __init__(self, message, hop_by_hop, end_to_end, timeout,
+                 callback=None, peer=None, failover=True):
+        """
+        :param message: encoded request
+        :param hop_by_hop: Hop-by-Hop identifier of the request
+        :param end_to_end: End-to-End identifier of the request
+        :param timeout: seconds to wait for the answer
+        :param callback: function called with this object once completed
+        :param peer: Peer the request is sent to, None for any peer
+        :param failover: False for requests bound to their connection
+        (CER, DWR), which are failed instead of being sent again
+        """
+
+        PendingRequest.__init__(self, hop_by_hop, end_to_end, timeout,
+                                callback)
+        self.message = message
+        self.peer = peer
+        self.failover = failover
+        self.failovers = 0
+        # PeerConnection the request was last sent on
+        self.connection = None
+
+
+class PeerConnection:
+    """
+    Transport connection to a peer, with its watchdog state.
+    """
+
+    def __init__(self, peer, index):
+        """
+        :param peer: Peer the connection belongs to
+        :param index: number of the connection among the peer's ones
+        """
+
+        self.peer = peer
+        self.index = index
+        self.state = CLOSED
+        self.socket = None
+        self.framer = None
+        # Incremented whenever the connection closes,
+        # the timers of a previous connection being then ignored
+        self.generation = 0
+        # Hop-by-Hop identifiers of the requests waiting for their answer
+        self.pending = set()
+        self.send_lock = threading.Lock()
+        # Watchdog: time of its last reset, current Tw,
+        # and whether a DWR is waiting for its answer
+        self.watchdog_reset = 0.0
+        self.watchdog_interval = 0.0
+        self.watchdog_pending = False
+
+    def outstanding(self):
+        """
+        :return: number of requests waiting for their answer
+        """
+        return len(self.pending)
+
+
+class Peer:
+    """
+    Diameter peer of the table, reached over several connections.
+    """
+
+    def __init__(self, host, port, connections):
+        """
+        :param host: peer host address
+        :param port: peer port
+        :param connections: number of connections to the peer
+        """
+
+        self.host = host
+        self.port = port
+        self.name = '%s:%d' % (host, port)
+        self.connections = [PeerConnection(self, index)
+                            for index in range(connections)]
+        # AVPs of the last Capabilities-Exchange-Answer of the peer
+        self.capabilities = None
+
+    def open_connections(self):
+        """
+        :return: list of the connections requests can be sent on
+        """
+        return [connection for connection in self.connections
+                if connection.state == OPEN]
+
+
+class PeerTable:
+    """
+    Peers of a Diameter client, and the scheduler serving
+    all their connections.
+    """
+
+    def __init__(self,
+                 origin_host='client.asn.test',
+                 origin_realm='asn.test',
+                 request_timeout=10.0,
+                 watchdog_interval=30.0,
+                 connect_timeout=5.0,
+                 reconnect_interval=5.0,
+                 max_failovers=1):
+        """
+        :param origin_host: Diameter Origin Host
+        :param origin_realm: Diameter Origin Realm
+        :param request_timeout: default seconds to wait for an answer
+        :param watchdog_interval: Tw, seconds without any message received
+        before a DWR is sent (RFC 3539 recommends 30, and at least 6)
+        :param connect_timeout: seconds to wait for the TCP connection,
+        and then for the CEA
+        :param reconnect_interval: seconds between connection attempts
+        :param max_failovers: number of times a request may be sent again
+        on another connection
+        """
+
+        self.origin_host = origin_host
+        self.origin_realm = origin_realm
+        self.request_timeout = request_timeout
+        self.watchdog_interval = watchdog_interval
+        self.connect_timeout = connect_timeout
+        self.reconnect_interval = reconnect_interval
+        self.max_failovers = max_failovers
+        self.origin_state_id = int(time.time())
+        self.peers = []
+
+        # Pending requests by Hop-by-Hop, and their deadlines
+        self.pending = {}
+        self.deadlines = []
+        # Timers, as (time, sequence, function, arguments)
+        self.timers = []
+        self.timer_sequence = itertools.count()
+        # Connections read by the scheduler, by socket
+        self.sockets = {}
+        # Rotates the first connection considered by the balancing,
+        # spreading the requests over equally loaded connections
+        self.rotation = itertools.count()
+        self.lock = threading.Lock()
+        self.opened = threading.Condition(self.lock)
+        self.running = False
+        self.scheduler = None
+        self.wakeup_pipe = None
+        self.wakeup_sent = False
+
+        # Same identifiers as the DiameterClient ones
+        self.hop_by_hop = itertools.count(random.randint(0, 0xFFFFFFFF))
+        self.end_to_end = itertools.count(
+            ((int(time.time()) & 0xFFF) << 20) | random.randint(0, 0xFFFFF))
+
+    def next_hop_by_hop(self):
+        """
+        :return: a new Hop-by-Hop identifier
+        """
+        return next(self.hop_by_hop) & 0xFFFFFFFF
+
+    def next_end_to_end(self):
+        """
+        :return: a new End-to-End identifier
+        """
+        return next(self.end_to_end) & 0xFFFFFFFF
+
+    def add_peer(self, host, port=3868, connections=1):
+        """
+        Adds a peer, connected to at once if the table is started.
+
+        :param host: peer host address
+        :param port: peer port
+        :param connections: number of connections to open to the peer
+        :return: the Peer, to send requests to it specifically
+        """
+
+        peer = Peer(host, port, connections)
+        with self.lock:
+            self.peers.append(peer)
+            if self.running:
+                for connection in peer.connections:
+                    self.schedule(time.time(), self.connect, connection,
+                                  connection.generation)
+        return peer
+
+    def start(self):
+        """
+        Loads the Diameter dictionary, starts the scheduler thread
+        and connects to the peers.
+        """
+
+        LoadDictionary("dictDiameter.xml")
+        self.wakeup_pipe = os.pipe()
+        with self.lock:
+            self.running = True
+            for peer in self.peers:
+                for connection in peer.connections:
+                    self.schedule(time.time(), self.connect, connection,
+                                  connection.generation)
+        self.scheduler = threading.Thread(target=self.run,
+                                          name='diameter-peers')
+        self.scheduler.daemon = True
+        self.scheduler.start()
+
+    def wait_open(self, peer=None, timeout=None):
+        """
+        Waits until a connection is open.
+
+        :param peer: Peer whose connection to wait for, None for any peer
+        :param timeout: seconds to wait, None to wait forever
+        :return: True if a connection is open
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        peers = self.peers if peer is None else [peer]
+        with self.opened:
+            while not any(candidate.open_connections()
+                          for candidate in list(peers)):
+                if deadline is None:
+                    self.opened.wait(1.0)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.opened.wait(remaining)
+        return True
+
+    def send_request(self, header, avps, peer=None, callback=None,
+                     timeout=None):
+        """
+        Sends a Diameter Request without waiting for its answer,
+        on the open connection with the fewest outstanding requests.
+
+        :param header: Diameter message header
+        :param avps: Diameter message's AVPs, binary encoded
+        :param peer: Peer to send the request to, None for any peer
+        :param callback: function called with the PeerRequest once the
+        answer is received or the request fails. It runs in the
+        scheduler thread, so it should not block.
+        :param timeout: seconds to wait for the answer
+        :return: PeerRequest, completed when the answer is received
+        """
+
+        if timeout is None:
+            timeout = self.request_timeout
+        header.HopByHop = self.next_hop_by_hop()
+        if not header.EndToEnd:
+            header.EndToEnd = self.next_end_to_end()
+        request = PeerRequest(createReqBin(header, avps), header.HopByHop,
+                              header.EndToEnd, timeout, callback, peer)
+        with self.lock:
+            self.pending[request.hop_by_hop] = request
+            heapq.heappush(self.deadlines,
+                           (request.deadline, request.hop_by_hop))
+        if not self.transmit(request):
+            with self.lock:
+                self.pending.pop(request.hop_by_hop, None)
+            request.complete(error=DiameterConnectionClosed(
+                "No open connection to %s"
+                % ('any peer' if peer is None else peer.name)))
+        return request
+
+    def exchange(self, header, avps, peer=None):
+        """
+        Sends a Diameter Request and waits for its answer.
+
+        :param header: Diameter message header
+        :param avps: Diameter message's AVPs, binary encoded
+        :param peer: Peer to send the request to, None for any peer
+        :return: dictionary containing the response AVPs
+        """
+        return self.send_request(header, avps, peer).result().avps
+
+    def outstanding(self):
+        """
+        :return: number of requests waiting for their answer
+        """
+        return len(self.pending)
+
+    def status(self):
+        """
+        :return: list of (peer name, connection number, state,
+        outstanding requests) tuples, one per connection
+        """
+        with self.lock:
+            return [(peer.name, connection.index, connection.state,
+                     len(connection.pending))
+                    for peer in self.peers
+                    for connection in peer.connections]
+
+    def select_connection(self, peer=None):
+        """
+        Least outstanding balancing, to be called holding the lock.
+
+        :param peer: Peer whose connections are considered, None for all
+        :return: open PeerConnection with the fewest outstanding requests,
+        None if there is no open connection
+        """
+
+        if peer is None:
+            connections = [connection for candidate in self.peers
+                           for connection in candidate.connections]
+        else:
+            connections = peer.connections
+        count = len(connections)
+        if not count:
+            return None
+        first = next(self.rotation) % count
+        selected = None
+        for index in range(first, first + count):
+            connection = connections[index % count]
+            if connection.state == OPEN and (
+                    selected is None
+                    or len(connection.pending) < len(selected.pending)):
+                selected = connection
+        return selected
+
+    def transmit(self, request, retransmission=False):
+        """
+        Sends a pending request on the least loaded open connection.
+
+        :param request: PeerRequest, already in the pending requests
+        :param retransmission: True when failing the request over,
+        to set its T flag (potentially retransmitted message)
+        :return: False if there is no open connection to send it on.
+        A failed send is handled as the failure of the connection,
+        which fails the request over.
+        """
+
+        with self.lock:
+            connection = self.select_connection(request.peer)
+            if connection is None:
+                return False
+            if retransmission:
+                request.failovers += 1
+                request.message[4] |= DIAMETER_HDR_RETRANSMIT
+            connection.pending.add(request.hop_by_hop)
+            request.connection = connection
+            generation = connection.generation
+        self.send_message(connection, generation, request.message)
+        return True
+
+    def send_on(self, connection, generation, header, avps, timeout,
+                callback=None):
+        """
+        Sends a request bound to a connection (CER, DWR).
+
+        :param connection: PeerConnection to send the request on
+        :param generation: generation of the connection
+        :param header: Diameter message header
+        :param avps: Diameter message's AVPs, binary encoded
+        :param timeout: seconds to wait for the answer
+        :param callback: function called with the completed PeerRequest
+        """
+
+        header.HopByHop = self.next_hop_by_hop()
+        header.EndToEnd = self.next_end_to_end()
+        request = PeerRequest(createReqBin(header, avps), header.HopByHop,
+                              header.EndToEnd, timeout, callback,
+                              connection.peer, failover=False)
+        request.connection = connection
+        with self.lock:
+            if connection.generation != generation:
+                return
+            self.pending[request.hop_by_hop] = request
+            connection.pending.add(request.hop_by_hop)
+            heapq.heappush(self.deadlines,
+                           (request.deadline, request.hop_by_hop))
+        self.send_message(connection, generation, request.message)
+
+    def send_message(self, connection, generation, message):
+        """
+        Writes a message on a connection. On failure, the connection
+        is shut down, for the scheduler to close it.
+
+        :param connection: PeerConnection to write on
+        :param generation: generation of the connection the message
+        is meant for, nothing being sent on a later one
+        :param message: encoded message
+        :return: True if the message was sent
+        """
+
+        with self.lock:
+            if connection.generation != generation \
+                    or connection.socket is None:
+                return False
+            sock = connection.socket
+        try:
+            with connection.send_lock:
+                sock.sendall(message)
+            return True
+        except socket.error as error:
+            logging.warning("Sending to peer %s failed: %s",
+                            connection.peer.name, error)
+            self.abort(connection, generation)
+            return False
+
+    def abort(self, connection, generation):
+        """
+        Shuts a connection down, from any thread: the scheduler then
+        reads the end of the connection and closes it.
+
+        :param connection: PeerConnection to shut down
+        :param generation: generation of the connection
+        """
+
+        with self.lock:
+            if connection.generation != generation \
+                    or connection.socket is None:
+                return
+            try:
+                connection.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def schedule(self, when, function, *args):
+        """
+        Adds a timer, run by the scheduler thread.
+        To be called holding the lock.
+
+        :param when: time to run the timer at
+        :param function: function to run
+        :param args: arguments of the function
+        """
+
+        heapq.heappush(self.timers,
+                       (when, next(self.timer_sequence), function, args))
+        if self.timers[0][0] == when:
+            self.wakeup()
+
+    def wakeup(self):
+        """
+        Wakes the scheduler up, to read a new connection or
+        run an earlier timer. To be called holding the lock.
+        """
+
+        if self.wakeup_pipe is not None and not self.wakeup_sent:
+            self.wakeup_sent = True
+            os.write(self.wakeup_pipe[1], b'x')
+
+    def run(self):
+        """
+        Scheduler loop: reads the messages of every connection
+        and runs the timers.
+        """
+
+        wakeup = self.wakeup_pipe[0]
+        while True:
+            wait = self.run_timers()
+            with self.lock:
+                if not self.running:
+                    break
+                sockets = dict(self.sockets)
+            try:
+                readable = select.select(
+                    list(sockets) + [wakeup], [], [], wait)[0]
+            except (select.error, socket.error) as error:
+                # A socket closed meanwhile, the next loop skips it
+                logging.debug("Waiting for the peers failed: %s", error)
+                continue
+            for sock in readable:
+                if sock == wakeup:
+                    os.read(wakeup, 4096)
+                    with self.lock:
+                        self.wakeup_sent = False
+                elif sockets[sock].socket is sock:
+                    self.read(sockets[sock])
+        self.shutdown()
+
+    def run_timers(self):
+        """
+        Runs the due timers and fails the requests whose deadline passed.
+
+        :return: seconds until the next timer or deadline
+        (at most one second)
+        """
+
+        now = time.time()
+        due = []
+        expired = []
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                when, sequence, function, args = heapq.heappop(self.timers)
+                due.append((function, args))
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, hop_by_hop = heapq.heappop(self.deadlines)
+                request = self.pending.get(hop_by_hop)
+                if request is not None and request.deadline == deadline:
+                    del self.pending[hop_by_hop]
+                    if request.connection is not None:
+                        request.connection.pending.discard(hop_by_hop)
+                    expired.append(request)
+        for function, args in due:
+            try:
+                function(*args)
+            except Exception:
+                logging.exception("Peer table timer failed")
+        for request in expired:
+            request.complete(error=DiameterTimeout(
+                "No answer for Hop-by-Hop %d" % request.hop_by_hop))
+
+        wait = 1.0
+        with self.lock:
+            if self.timers:
+                wait = min(wait, self.timers[0][0] - now)
+            if self.deadlines:
+                wait = min(wait, self.deadlines[0][0] - now)
+        return max(wait, 0.0)
+
+    def read(self, connection):
+        """
+        Reads the received messages of a connection.
+
+        :param connection: readable PeerConnection
+        """
+
+        try:
+            if connection.framer.recv_from(connection.socket) == 0:
+                self.connection_failed(connection,
+                                       "Connection closed by peer")
+                return
+            for message in connection.framer.messages():
+                self.receive(connection, message)
+        except (socket.error, DiameterFramingError) as failure:
+            self.connection_failed(connection, str(failure))
+
+    def receive(self, connection, message):
+        """
+        Handles a received message: answers complete their request,
+        and watchdog requests of the peer are answered.
+        Any message resets the connection's watchdog.
+
+        :param connection: PeerConnection the message was received on
+        :param message: received Diameter message
+        """
+
+        header = HDRItem()
+        stripHdrBin(header, message)
+        request = None
+        with self.lock:
+            connection.watchdog_reset = time.time()
+            if connection.state == SUSPECT:
+                logging.info("Connection %d to peer %s is back",
+                             connection.index, connection.peer.name)
+                connection.state = OPEN
+                self.opened.notify_all()
+            if not header.flags & DIAMETER_HDR_REQUEST:
+                if header.cmd == diameter_base.cmd_codes['Device-Watchdog']:
+                    connection.watchdog_pending = False
+                request = self.pending.pop(header.HopByHop, None)
+                if request is not None:
+                    request.connection.pending.discard(header.HopByHop)
+
+        if header.flags & DIAMETER_HDR_REQUEST:
+            self.answer_request(connection, header)
+        elif request is None:
+            logging.warning("Answer for unknown Hop-by-Hop %d from peer %s",
+                            header.HopByHop, connection.peer.name)
+        else:
+            # The message is a view over the framer buffer, overwritten
+            # by the next read, while the answer is kept by the caller
+            answer = HDRItem()
+            stripHdrBin(answer, memoryview(message).tobytes())
+            request.complete(diameter_base.DiameterMessage(answer))
+
+    def answer_request(self, connection, header):
+        """
+        Answers the Device Watchdog Requests of a peer,
+        other requests being ignored.
+
+        :param connection: PeerConnection the request was received on
+        :param header: HDRItem of the received request
+        """
+
+        if header.cmd != diameter_base.cmd_codes['Device-Watchdog']:
+            logging.warning("Ignoring request %d received from peer %s",
+                            header.cmd, connection.peer.name)
+            return
+        try:
+            answer = generate_device_watchdog_answer(
+                diameter_base.DiameterMessage(header),
+                self.origin_host, self.origin_realm)
+        except KeyError as error:
+            logging.warning("Invalid watchdog request from peer %s: "
+                            "missing %s", connection.peer.name, error)
+            return
+        self.send_message(connection, connection.generation, answer)
+
+    def connect(self, connection, generation):
+        """
+        Timer opening a connection, from a separate short-lived thread
+        so that the scheduler does not wait for the TCP handshake.
+
+        :param connection: closed PeerConnection
+        :param generation: generation of the connection
+        """
+
+        with self.lock:
+            if not self.running or connection.generation != generation \
+                    or connection.state != CLOSED:
+                return
+            connection.state = CONNECTING
+        connector = threading.Thread(
+            target=self.open_connection, args=(connection, generation),
+            name='diameter-connect-%s' % connection.peer.name)
+        connector.daemon = True
+        connector.start()
+
+    def open_connection(self, connection, generation):
+        """
+        Connects to the peer, and starts the Capabilities Exchange.
+
+        :param connection: PeerConnection being connected
+        :param generation: generation of the connection
+        """
+
+        peer = connection.peer
+        try:
+            sock = socket.create_connection((peer.host, peer.port),
+                                            self.connect_timeout)
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error as error:
+            logging.warning("Connecting to peer %s failed: %s",
+                            peer.name, error)
+            with self.lock:
+                if connection.generation == generation:
+                    self.closed(connection)
+            return
+
+        with self.lock:
+            if not self.running or connection.generation != generation:
+                sock.close()
+                return
+            connection.socket = sock
+            connection.framer = DiameterFramer()
+            self.sockets[sock] = connection
+            self.wakeup()
+
+        header = HDRItem()
+        header.cmd = diameter_base.cmd_codes['Capability-Exchange']
+        self.send_on(connection, generation, header,
+                     self.capabilities_exchange_avps(sock),
+                     self.connect_timeout,
+                     lambda request: self.capabilities_answered(
+                         request, connection, generation))
+
+    def capabilities_exchange_avps(self, sock):
+        """
+        :param sock: socket of the connection
+        :return: AVPs of the CER, binary encoded
+        """
+
+        return [
+            encodeAVPBin('Origin-Host', self.origin_host),
+            encodeAVPBin('Origin-Realm', self.origin_realm),
+            encodeAVPBin('Host-IP-Address', sock.getsockname()[0]),
+            encodeAVPBin('Vendor-Id',
+                         diameter_base.standard_avp_values['Vendor-Id']),
+            encodeAVPBin('Product-Name',
+                         diameter_base.standard_avp_values['Product-Name']),
+            encodeAVPBin('Origin-State-Id', self.origin_state_id),
+            encodeAVPBin(
+                'Supported-Vendor-Id',
+                diameter_base.standard_avp_values['Supported-Vendor-Id']),
+            encodeAVPBin(
+                'Acct-Application-Id',
+                diameter_base.standard_avp_values['Acct-Application-Id']),
+        ]
+
+    def capabilities_answered(self, request, connection, generation):
+        """
+        Opens the connection on a successful CEA, closes it otherwise.
+
+        :param request: completed CER PeerRequest
+        :param connection: PeerConnection the CER was sent on
+        :param generation: generation of the connection
+        """
+
+        result_code = None
+        if request.error is None:
+            result_code = request.answer.avps.get('Result-Code')
+        if result_code != diameter_base.result_codes['DIAMETER_SUCCESS']:
+            logging.warning("Capabilities exchange with peer %s failed: %s",
+                            connection.peer.name,
+                            request.error or result_code)
+            self.abort(connection, generation)
+            return
+        with self.lock:
+            if connection.generation != generation \
+                    or connection.state != CONNECTING:
+                return
+            connection.state = OPEN
+            connection.peer.capabilities = request.answer.avps
+            connection.watchdog_reset = time.time()
+            connection.watchdog_pending = False
+            self.schedule_watchdog(connection)
+            self.opened.notify_all()
+        logging.info("Connection %d to peer %s open",
+                     connection.index, connection.peer.name)
+
+    def schedule_watchdog(self, connection):
+        """
+        Sets the watchdog timer of a connection, Tw after its last reset.
+        To be called holding the lock.
+
+        :param connection: open PeerConnection
+        """
+
+        connection.watchdog_interval = max(
+            self.watchdog_interval
+            + random.uniform(-WATCHDOG_JITTER, WATCHDOG_JITTER),
+            self.watchdog_interval / 2.0)
+        self.schedule(
+            connection.watchdog_reset + connection.watchdog_interval,
+            self.watchdog, connection, connection.generation)
+
+    def watchdog(self, connection, generation):
+        """
+        Watchdog timer of a connection (RFC 3539 section 3.4).
+
+        Received messages only move the time of the last reset, the timer
+        being set again for the remaining time when it is due early.
+
+        :param connection: PeerConnection
+        :param generation: generation of the connection
+        """
+
+        now = time.time()
+        send = False
+        suspect = False
+        down = False
+        requests = []
+        with self.lock:
+            if connection.generation != generation \
+                    or connection.socket is None:
+                return
+            due = connection.watchdog_reset + connection.watchdog_interval
+            if due > now:
+                self.schedule(due, self.watchdog, connection, generation)
+                return
+            if connection.state == SUSPECT:
+                down = True
+            elif connection.watchdog_pending:
+                # Failover: the connection gets no requests while suspect
+                connection.state = SUSPECT
+                suspect = True
+                requests = self.take_pending(connection)
+            else:
+                connection.watchdog_pending = True
+                send = True
+            if not down:
+                connection.watchdog_reset = now
+                self.schedule_watchdog(connection)
+
+        if down:
+            self.connection_failed(connection, "Watchdog not answered")
+            return
+        if suspect:
+            logging.warning("Connection %d to peer %s is suspect",
+                            connection.index, connection.peer.name)
+            self.failover(requests, connection, keep=True)
+        if send:
+            header = HDRItem()
+            header.cmd = diameter_base.cmd_codes['Device-Watchdog']
+            self.send_on(connection, generation, header, [
+                encodeAVPBin('Origin-Host', self.origin_host),
+                encodeAVPBin('Origin-Realm', self.origin_realm),
+                encodeAVPBin('Origin-State-Id', self.origin_state_id),
+            ], connection.watchdog_interval)
+
+    def take_pending(self, connection):
+        """
+        Removes the pending requests of a connection from it.
+        To be called holding the lock.
+
+        :param connection: PeerConnection
+        :return: list of the PeerRequests pending on the connection
+        """
+
+        requests = [self.pending[hop_by_hop]
+                    for hop_by_hop in connection.pending
+                    if hop_by_hop in self.pending]
+        connection.pending = set()
+        return requests
+
+    def failover(self, requests, connection, keep=False):
+        """
+        Sends the requests of a failed connection again on other open
+        connections, with the T flag set (potentially retransmitted
+        message).
+
+        :param requests: PeerRequests pending on the connection
+        :param connection: the failed or suspect PeerConnection
+        :param keep: True to leave the requests which can not be sent
+        again waiting on the (suspect) connection, they fail otherwise
+        """
+
+        for request in requests:
+            if request.failover and request.failovers < self.max_failovers \
+                    and self.transmit(request, retransmission=True):
+                continue
+            with self.lock:
+                if keep and request.hop_by_hop in self.pending:
+                    connection.pending.add(request.hop_by_hop)
+                    continue
+                if self.pending.pop(request.hop_by_hop, None) is None:
+                    # Answered meanwhile
+                    continue
+            request.complete(error=DiameterConnectionClosed(
+                "Connection to peer %s lost" % connection.peer.name))
+
+    def closed(self, connection):
+        """
+        Marks a connection closed, and schedules its reconnection.
+        To be called holding the lock.
+
+        :param connection: PeerConnection
+        """
+
+        connection.state = CLOSED
+        connection.generation += 1
+        connection.watchdog_pending = False
+        if self.running:
+            self.schedule(time.time() + self.reconnect_interval,
+                          self.connect, connection, connection.generation)
+
+    def connection_failed(self, connection, reason):
+        """
+        Closes a failed connection, failing its pending requests over.
+        Only called by the scheduler thread, the one reading the sockets.
+
+        :param connection: failed PeerConnection
+        :param reason: description of the failure
+        """
+
+        with self.lock:
+            sock = connection.socket
+            if sock is None:
+                return
+            connection.socket = None
+            connection.framer = None
+            self.sockets.pop(sock, None)
+            requests = self.take_pending(connection)
+            self.closed(connection)
+        logging.warning("Connection %d to peer %s closed: %s",
+                        connection.index, connection.peer.name, reason)
+        sock.close()
+        self.failover(requests, connection)
+
+    def shutdown(self):
+        """
+        Closes every connection, failing the pending requests.
+        Run by the scheduler thread when the table is closed.
+        """
+
+        with self.lock:
+            sockets = list(self.sockets)
+            self.sockets = {}
+            for peer in self.peers:
+                for connection in peer.connections:
+                    connection.socket = None
+                    connection.framer = None
+                    connection.pending = set()
+                    connection.state = CLOSED
+                    connection.generation += 1
+            requests = self.pending.values()
+            self.pending = {}
+            self.deadlines = []
+            self.timers = []
+            wakeup_pipe = self.wakeup_pipe
+            self.wakeup_pipe = None
+        for sock in sockets:
+            sock.close()
+        for request in requests:
+            request.complete(error=DiameterConnectionClosed(
+                "Peer table closed"))
+        os.close(wakeup_pipe[0])
+        os.close(wakeup_pipe[1])
+
+    def close(self):
+        """
+        Stops the scheduler, closing the connections to the peers
+        and failing the requests still waiting for an answer.
+        """
+
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            self.wakeup()
+        self.scheduler.join()
+        self.scheduler = None
@@ -7,10 +7,78 @@ which is later customized for the specific command code.
 """
 
 import diameter_base
+from diameter_accounting import *
+from diameter_cdr import *
+from diameter_credit_control import *
+from diameter_templates import *
 from libDiameter import *
 
 logging.getLogger().setLevel(logging.INFO)
 
+# Open accounting sessions of the server
+accounting_sessions = SessionStore()
+
+# Subscriber balances and open credit control sessions of the server
+credit_sessions = CreditControlStore()
+
+# CDRWriter the completed accounting records are sent to, if any
+cdr_writer = None
+
+# Answer templates, by (answer kind, origin host, origin realm)
+answer_templates = {}
+
+
+def get_answer_template(kind, origin_host, origin_realm):
+    """
+    Returns the template of an answer sent by the given server,
+    creating it the first time it is needed.
+
+    The answers start with the server's Origin-Host and Origin-Realm
+    (pre-encoded), followed by the request's origin as Destination-Host
+    and Destination-Realm (written at render time) and the Result-Code.
+
+    :param kind: 'watchdog' for DWA, 'watchdog-stateless' for DWA
+    answering a DWR without Origin-State-Id, 'invalid' for invalid
+    request answers
+    :param origin_host: Diameter Server's origin host
+    :param origin_realm: Diameter Server's origin realm
+    :return: MessageTemplate of the answer
+    """
+    key = (kind, origin_host, origin_realm)
+    template = answer_templates.get(key)
+    if template is None:
+        avps = [
+            ('Origin-Host', origin_host),
+            ('Origin-Realm', origin_realm),
+            ('Destination-Host', SLOT),
+            ('Destination-Realm', SLOT),
+        ]
+        if kind in ('watchdog', 'watchdog-stateless'):
+            avps.append(('Result-Code',
+                         diameter_base.result_codes['DIAMETER_SUCCESS']))
+            if kind == 'watchdog':
+                avps.append(('Origin-State-Id', SLOT))
+            command_code = diameter_base.cmd_codes['Device-Watchdog']
+        else:
+            avps.append(('Result-Code',
+                         diameter_base.result_codes[
+                             'DIAMETER_UNABLE_TO_COMPLY']))
+            command_code = 0
+        template = MessageTemplate(command_code, avps)
+        answer_templates[key] = template
+    return template
+
+
+def template_values(diameter_request):
+    """
+    :param diameter_request: request for which we're building the response
+    :return: values of the answer template slots, taken from the request
+    """
+    return {
+        'Destination-Host': diameter_request.avps['Origin-Host'],
+        'Destination-Realm': diameter_request.avps['Origin-Realm'],
+    }
+
 
 def generate_generic_diameter_message(diameter_request,
                                       origin_host,
@@ -37,13 +105,13 @@ def generate_generic_diameter_message(diameter_request,
     response_avps = list()
 
     # Adding server's origin host and realm
-    response_avps.append(encodeAVP('Origin-Host', origin_host))
-    response_avps.append(encodeAVP('Origin-Realm', origin_realm))
+    response_avps.append(encodeAVPBin('Origin-Host', origin_host))
+    response_avps.append(encodeAVPBin('Origin-Realm', origin_realm))
 
     # Setting as the destination host and realm request's origin
-    response_avps.append(encodeAVP(
+    response_avps.append(encodeAVPBin(
         'Destination-Host', diameter_request.avps['Origin-Host']))
-    response_avps.append(encodeAVP(
+    response_avps.append(encodeAVPBin(
         'Destination-Realm', diameter_request.avps['Origin-Realm']))
 
     # returning the generic Diameter response
@@ -74,27 +142,27 @@ def generate_capability_exchange_answer(diameter_request,
     cea_avps = generic_response['avps']
 
     # Customizing it for Capability Exchange Answer
-    cea_avps.append(encodeAVP(
+    cea_avps.append(encodeAVPBin(
         'Result-Code', diameter_base.result_codes['DIAMETER_SUCCESS']))
 
     # Iterating over the request's AVPs and adding them to the response
-    for attribute, value in diameter_request.avps.items():
+    for attribute, value in diameter_request.avps.allitems():
         # Grouped AVPs handling
-        if isinstance(value, list):
+        if isinstance(value, (list, diameter_base.LazyAVPGroup)):
             values = []
             # Handling each AVP from the group
             for group in value:
-                values.append(encodeAVP(group[0], group[1]))
+                values.append(encodeAVPBin(group[0], group[1]))
             # After creating the list of AVPs
             # add them as a grouped AVP under the response
-            cea_avps.append((encodeAVP(attribute, values)))
+            cea_avps.append((encodeAVPBin(attribute, values)))
         # Standard AVPs handling
         else:
             if attribute != 'Origin-Host' and attribute != 'Origin-Realm':
-                cea_avps.append((encodeAVP(attribute, value)))
+                cea_avps.append((encodeAVPBin(attribute, value)))
 
     # Create the Diameter response message by joining the header and the AVPs
-    cea_message = createRes(cea_header, cea_avps)
+    cea_message = createResBin(cea_header, cea_avps)
     return cea_message
 
 
@@ -105,27 +173,317 @@ def generate_device_watchdog_answer(diameter_request,
     Method used with the purpose of handling DWR requests
     and sending DWA responses.(Device Watchdog)
 
-    Builds the DWA message, the header and AVPs list separately,
-    then create a Diameter response based on them.
+    The DWA only differs between requests by the request's origin
+    and Origin-State-Id, so it is rendered from a pre-encoded template.
+    Origin-State-Id being optional in the DWR, the answer only carries it
+    when the request does.
     """
 
-    logging.info("Responding to Device Watchdog Request ...")
-    # Generating a standard Diameter response
-    generic_response = generate_generic_diameter_message(diameter_request,
-                                                         origin_host,
-                                                         origin_realm)
-    dwa_header = generic_response['header']
-    dwa_avps = generic_response['avps']
+    logging.debug("Responding to Device Watchdog Request ...")
+    values = template_values(diameter_request)
+    origin_state_id = diameter_request.avps.get('Origin-State-Id')
+    if origin_state_id is None:
+        kind = 'watchdog-stateless'
+    else:
+        kind = 'watchdog'
+        values['Origin-State-Id'] = origin_state_id
+    dwa_template = get_answer_template(kind, origin_host, origin_realm)
+
+    # Rendering the answer with the request's identifiers
+    dwa_message = dwa_template.render(diameter_request.HopByHop,
+                                      diameter_request.EndToEnd,
+                                      values)
+    return dwa_message
+
+
+def write_cdr(record_type, diameter_request, session=None):
+    """
+    Queues the CDR of a STOP or EVENT accounting record.
+
+    :param record_type: Accounting-Record-Type of the request
+    :param diameter_request: accounting request
+    :param session: AccountingSession closed by a STOP record
+    :return: False if the CDR could not be queued, True otherwise
+    """
+    if cdr_writer is None:
+        return True
+    if session is not None:
+        record = CDRecord(record_type, session.session_id,
+                          session.origin_host, session.started,
+                          session.updated, session.record_number,
+                          session.interim_records)
+    elif (record_type == STOP_RECORD and
+          diameter_request.flags & DIAMETER_HDR_RETRANSMIT):
+        # Session already closed by the original request
+        return True
+    else:
+        now = time.time()
+        record = CDRecord(record_type,
+                          diameter_request.avps['Session-Id'],
+                          diameter_request.avps.get('Origin-Host'),
+                          now, now,
+                          diameter_request.avps['Accounting-Record-Number'],
+                          0)
+    return cdr_writer.submit(record)
+
+
+def generate_accounting_answer(diameter_request,
+                                origin_host,
+                                origin_realm):
+    """
+    Method used with the purpose of handling ACR requests
+    and sending ACA responses.(Accounting)
 
-    # Customizing it for Device Watchdog Answer
-    dwa_avps.append(encodeAVP(
-        'Result-Code', diameter_base. result_codes['DIAMETER_SUCCESS']))
-    dwa_avps.append(encodeAVP(
-        'Origin-State-Id', diameter_request.avps['Origin-State-Id']))
+    START records open a session in the accounting session store,
+    INTERIM records refresh it and STOP records close it, while
+    EVENT records do not keep any session state.
+    A retransmitted STOP for an already closed session is accepted.
+
+    STOP and EVENT records are written as CDRs by the cdr_writer.
+    While its queue is full they are answered with DIAMETER_OUT_OF_SPACE,
+    so that the peer sends them again later.
+    """
+
+    logging.debug("Responding to Accounting Request ...")
+    request_avps = diameter_request.avps
+    session_id = request_avps.get('Session-Id')
+    record_type = request_avps.get('Accounting-Record-Type')
+    if record_type is not None:
+        record_type = enumerated_value(
+            record_type, 'Accounting-Record-Type')
+    record_number = request_avps.get('Accounting-Record-Number')
+    interim_interval = request_avps.get('Acct-Interim-Interval', 0)
+    interim_interval_answer = None
+
+    result_code = diameter_base.result_codes['DIAMETER_SUCCESS']
+    if session_id is None or record_type is None or record_number is None:
+        result_code = diameter_base.result_codes['DIAMETER_MISSING_AVP']
+    elif record_type == START_RECORD or record_type == INTERIM_RECORD:
+        if record_type == START_RECORD:
+            session = accounting_sessions.start(
+                session_id, request_avps.get('Origin-Host'),
+                record_number, interim_interval)
+        else:
+            session = accounting_sessions.interim(
+                session_id, request_avps.get('Origin-Host'),
+                record_number, interim_interval)
+        if session is None:
+            result_code = diameter_base.result_codes['DIAMETER_OUT_OF_SPACE']
+        elif session.interim_interval:
+            interim_interval_answer = session.interim_interval
+    elif record_type == STOP_RECORD or record_type == EVENT_RECORD:
+        if cdr_writer is not None and cdr_writer.congested():
+            # Leaving the session open until the record can be written
+            result_code = diameter_base.result_codes['DIAMETER_OUT_OF_SPACE']
+        else:
+            session = None
+            if record_type == STOP_RECORD:
+                session = accounting_sessions.stop(session_id, record_number)
+            if not write_cdr(record_type, diameter_request, session):
+                result_code = \
+                    diameter_base.result_codes['DIAMETER_OUT_OF_SPACE']
+    else:
+        result_code = diameter_base.result_codes['DIAMETER_INVALID_AVP_VALUE']
+
+    # Creating the answer header, keeping the request's application
+    aca_header = HDRItem()
+    aca_header.cmd = diameter_request.command_code
+    aca_header.appId = diameter_request.application_Id
+    aca_header.flags = diameter_request.flags & DIAMETER_HDR_PROXIABLE
+    aca_header.HopByHop = diameter_request.HopByHop
+    aca_header.EndToEnd = diameter_request.EndToEnd
+
+    aca_avps = list()
+    if session_id is not None:
+        aca_avps.append(encodeAVPBin('Session-Id', session_id))
+    aca_avps.append(encodeAVPBin('Result-Code', result_code))
+    aca_avps.append(encodeAVPBin('Origin-Host', origin_host))
+    aca_avps.append(encodeAVPBin('Origin-Realm', origin_realm))
+    if record_type is not None:
+        aca_avps.append(encodeAVPBin('Accounting-Record-Type', record_type))
+    if record_number is not None:
+        aca_avps.append(encodeAVPBin('Accounting-Record-Number',
+                                     record_number))
+    if 'Acct-Application-Id' in request_avps:
+        aca_avps.append(encodeAVPBin(
+            'Acct-Application-Id', request_avps['Acct-Application-Id']))
+    if interim_interval_answer is not None:
+        aca_avps.append(encodeAVPBin('Acct-Interim-Interval',
+                                     interim_interval_answer))
 
     # Create the Diameter response message by joining the header and the AVPs
-    dwa_message = createRes(dwa_header, dwa_avps)
-    return dwa_message
+    aca_message = createResBin(aca_header, aca_avps)
+    return aca_message
+
+
+def subscription_id(diameter_request):
+    """
+    :param diameter_request: credit control request
+    :return: Subscription-Id-Data of the request's first Subscription-Id,
+    None if it has none
+    """
+    data = diameter_request.path_values(
+        'Subscription-Id/Subscription-Id-Data')
+    if data:
+        return data[0]
+    return None
+
+
+def credit_control_services(diameter_request):
+    """
+    Reads the services of a credit control request: each of its
+    Multiple-Services-Credit-Control AVPs, or the request itself
+    (with no rating group) when it has none.
+
+    :param diameter_request: credit control request
+    :return: (rating group, used unit type, used amount,
+    requested unit type, requested amount) of each service,
+    the requested amount being None when no units are requested
+    """
+    groups = diameter_request.avp_values('Multiple-Services-Credit-Control')
+    if not groups:
+        single_service = [
+            (name, diameter_request.avps[name])
+            for name in ('Requested-Service-Unit', 'Used-Service-Unit')
+            if name in diameter_request.avps]
+        groups = [single_service] if single_service else []
+
+    services = []
+    for group in groups:
+        avps = dict(group)
+        used_unit, used = service_units(avps.get('Used-Service-Unit', ()))
+        requested_unit, requested = None, None
+        if 'Requested-Service-Unit' in avps:
+            requested_unit, requested = service_units(
+                avps['Requested-Service-Unit'])
+        services.append((avps.get('Rating-Group'), used_unit, used,
+                         requested_unit, requested))
+    return services
+
+
+def encode_granted_units(builder, unit, granted, rating_group, final):
+    """
+    Adds the AVPs granting the units of a service: the
+    Granted-Service-Unit, Rating-Group, Validity-Time, Result-Code and
+    Final-Unit-Indication (when the last units of the balance were granted).
+    Single service requests (no rating group) get no Result-Code
+    of their own, the answer's Result-Code covering the grant.
+
+    :param builder: AVPBuilder the AVPs are added to
+    :param unit: unit type of the granted units
+    :param granted: amount granted, 0 when the balance is exhausted
+    :param rating_group: Rating-Group of the service, None if none
+    :param final: True when the last units of the balance were granted
+    """
+    if granted:
+        result_code = diameter_base.result_codes['DIAMETER_SUCCESS']
+    else:
+        result_code = \
+            diameter_base.result_codes['DIAMETER_CREDIT_LIMIT_REACHED']
+    if granted:
+        with builder.group('Granted-Service-Unit'):
+            builder.add(unit, granted)
+    if rating_group is not None:
+        builder.add('Rating-Group', rating_group)
+    if granted:
+        builder.add('Validity-Time', credit_sessions.validity_time)
+    if rating_group is not None:
+        builder.add('Result-Code', result_code)
+    if final and granted:
+        with builder.group('Final-Unit-Indication'):
+            builder.add('Final-Unit-Action', 0)
+
+
+def generate_credit_control_answer(diameter_request,
+                                   origin_host,
+                                   origin_realm):
+    """
+    Method used with the purpose of handling CCR requests
+    and sending CCA responses.(Credit Control, Gy/Ro online charging)
+
+    INITIAL requests open a session for the subscriber of the
+    Subscription-Id, and UPDATE requests debit the used units and
+    reserve the requested ones, for each Multiple-Services-Credit-Control
+    rating group. TERMINATION requests debit the last used units and
+    close the session. EVENT requests are charged at once, according
+    to their Requested-Action.
+
+    A rating group with no units left is answered with
+    DIAMETER_CREDIT_LIMIT_REACHED, as is the whole request
+    when none of its rating groups got any units.
+    """
+
+    logging.debug("Responding to Credit Control Request ...")
+    request_avps = diameter_request.avps
+    session_id = request_avps.get('Session-Id')
+    request_type = request_avps.get('CC-Request-Type')
+    request_number = request_avps.get('CC-Request-Number')
+    grants = []
+
+    result_code = diameter_base.result_codes['DIAMETER_SUCCESS']
+    try:
+        if session_id is None or request_type is None \
+                or request_number is None:
+            raise CreditControlError('DIAMETER_MISSING_AVP')
+        services = credit_control_services(diameter_request)
+        if request_type == INITIAL_REQUEST or request_type == EVENT_REQUEST:
+            subscriber = subscription_id(diameter_request)
+            if subscriber is None:
+                raise CreditControlError('DIAMETER_MISSING_AVP')
+            if request_type == INITIAL_REQUEST:
+                credit_sessions.open(session_id, subscriber)
+                grants = credit_sessions.charge(session_id, services)
+            else:
+                grants = credit_sessions.event(
+                    subscriber,
+                    request_avps.get('Requested-Action', DIRECT_DEBITING),
+                    services)
+        elif request_type == UPDATE_REQUEST:
+            grants = credit_sessions.charge(session_id, services)
+        elif request_type == TERMINATION_REQUEST:
+            credit_sessions.terminate(session_id, services)
+        else:
+            raise CreditControlError('DIAMETER_INVALID_AVP_VALUE')
+    except CreditControlError as error:
+        result_code = diameter_base.result_codes[error.result_code]
+    if grants and not any(granted for _, _, granted, _ in grants):
+        result_code = \
+            diameter_base.result_codes['DIAMETER_CREDIT_LIMIT_REACHED']
+
+    # Creating the answer header, keeping the request's application
+    cca_header = HDRItem()
+    cca_header.cmd = diameter_request.command_code
+    cca_header.appId = diameter_request.application_Id
+    cca_header.flags = diameter_request.flags & DIAMETER_HDR_PROXIABLE
+    cca_header.HopByHop = diameter_request.HopByHop
+    cca_header.EndToEnd = diameter_request.EndToEnd
+
+    # Writing the AVPs straight into the answer, the grouped ones included
+    cca_avps = AVPBuilder(cca_header)
+    if session_id is not None:
+        cca_avps.add('Session-Id', session_id)
+    cca_avps.add('Result-Code', result_code)
+    cca_avps.add('Origin-Host', origin_host)
+    cca_avps.add('Origin-Realm', origin_realm)
+    cca_avps.add('Auth-Application-Id',
+                 request_avps.get('Auth-Application-Id',
+                                  diameter_request.application_Id))
+    if request_type is not None:
+        cca_avps.add('CC-Request-Type', request_type)
+    if request_number is not None:
+        cca_avps.add('CC-Request-Number', request_number)
+    for rating_group, unit, granted, final in grants:
+        if rating_group is None:
+            # Single service request, answered without grouping
+            encode_granted_units(cca_avps, unit, granted, rating_group, final)
+        else:
+            with cca_avps.group('Multiple-Services-Credit-Control'):
+                encode_granted_units(cca_avps, unit, granted, rating_group,
+                                     final)
+
+    # Filling in the header, now that the length of the answer is known
+    cca_message = cca_avps.finish()
+    return cca_message
 
 
 def response_to_invalid_request(diameter_request,
@@ -136,24 +494,20 @@ def response_to_invalid_request(diameter_request,
 
     We define an invalid Diameter request by comparing its command code
     with the ones that we have support for.
+    The answer is rendered from a pre-encoded template,
+    using the request's command code.
     """
 
-    logging.info("Responding to invalid request...")
-    # Generating a standard Diameter response
-    generic_response = generate_generic_diameter_message(diameter_request,
-                                                         origin_host,
-                                                         origin_realm)
-    response_header = generic_response['header']
-    response_avps = generic_response['avps']
+    logging.debug("Responding to invalid request...")
+    response_template = get_answer_template('invalid',
+                                            origin_host, origin_realm)
 
-    # Customizing the standard response for invalid request answer
-    response_avps.append(
-        encodeAVP('Result-Code',
-                  diameter_base.result_codes['DIAMETER_UNABLE_TO_COMPLY']))
-
-    # Generating the actual Diameter response
-    # by joining the header and the AVPs
-    response_message = createRes(response_header, response_avps)
+    # Rendering the answer with the request's command code and identifiers
+    response_message = response_template.render(
+        diameter_request.HopByHop,
+        diameter_request.EndToEnd,
+        template_values(diameter_request),
+        command_code=diameter_request.command_code)
     return response_message
 
 
@@ -163,6 +517,14 @@ cmd_code_responses = {
     diameter_base.cmd_codes['Capability-Exchange']:
         generate_capability_exchange_answer,
 
+    # Response for Accounting Request
+    diameter_base.cmd_codes['Accounting']:
+        generate_accounting_answer,
+
+    # Response for Credit Control Request
+    diameter_base.cmd_codes['Credit-Control']:
+        generate_credit_control_answer,
+
     # Response for Device Watchdog Request
     diameter_base.cmd_codes['Device-Watchdog']:
         generate_device_watchdog_answer,
@@ -6,8 +6,14 @@ Using the libDiameter library, as well as the dictDiameter .xml dictionary
 """
 
 import thread
+import diameter_responses
 from diameter_base import *
+from diameter_framing import *
+from diameter_metrics import *
+from diameter_pcap import *
 from diameter_responses import *
+from diameter_tracing import *
+from diameter_workers import *
 import logging
 
 logging.getLogger().setLevel(logging.INFO)
@@ -25,19 +31,42 @@ class DiameterServer:
     def __init__(self,
                  host="127.0.0.1",
                  port=3868,
-                 buffer_size=4096,  # Limit buffer size to collect data
+                 buffer_size=4096,  # Initial size of the receive buffer
                  max_clients=5,     # Maximum number of clients accepted
                  origin_host='server.asn.test',
-                 origin_realm='asn.test'):
+                 origin_realm='asn.test',
+                 workers=1,         # Number of worker processes
+                 reuse_port=True,   # Workers bind with SO_REUSEPORT
+                 cdr_writer=None,   # CDRWriter for accounting records
+                 metrics_port=None,  # Port of the metrics endpoint
+                 tracer=None,       # MessageTracer sampling the exchanges
+                 recorder=None):    # PcapWriter recording the traffic
         """
         The server accepts data over an open socket, decodes it into
         Diameter Request messages, interprets the data and builds up
         Diameter Response message based on the received information.
 
+        With more than one worker, the server runs as that many
+        processes, supervised by a DiameterWorkerPool.
+
         :param host: host of the server
         :param port: port used for connection
-        :param buffer_size: size of the buffer for receiving data
+        :param buffer_size: initial size of each peer's receive buffer
         :param max_clients: maximum number of clients at a given time
+        :param workers: number of worker processes
+        :param reuse_port: each worker binds its own socket on the port
+        with SO_REUSEPORT, instead of sharing a single listening socket
+        :param cdr_writer: CDRWriter writing the completed accounting
+        sessions and events as CDRs, None to not write any
+        :param metrics_port: local port serving the metrics in the
+        Prometheus text format, None to not serve them. With several
+        workers, each worker serves its own metrics on the following
+        ports (metrics_port + worker number)
+        :param tracer: MessageTracer capturing a sample of the decoded
+        exchanges, served on GET /traces by the metrics endpoint,
+        None to not capture any
+        :param recorder: PcapWriter recording every request and answer,
+        None to not record the traffic
         """
 
         self.host = host
@@ -46,26 +75,77 @@ class DiameterServer:
         self.max_clients = max_clients
         self.origin_host = origin_host
         self.origin_realm = origin_realm
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.listening_socket = None
+        self.cdr_writer = cdr_writer
+        if cdr_writer is not None:
+            diameter_responses.cdr_writer = cdr_writer
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.tracer = tracer
+        self.recorder = recorder
+        self.metrics = MetricsRegistry()
+        self.register_gauges()
 
-    def send_response(self, socket_connection, request_info):
+    def register_gauges(self):
+        """
+        Registers the gauges read with the server's metrics.
+        """
+
+        self.metrics.gauge('diameter_active_connections',
+                           self.active_connections,
+                           'Peer connections currently open')
+        self.metrics.gauge('diameter_accounting_sessions',
+                           lambda: len(diameter_responses.accounting_sessions),
+                           'Accounting sessions currently open')
+        self.metrics.gauge('diameter_credit_sessions',
+                           lambda: len(diameter_responses.credit_sessions),
+                           'Credit control sessions currently open')
+        if self.cdr_writer is not None:
+            self.metrics.gauge('diameter_cdr_queue_depth',
+                               self.cdr_writer.queue.qsize,
+                               'CDRs waiting to be written')
+
+    def active_connections(self):
+        """
+        :return: number of currently connected peers
+        """
+        return (self.metrics.total('connections_opened')
+                - self.metrics.total('connections_closed'))
+
+    def serve_metrics(self, port):
+        """
+        Starts serving the server's metrics on a local HTTP endpoint
+        (GET /metrics), in the Prometheus text format.
+
+        :param port: port of the metrics endpoint
         """
-        Method used to send a Diameter response to a request for the server.
+
+        self.metrics_server = MetricsServer(self.metrics, port=port,
+                                            tracer=self.tracer)
+        self.metrics_server.start()
+        logging.info("Serving metrics on port %d", port)
+
+    def generate_response(self, request_info, peer=None):
+        """
+        Method used to generate a Diameter response to a request.
 
         Creates a DiameterMessage object based on the encoded data
-        received from the peer, prepares a specific response
-        based on the request's Diameter command code, which is then
-        being sent over the same socket connection back to the peer
-        that performed the request.
+        received from the peer and prepares a specific response
+        based on the request's Diameter command code.
 
-        :param socket_connection: peer connection to the server
-        :param request_info: data received from the socket connection
-        :return: a DiameterMessage object containing the response sent
+        :param request_info: a single Diameter request, as received
+        :param peer: address of the peer which sent the request
+        :return: the encoded Diameter response
         """
 
         # Creating a diameter request message based on the data received
+        started = time.time()
         request = HDRItem()
-        stripHdr(request, request_info.encode("hex"))
+        stripHdrBin(request, request_info)
         diameter_request = DiameterMessage(request)
+        decoded = time.time()
 
         # Generating a response based on the request info and command code
         response = cmd_code_responses.get(
@@ -73,12 +153,62 @@ class DiameterServer:
             response_to_invalid_request
         )(diameter_request, self.origin_host, self.origin_realm)
 
+        self.metrics.record_request(
+            diameter_request.command_code, answer_result_code(response),
+            len(request_info), len(response),
+            (('decode', decoded - started), ('handle', time.time() - decoded)))
+        if self.tracer is not None and self.tracer.sample():
+            self.tracer.capture(request_info, response, peer)
+        if self.recorder is not None:
+            self.record_exchange(request_info, response, peer, started)
+        return response
+
+    def record_exchange(self, request_info, response, peer, received):
+        """
+        Records a request and its answer into the server's capture.
+
+        :param request_info: the Diameter request, as received
+        :param response: the encoded Diameter response
+        :param peer: address of the peer, None if unknown
+        :param received: time the request was received
+        """
+
+        peer = tuple(peer[:2]) if peer else ('0.0.0.0', 0)
+        server = (self.host, self.port)
+        self.recorder.write_message(peer, server, request_info, received)
+        self.recorder.write_message(server, peer, response)
+
+    def send_response(self, socket_connection, request_info):
+        """
+        Method used to send a Diameter response to a request for the server.
+
+        Prepares a specific response based on the request's Diameter
+        command code, which is then being sent over the same socket
+        connection back to the peer that performed the request.
+
+        :param socket_connection: peer connection to the server
+        :param request_info: data received from the socket connection
+        :return: a DiameterMessage object containing the response sent
+        """
+
+        response = self.generate_response(request_info)
+
         # Sending the message and returning a Diameter Message object
-        socket_connection.send(response.decode('hex'))
+        socket_connection.sendall(response)
+        return self.sent_message(response)
+
+    @staticmethod
+    def sent_message(response):
+        """
+        Decodes a sent response back into a Diameter Message object.
+
+        :param response: the encoded Diameter response
+        :return: a DiameterMessage object containing the response
+        """
+
         response_data = HDRItem()
-        stripHdr(response_data, response)
-        diameter_sent_message = DiameterMessage(response_data)
-        return diameter_sent_message
+        stripHdrBin(response_data, response)
+        return DiameterMessage(response_data)
 
     def handle_request(self, connection, address):
         """
@@ -86,44 +216,106 @@ class DiameterServer:
         Represents one of the processing threads,
         for a specific request sent by a peer.
 
-        Tries to receive data from the socket connection based on the buffer,
-        and if the buffer is full, then re-tries to add data from the next
-        buffered packet, since it may be related to the first one.
-
-        Once the data receiving process is finished, the information is being
-        sent for further analysis and building up a response for it.
+        Receives data from the socket connection into the peer's
+        receive buffer, which splits the stream into whole Diameter
+        messages based on the length from their header. Partial messages
+        are kept for the next read, while all the requests completed
+        by one read (pipelined by the peer) are handled as a batch,
+        their responses being sent back together.
 
         :param connection: socket connection on which we handle the request
         :param address: address of the peer requesting the connection
         """
 
+        self.metrics.connection_opened()
+        try:
+            framer = DiameterFramer(self.buffer_size)
+            while True:
+                # get input, wait if no data is being received
+                try:
+                    received = framer.recv_from(connection)
+                except socket.error:
+                    break
+                # no data found exit loop (possible closed socket)
+                if received == 0:
+                    break
+                responses = []
+                try:
+                    for request_info in framer.messages():
+                        # actual handling of the Diameter message
+                        logging.debug("Handling request for address %s",
+                                      address)
+                        responses.append(
+                            self.generate_response(request_info, address))
+                except DiameterFramingError as error:
+                    logging.error("Closing connection to " + str(address)
+                                  + ": " + str(error))
+                    break
+                if not responses:
+                    continue
+                sending = time.time()
+                try:
+                    connection.sendall(bytearray().join(responses))
+                except socket.error:
+                    break
+                self.metrics.record_stage('send', time.time() - sending)
+                # Decoding the answers back only when they are logged
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    for response in responses:
+                        logging.debug("Sent %s", LoggedMessage(response))
+        finally:
+            # Also run when handling a request fails
+            connection.close()
+            self.metrics.connection_closed()
+            self.metrics.retire()
+
+    def listen(self, reuse_port=False):
+        """
+        Creates the socket listening for peers on the pre-defined port.
+
+        :param reuse_port: set SO_REUSEPORT, allowing several processes
+        to bind the same port
+        """
+
+        # Create the server, binding to HOST:PORT and set max peers
+        socket_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        socket_connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            socket_connection.setsockopt(
+                socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        socket_connection.bind((self.host, self.port))
+        socket_connection.listen(self.max_clients)
+        self.listening_socket = socket_connection
+
+    def serve(self):
+        """
+        Accepts the incoming connections, starting a processing thread
+        which handles the requests of each of them.
+        """
+
         while True:
-            # get input, wait if no data is being received
-            try:
-                data = connection.recv(self.buffer_size)
-            except socket.error:
-                break
-            # suspect more data(try to get it all without stopping if no data)
-            if len(data) == self.buffer_size:
-                while 1:
-                    try:
-                        data += connection.recv(self.buffer_size)
-                    except socket.error:
-                        # error means no more data
-                        break
-            # no data found exit loop (possible closed socket)
-            if len(data) == 0:
-                break
-            else:
-                # actual handling of the Diameter message
-                logging.info("Handling request for address " + str(address))
-                message_sent = self.send_response(connection, data)
-                logging.info(
-                    "\n\nSent "
-                    + str(dictCOMMANDcode2name(
-                        message_sent.flags, message_sent.command_code))
-                    + "\nAVPs:\n" + str(message_sent.avps) + "\n\n")
-        connection.close()
+            incoming_connection, peer_address = \
+                self.listening_socket.accept()
+            logging.info('Connected to ' + str(peer_address))
+            thread.start_new(
+                self.handle_request, (incoming_connection, peer_address))
+
+    def close(self):
+        """
+        Closes the listening socket, writes the queued CDRs
+        and stops serving the metrics.
+        """
+
+        if self.listening_socket is not None:
+            self.listening_socket.close()
+            self.listening_socket = None
+        if self.cdr_writer is not None:
+            self.cdr_writer.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.recorder is not None:
+            self.recorder.close()
 
     def start(self):
         """
@@ -133,25 +325,24 @@ class DiameterServer:
         listening on the pre-defined port, and then starts a processing thread
         which handles possible requests for each of the incoming connections
         on said socket from any potential peers.
+
+        With several workers, the dictionary is loaded before starting
+        the worker processes, which then listen and serve the connections.
         """
 
         # Loading the Diameter dictionary for messages, codes and AVPs
         LoadDictionary("dictDiameter.xml")
 
-        # Create the server, binding to HOST:PORT and set max peers
-        socket_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        socket_connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        socket_connection.bind((self.host, self.port))
-        socket_connection.listen(self.max_clients)
-
         try:
-            while True:
-                incoming_connection, peer_address = socket_connection.accept()
-                logging.info('Connected to ' + str(peer_address))
-                thread.start_new(
-                    self.handle_request, (incoming_connection, peer_address))
+            if self.metrics_port is not None and self.workers <= 1:
+                self.serve_metrics(self.metrics_port)
+            if self.workers > 1:
+                DiameterWorkerPool(self, self.workers, self.reuse_port).run()
+            else:
+                self.listen()
+                self.serve()
         except KeyboardInterrupt:
             print("\nClosing server...")
 
         # Closing the socket connection
-        socket_connection.close()
+        self.close()
@@ -0,0 +1,234 @@
+"""
+Pre-encoded Diameter message templates.
+
+Many messages, like watchdog answers, only differ by a few fields
+from one another. A template encodes the static AVPs of such a message
+once, at creation. Rendering it copies the pre-encoded bytes into the
+message buffer and only writes the variable fields: the header
+identifiers and length, fixed size AVP values patched in place with
+pack_into, and the few variable length AVPs.
+"""
+
+import libDiameter
+from libDiameter import *
+
+# Struct format of fixed size AVP types, which are patched in place
+_FIXED_FORMATS = (
+    ('asI32', "!I"),
+    ('asU32', "!I"),
+    ('asI64', "!Q"),
+    ('asU64', "!Q"),
+    ('asF32', "!f"),
+    ('asF64', "!d"),
+    ('asTime', "!I"),
+)
+
+# AVP Time values count the seconds since 1900
+SECONDS_BETWEEN_1900_AND_1970 = ((70 * 365) + 17) * 86400
+
+
+class TemplateSlot:
+    """
+    Marker for AVPs whose value is given when rendering the template.
+    """
+
+    def __repr__(self):
+        return 'SLOT'
+
+
+# Value of a template AVP set at render time
+SLOT = TemplateSlot()
+
+
+def fixed_format(avp_type):
+    """
+    :param avp_type: dictionary type of an AVP
+    :return: struct format of the value, None for variable size types
+    """
+
+    if avp_type == "Enumerated":
+        return "!I"
+    # Type lists are only set once the dictionary is loaded
+    for type_list, fmt in _FIXED_FORMATS:
+        if avp_type in getattr(libDiameter, type_list):
+            return fmt
+    return None
+
+
+class StaticSegment:
+    """
+    Pre-encoded run of AVPs, with the offsets of its fixed size slots.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        # (offset in data, struct format, AVP name, is Time) of each slot
+        self.patches = []
+
+
+class VariableSlot:
+    """
+    Variable length AVP, encoded when rendering the template.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: AVP name
+        """
+
+        self.name = name
+        self.avp = AVPItem()
+        dictAVPname2code(self.avp, name, None)
+        self.flags = checkMandatory(self.avp.mandatory)
+        self.is_utf8 = self.avp.type in libDiameter.asUTF8
+        self.is_string = (self.is_utf8
+                          or self.avp.type in libDiameter.asString)
+        self.header_length = 8
+        if self.avp.vendor != 0:
+            self.flags |= DIAMETER_FLAG_VENDOR
+            self.header_length = 12
+
+    def encode(self, value):
+        """
+        Converts the value into the bytes to write into the message.
+
+        :param value: AVP value
+        :return: string data for string types, or the whole encoded AVP
+        """
+
+        if self.is_utf8:
+            return utf8encoder(value)[0]
+        if self.is_string:
+            return value
+        return do_encodeBin(self.avp, checkMandatory(self.avp.mandatory),
+                            value)
+
+    def size(self, data):
+        """
+        :param data: result of encode()
+        :return: bytes taken by the AVP in the message, padding included
+        """
+
+        if self.is_string:
+            return calc_padding(self.header_length + len(data))
+        return len(data)
+
+    def write(self, buf, offset, data):
+        """
+        Writes the AVP into the message buffer.
+
+        :param buf: message buffer
+        :param offset: where the AVP starts in the buffer
+        :param data: result of encode()
+        :return: offset after the AVP (padding included)
+        """
+
+        if not self.is_string:
+            buf[offset:offset + len(data)] = data
+            return offset + len(data)
+        length = self.header_length + len(data)
+        struct.pack_into("!II", buf, offset,
+                         int(self.avp.code), (self.flags << 24) | length)
+        if self.header_length == 12:
+            struct.pack_into("!I", buf, offset + 8, int(self.avp.vendor))
+        start = offset + self.header_length
+        buf[start:start + len(data)] = data
+        return offset + calc_padding(length)
+
+
+class MessageTemplate:
+    """
+    Diameter message with pre-encoded static AVPs.
+    """
+
+    def __init__(self, command_code, avps, flags=0, application_id=0):
+        """
+        Encodes the static AVPs of the message. AVPs given the SLOT value
+        are set when rendering: the ones with a fixed size are encoded
+        as placeholders patched in place, the others are written between
+        the pre-encoded parts of the message.
+        The dictionary has to be loaded before creating a template.
+
+        :param command_code: Diameter command code
+        :param avps: ordered list of (AVP name, value or SLOT) tuples
+        :param flags: Diameter header flags
+        :param application_id: Diameter Application-ID
+        """
+
+        self.command_code = command_code
+        self.flags = flags
+        self.application_id = application_id
+        self.segments = []
+        self.variable_slots = []
+        self.static_length = 20
+
+        segment = None
+        for name, value in avps:
+            if value is SLOT:
+                avp = AVPItem()
+                dictAVPname2code(avp, name, value)
+                fmt = fixed_format(avp.type)
+                if fmt is None:
+                    slot = VariableSlot(name)
+                    self.segments.append(slot)
+                    self.variable_slots.append(slot)
+                    segment = None
+                    continue
+                encoded = encodeAVPBin(name, 0)
+                if segment is None:
+                    segment = StaticSegment()
+                    self.segments.append(segment)
+                # Value follows the AVP header, with Vendor-ID if any
+                data_offset = 8
+                if avp.vendor != 0:
+                    data_offset = 12
+                segment.patches.append((
+                    len(segment.data) + data_offset, fmt, name,
+                    avp.type in libDiameter.asTime))
+            else:
+                encoded = encodeAVPBin(name, value)
+                if segment is None:
+                    segment = StaticSegment()
+                    self.segments.append(segment)
+            segment.data += encoded
+            self.static_length += len(encoded)
+
+    def render(self, hop_by_hop, end_to_end, values=None, command_code=None):
+        """
+        Builds a message from the template.
+
+        :param hop_by_hop: Hop-by-Hop identifier of the message
+        :param end_to_end: End-to-End identifier of the message
+        :param values: dictionary of the values of the SLOT AVPs
+        :param command_code: command code, if not the template's one
+        :return: encoded Diameter message, as a bytearray
+        """
+
+        length = self.static_length
+        encoded = []
+        for slot in self.variable_slots:
+            data = slot.encode(values[slot.name])
+            encoded.append(data)
+            length += slot.size(data)
+
+        if command_code is None:
+            command_code = self.command_code
+        buf = bytearray(length)
+        struct.pack_into("!IIIII", buf, 0,
+                         0x01000000 | length,
+                         (self.flags << 24) | command_code,
+                         self.application_id, hop_by_hop, end_to_end)
+        offset = 20
+        slot_data = iter(encoded)
+        for segment in self.segments:
+            if isinstance(segment, VariableSlot):
+                offset = segment.write(buf, offset, next(slot_data))
+                continue
+            buf[offset:offset + len(segment.data)] = segment.data
+            for position, fmt, name, is_time in segment.patches:
+                value = values[name]
+                if is_time:
+                    value += SECONDS_BETWEEN_1900_AND_1970
+                struct.pack_into(fmt, buf, offset + position, value)
+            offset += len(segment.data)
+        return buf
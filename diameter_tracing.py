@@ -0,0 +1,132 @@
+"""
+Message tracing: lazily formatted message logs and sampled captures.
+
+Decoding a message back and formatting its command name and every AVP
+costs more than handling it, so messages are only logged through
+LoggedMessage objects, formatted when the log record is actually emitted.
+
+Full decoded exchanges are captured for a sample of the requests only
+(1 in every N), into a bounded ring buffer: the oldest captures are
+dropped, so tracing can be left enabled under load.
+"""
+
+import collections
+import itertools
+from diameter_base import *
+
+# Captured exchange, the request and answer being DiameterMessage objects
+TraceRecord = collections.namedtuple(
+    'TraceRecord', ['timestamp', 'peer', 'request', 'answer'])
+
+
+def decode_message(message):
+    """
+    :param message: encoded Diameter message
+    :return: DiameterMessage object containing the message
+    """
+    header = HDRItem()
+    stripHdrBin(header, message)
+    return DiameterMessage(header)
+
+
+def format_message(message):
+    """
+    :param message: DiameterMessage object
+    :return: the command name and AVPs of the message, as text
+    """
+    return '%s\nAVPs:\n%s' % (
+        dictCOMMANDcode2name(message.flags, message.command_code),
+        message.avps)
+
+
+class LoggedMessage:
+    """
+    Encoded message, logged as its decoded form.
+
+    Passed as a logging argument, the message is only decoded and
+    formatted if the log record is emitted, e.g.:
+        logging.debug("Sent %s", LoggedMessage(response))
+    """
+
+    def __init__(self, message):
+        """
+        :param message: encoded Diameter message
+        """
+        self.message = message
+
+    def __str__(self):
+        return format_message(decode_message(self.message))
+
+
+class MessageTracer:
+    """
+    Captures 1 in every N exchanges, decoded, into a ring buffer.
+    """
+
+    def __init__(self, sample_rate=1000, capacity=1024):
+        """
+        :param sample_rate: one in every sample_rate requests is captured,
+        0 to capture none
+        :param capacity: number of captures kept, the oldest ones
+        being dropped first
+        """
+        self.sample_rate = sample_rate
+        self.records = collections.deque(maxlen=capacity)
+        # Counting with itertools.count is atomic, threads can share it
+        self.counter = itertools.count(1)
+
+    def sample(self):
+        """
+        :return: True if the current request is to be captured
+        """
+        return (self.sample_rate > 0
+                and next(self.counter) % self.sample_rate == 0)
+
+    def capture(self, request, answer, peer=None):
+        """
+        Decodes and stores an exchange, regardless of the sampling.
+
+        :param request: encoded request, copied as its buffer is reused
+        :param answer: encoded answer
+        :param peer: address of the peer, if known
+        """
+        self.records.append(TraceRecord(
+            time.time(), peer,
+            decode_message(bytes(bytearray(request))),
+            decode_message(bytes(answer))))
+
+    def trace(self, request, answer, peer=None):
+        """
+        Captures the exchange if it is sampled.
+
+        :param request: encoded request
+        :param answer: encoded answer
+        :param peer: address of the peer, if known
+        """
+        if self.sample():
+            self.capture(request, answer, peer)
+
+    def snapshot(self):
+        """
+        :return: list of the captured TraceRecords, oldest first
+        """
+        return list(self.records)
+
+    def clear(self):
+        """
+        Drops every capture.
+        """
+        self.records.clear()
+
+    def dump(self, output):
+        """
+        Writes the captured exchanges as text.
+
+        :param output: file object to write to
+        """
+        for record in self.snapshot():
+            output.write('%s peer %s\n%s\n%s\n\n' % (
+                time.strftime('%Y-%m-%d %H:%M:%S',
+                              time.localtime(record.timestamp)),
+                record.peer, format_message(record.request),
+                format_message(record.answer)))
@@ -0,0 +1,238 @@
+"""
+Multi-process scaling for the Diameter servers.
+
+A single Python process uses at most one CPU core for encoding and
+decoding messages, so the server can be run as several worker processes.
+The Diameter dictionary is loaded once by the supervisor before forking,
+the workers sharing its memory pages copy-on-write. Each worker either
+binds its own listening socket on the same port with SO_REUSEPORT,
+the kernel spreading the new connections between them, or accepts
+from a listening socket created by the supervisor and shared by all.
+
+The supervisor restarts the workers which die, and aggregates
+the statistics each of them publishes in shared memory.
+"""
+
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+# Statistics kept by each worker, in this order, in shared memory
+WORKER_STATS = ('requests', 'bytes_in', 'bytes_out')
+
+# Seconds between publications of a worker's statistics
+STATS_PUBLISH_INTERVAL = 1.0
+
+# Workers living less than this (seconds) are restarted after a delay
+MIN_WORKER_LIFETIME = 1.0
+
+
+def reuse_port_supported():
+    """
+    :return: True if the platform supports the SO_REUSEPORT option
+    """
+    return hasattr(socket, 'SO_REUSEPORT')
+
+
+def _terminate_worker(signum, frame):
+    # Stops the worker's server the same way as an interrupt
+    raise KeyboardInterrupt()
+
+
+class DiameterWorkerPool:
+    """
+    Supervisor running a Diameter server as several worker processes.
+    """
+
+    def __init__(self, server, workers, reuse_port=True, stats_interval=60):
+        """
+        The server object is the one each worker runs: it has to provide
+        listen(reuse_port) creating its listening socket, serve() running
+        until the process is stopped, and metrics, the MetricsRegistry
+        its handled requests are counted in.
+
+        :param server: DiameterServer (or AsyncDiameterServer) to run
+        :param workers: number of worker processes
+        :param reuse_port: each worker binds the port with SO_REUSEPORT,
+        instead of accepting from a socket shared by all the workers
+        :param stats_interval: seconds between logs of aggregated stats
+        """
+
+        self.server = server
+        self.workers = workers
+        self.reuse_port = reuse_port and reuse_port_supported()
+        self.stats_interval = stats_interval
+        self.counters = multiprocessing.RawArray(
+            'L', workers * len(WORKER_STATS))
+        self.pids = [None] * workers
+        self.started = [0.0] * workers
+        self.restarts = 0
+        if reuse_port and not self.reuse_port:
+            logging.warning("SO_REUSEPORT not supported, "
+                            "workers will share the listening socket")
+
+    def spawn(self, index):
+        """
+        Forks the worker process for the given slot.
+
+        :param index: worker slot number
+        """
+
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                self.run_worker(index)
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                logging.exception("Worker %d failed", index)
+                exit_code = 1
+            try:
+                # Writes the worker's queued CDRs before exiting
+                self.server.close()
+            except Exception:
+                logging.exception("Worker %d failed to close", index)
+            self.publish_stats(index)
+            os._exit(exit_code)
+        self.pids[index] = pid
+        self.started[index] = time.time()
+        logging.info("Started worker %d (pid %d)", index, pid)
+
+    def run_worker(self, index):
+        """
+        Runs the server inside a worker process, publishing its metrics
+        into the worker's slot of the shared statistics.
+
+        :param index: worker slot number
+        """
+
+        # Counts of the previous workers of the slot, kept over restarts
+        base = index * len(WORKER_STATS)
+        self.published = self.counters[base:base + len(WORKER_STATS)]
+        signal.signal(signal.SIGTERM, _terminate_worker)
+        if self.reuse_port:
+            self.server.listen(reuse_port=True)
+        if self.server.metrics_port is not None:
+            self.server.serve_metrics(self.server.metrics_port + index)
+
+        publisher = threading.Thread(target=self.publish_loop, args=(index,))
+        publisher.daemon = True
+        publisher.start()
+        self.server.serve()
+
+    def publish_loop(self, index):
+        """
+        Publishes the worker's statistics periodically.
+
+        :param index: worker slot number
+        """
+
+        while True:
+            time.sleep(STATS_PUBLISH_INTERVAL)
+            self.publish_stats(index)
+
+    def publish_stats(self, index):
+        """
+        Stores the totals of the worker server's metrics into the
+        worker's slot. Only the worker writes its slot, storing
+        whole values, so no update is lost without locking.
+
+        :param index: worker slot number
+        """
+
+        totals = self.server.metrics.totals()
+        values = (sum(totals.requests.values()),
+                  totals.bytes_in, totals.bytes_out)
+        base = index * len(WORKER_STATS)
+        for offset, value in enumerate(values):
+            self.counters[base + offset] = self.published[offset] + value
+
+    def stats(self):
+        """
+        Aggregates the statistics of all the workers.
+
+        :return: dictionary with the totals of each statistic,
+        the number of restarts and the per worker statistics
+        """
+
+        per_worker = []
+        for index in range(self.workers):
+            base = index * len(WORKER_STATS)
+            per_worker.append(dict(
+                zip(WORKER_STATS, self.counters[base:base + len(WORKER_STATS)])))
+        totals = dict((name, sum(worker[name] for worker in per_worker))
+                      for name in WORKER_STATS)
+        totals['workers'] = self.workers
+        totals['restarts'] = self.restarts
+        totals['per_worker'] = per_worker
+        return totals
+
+    def reap(self):
+        """
+        Restarts the workers which exited since the last call.
+        """
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid not in self.pids:
+                continue
+            index = self.pids.index(pid)
+            logging.warning("Worker %d (pid %d) exited with status %d",
+                            index, pid, status)
+            if time.time() - self.started[index] < MIN_WORKER_LIFETIME:
+                # Avoid restarting a failing worker in a tight loop
+                time.sleep(MIN_WORKER_LIFETIME)
+            self.restarts += 1
+            self.spawn(index)
+
+    def stop(self):
+        """
+        Terminates all the worker processes.
+        """
+
+        for index, pid in enumerate(self.pids):
+            if pid is None:
+                continue
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            self.pids[index] = None
+
+    def run(self):
+        """
+        Starts the workers and supervises them until interrupted.
+
+        The Diameter dictionary has to be loaded before calling this,
+        so that the workers inherit it.
+        """
+
+        if not self.reuse_port:
+            self.server.listen()
+        for index in range(self.workers):
+            self.spawn(index)
+
+        last_stats = time.time()
+        try:
+            while True:
+                time.sleep(0.5)
+                self.reap()
+                if time.time() - last_stats >= self.stats_interval:
+                    last_stats = time.time()
+                    logging.info("Workers stats: %s", self.stats())
+        finally:
+            self.stop()
@@ -16,6 +16,10 @@ import sys
 import logging
 import time
 import string
+import collections
+import hashlib
+import marshal
+import os
 
 # Diameter Header fields
 
@@ -39,6 +43,10 @@ class AVPItem:
         self.type=""
         self.mandatory=""
         
+# Compact, read-only AVP definition kept in dictionary indexes
+# vendor is numeric vendor code (None if vendor-id is not in dictionary)
+AVPDef=collections.namedtuple("AVPDef","code name vendor vendor_id type mandatory")
+
 class HDRItem:
     def __init__(self):
         self.ver=0
@@ -58,11 +66,149 @@ utf8decoder=codecs.getdecoder("utf_8")
 #----------------------------------------------------------------------
 # Dictionary routines
 
+# Compiled dictionary: plain tables (tuples, lists, dicts) extracted from
+# the XML, cached with marshal next to the XML file. Cache is keyed by the
+# XML hash, the cache format and the python version, so a changed XML is
+# compiled again. XML DOM is not kept once the tables are extracted
+DICT_CACHE_FORMAT=2
+
 # Load simplified dictionary from <file>
-def LoadDictionary(file):
-    global dict_avps
-    global dict_vendors
-    global dict_commands
+# Compiled tables are read from <cacheFile> (<file>.cache by default)
+# when up to date, and written there otherwise. Empty cacheFile disables it
+def LoadDictionary(file,cacheFile=None):
+    f=open(file,"rb")
+    try:
+        xml=f.read()
+    finally:
+        f.close()
+    if cacheFile is None:
+        cacheFile=file+".cache"
+    key=(DICT_CACHE_FORMAT,sys.version,hashlib.sha1(xml).hexdigest())
+    tables=None
+    if cacheFile:
+        tables=readDictCache(cacheFile,key)
+    if tables is None:
+        tables=compileDictionary(xml)
+        if cacheFile:
+            writeDictCache(cacheFile,key,tables)
+    installDictionary(tables)
+
+# Compile dictionary from XML text into the lookup tables
+# Where dictionary has duplicates, tables keep the entry a scan would find
+def compileDictionary(xml):
+    doc = minidom.parseString(xml)
+    tables={}
+    # Now lets process typedefs
+    types={}
+    types["asString"]=["OctetString"]
+    types["asUTF8"]=["UTF8String"]
+    types["asI32"]=["Integer32"]
+    types["asU32"]=["Unsigned32"]
+    types["asF32"]=["Float32"]
+    types["asI64"]=["Integer64"]
+    types["asU64"]=["Unsigned64"]
+    types["asF64"]=["Float64"]
+    types["asIPAddress"]=["IPAddress"]
+    types["asIP"]=["IP"]
+    types["asTime"]=["Time"]
+    for td in doc.getElementsByTagName("typedef"):
+        tName=td.getAttribute("name")
+        tType=td.getAttribute("type")
+        for names in types.values():
+            if tType in names:
+                names.append(tName)
+    tables["types"]=types
+    vendor_id2code={}
+    vendor_code2id={}
+    for vendor in doc.getElementsByTagName("vendor"):
+        vCode=int(vendor.getAttribute("code"))
+        vId=vendor.getAttribute("vendor-id")
+        vendor_id2code.setdefault(vId,vCode)
+        vendor_code2id.setdefault(vCode,vId)
+    tables["vendor_id2code"]=vendor_id2code
+    tables["vendor_code2id"]=vendor_code2id
+    command_name2code={}
+    command_code2name={}
+    for command in doc.getElementsByTagName("command"):
+        cName=command.getAttribute("name")
+        cCode=int(command.getAttribute("code"))
+        command_name2code.setdefault(cName,cCode)
+        command_code2name[cCode]=cName
+    tables["command_name2code"]=command_name2code
+    tables["command_code2name"]=command_code2name
+    # AVP definitions (AVPDef fields), indexed by position in avps list
+    avps=[]
+    avp_byname={}
+    avp_bycode={}
+    # Enum codes by AVP name and enum name, enum names by AVP name and code
+    enum_byname={}
+    enum_bycode={}
+    for avp in doc.getElementsByTagName("avp"):
+        vId=avp.getAttribute("vendor-id")
+        if vId=="":
+            vId="None"
+            vCode=0
+        else:
+            vCode=vendor_id2code.get(vId)
+        A=(int(avp.getAttribute("code")),avp.getAttribute("name"),vCode,vId,
+           avp.getAttribute("type"),avp.getAttribute("mandatory"))
+        if A[1] not in avp_byname:
+            avp_byname[A[1]]=len(avps)
+            enums={}
+            names={}
+            for e in avp.getElementsByTagName("enum"):
+                eName=e.getAttribute("name")
+                eCode=int(e.getAttribute("code"))
+                enums.setdefault(eName,eCode)
+                names.setdefault(eCode,eName)
+            if len(enums)>0:
+                enum_byname[A[1]]=enums
+                enum_bycode[A[1]]=names
+        if vCode is not None:
+            avp_bycode.setdefault((A[0],vCode),len(avps))
+        avps.append(A)
+    tables["avps"]=avps
+    tables["avp_byname"]=avp_byname
+    tables["avp_bycode"]=avp_bycode
+    tables["enum_byname"]=enum_byname
+    tables["enum_bycode"]=enum_bycode
+    doc.unlink()
+    return tables
+
+# Compiled tables from cache file, None if missing or out of date
+def readDictCache(cacheFile,key):
+    try:
+        f=open(cacheFile,"rb")
+        try:
+            (cacheKey,tables)=marshal.load(f)
+        finally:
+            f.close()
+    except (IOError,OSError,EOFError,ValueError,TypeError):
+        return None
+    if cacheKey!=key:
+        return None
+    return tables
+
+# Write compiled tables to cache file (through a temporary file renamed
+# over it, as several processes may load the dictionary at once)
+def writeDictCache(cacheFile,key,tables):
+    tmpFile="%s.%d.tmp" % (cacheFile,os.getpid())
+    try:
+        f=open(tmpFile,"wb")
+        try:
+            marshal.dump((key,tables),f)
+        finally:
+            f.close()
+        os.rename(tmpFile,cacheFile)
+    except (IOError,OSError):
+        # Read-only location, dictionary is compiled on every load
+        try:
+            os.remove(tmpFile)
+        except OSError:
+            pass
+
+# Set dictionary globals from compiled tables
+def installDictionary(tables):
     global asString
     global asUTF8
     global asU32
@@ -74,141 +220,111 @@ def LoadDictionary(file):
     global asIPAddress
     global asIP
     global asTime
-    doc = minidom.parse(file)
-    node = doc.documentElement
-    dict_avps = doc.getElementsByTagName("avp")
-    dict_vendors = doc.getElementsByTagName("vendor")
-    dict_commands=doc.getElementsByTagName("command")
-    # Now lets process typedefs
-    asString=["OctetString"]
-    asUTF8=["UTF8String"]
-    asI32=["Integer32"]
-    asU32=["Unsigned32"]
-    asF32=["Float32"]
-    asI64=["Integer64"]
-    asU64=["Unsigned64"]
-    asF64=["Float64"]
-    asIPAddress=["IPAddress"]
-    asIP=["IP"]    
-    asTime=["Time"]    
-    dict_typedefs=doc.getElementsByTagName("typedef")
-    for td in dict_typedefs:
-        tName=td.getAttribute("name")
-        tType=td.getAttribute("type")
-        if tType in asString:
-           asString.append(tName)
-        if tType in asUTF8:
-           asUTF8.append(tName)
-        if tType in asU32:
-           asU32.append(tName)
-        if tType in asI32:
-           asI32.append(tName)
-        if tType in asI64:
-           asI64.append(tName)    
-        if tType in asU64:
-           asU64.append(tName)           
-        if tType in asF32:
-           asF32.append(tName)           
-        if tType in asF64:
-           asF64.append(tName)           
-        if tType in asIPAddress:
-           asIPAddress.append(tName)
-        if tType in asIP:
-           asIP.append(tName)           
-        if tType in asTime:
-           asTime.append(tName)   
-        
+    global dict_vendor_id2code
+    global dict_vendor_code2id
+    global dict_command_name2code
+    global dict_command_code2name
+    global dict_avp_byname
+    global dict_avp_bycode
+    global dict_enum_byname
+    global dict_enum_bycode
+    types=tables["types"]
+    asString=types["asString"]
+    asUTF8=types["asUTF8"]
+    asU32=types["asU32"]
+    asI32=types["asI32"]
+    asU64=types["asU64"]
+    asI64=types["asI64"]
+    asF32=types["asF32"]
+    asF64=types["asF64"]
+    asIPAddress=types["asIPAddress"]
+    asIP=types["asIP"]
+    asTime=types["asTime"]
+    dict_vendor_id2code=tables["vendor_id2code"]
+    dict_vendor_code2id=tables["vendor_code2id"]
+    dict_command_name2code=tables["command_name2code"]
+    dict_command_code2name=tables["command_code2name"]
+    avps=[AVPDef._make(A) for A in tables["avps"]]
+    dict_avp_byname=dict((name,avps[i])
+        for (name,i) in tables["avp_byname"].iteritems())
+    dict_avp_bycode=dict((key,avps[i])
+        for (key,i) in tables["avp_bycode"].iteritems())
+    dict_enum_byname=tables["enum_byname"]
+    dict_enum_bycode=tables["enum_bycode"]
+    buildCodecs()
+    clearAVPCache()
+
 # Find AVP definition in dictionary: User-Name->1
 # on finish A contains all data
 def dictAVPname2code(A,avpname,avpvalue):
-    global dict_avps
-    dbg="Searching dictionary for N",avpname,"V",avpvalue
-    # logging.debug(dbg)
-    for avp in dict_avps:
-        A.name = avp.getAttribute("name")
-        A.code = avp.getAttribute("code")
-        A.mandatory=avp.getAttribute("mandatory")
-        A.type = avp.getAttribute("type")
-        vId = avp.getAttribute("vendor-id")
-        if avpname==A.name:
-           if vId=="":
-                A.vendor=0
-           else:
-                A.vendor=dictVENDORid2code(vId)
-           return
-    dbg="Searching dictionary failed for N",avpname,"V",avpvalue
-    bailOut(dbg)
+    avp=dict_avp_byname.get(avpname)
+    if avp is None:
+        dbg="Searching dictionary failed for N",avpname,"V",avpvalue
+        bailOut(dbg)
+    A.name=avp.name
+    A.code=avp.code
+    A.mandatory=avp.mandatory
+    A.type=avp.type
+    if avp.vendor is None:
+        dbg="Searching Vendor dictionary failed for V",avp.vendor_id
+        bailOut(dbg)
+    A.vendor=avp.vendor
+    return
 
 # Find AVP definition in dictionary: 1->User-Name
 # on finish A contains all data
 def dictAVPcode2name(A,avpcode,vendorcode):
-    global dict_avps
-    dbg="Searching dictionary for ","C",avpcode,"V",vendorcode
-    # logging.debug(dbg)
     A.vendor=dictVENDORcode2id(int(vendorcode))
-    for avp in dict_avps:
-        A.name = avp.getAttribute("name")
-        A.type = avp.getAttribute("type")
-        A.code = int(avp.getAttribute("code"))
-        A.mandatory=avp.getAttribute("mandatory")
-        vId = avp.getAttribute("vendor-id")
-        if int(avpcode)==A.code:
-            if vId=="":
-               vId="None"
-            if vId==A.vendor:
-               return 
+    avp=dict_avp_bycode.get((int(avpcode),int(vendorcode)))
+    if avp is not None:
+        A.name=avp.name
+        A.type=avp.type
+        A.code=avp.code
+        A.mandatory=avp.mandatory
+        return
     # logging.info("Unsuccessful search")
     A.code=avpcode
     A.name="Unknown Attr-"+str(A.code)+" (Vendor:"+A.vendor+")"
     A.type="OctetString"
     return 
 
+# Find Enum definition in dictionary: Accounting-Record-Type,Start Record->2
+# Result: enum code, None if AVP has no such enum
+def dictENUMname2code(avpname,enumname):
+    return dict_enum_byname.get(avpname,{}).get(enumname)
+
+# Find Enum definition in dictionary: Accounting-Record-Type,2->Start Record
+# Result: enum name, None if AVP has no such enum
+def dictENUMcode2name(avpname,enumcode):
+    return dict_enum_bycode.get(avpname,{}).get(enumcode)
+
 # Find Vendor definition in dictionary: 10415->TGPP    
 def dictVENDORcode2id(code):
-    global dict_vendors
-    dbg="Searching Vendor dictionary for C",code
-    # logging.debug(dbg)
-    for vendor in dict_vendors:
-        vCode=vendor.getAttribute("code")
-        vId=vendor.getAttribute("vendor-id")
-        if code==int(vCode):
-            return vId
-    dbg="Searching Vendor dictionary failed for C",code
-    bailOut(dbg)
+    vId=dict_vendor_code2id.get(code)
+    if vId is None:
+        dbg="Searching Vendor dictionary failed for C",code
+        bailOut(dbg)
+    return vId
 
 # Find Vendor definition in dictionary: TGPP->10415    
 def dictVENDORid2code(vendor_id):
-    global dict_vendors
-    dbg="Searching Vendor dictionary for V",vendor_id
-    # logging.debug(dbg)
-    for vendor in dict_vendors:
-        Code=vendor.getAttribute("code")
-        vId=vendor.getAttribute("vendor-id")
-        if vendor_id==vId:
-            return int(Code)
-    dbg="Searching Vendor dictionary failed for V",vendor_id
-    bailOut(dbg)
+    Code=dict_vendor_id2code.get(vendor_id)
+    if Code is None:
+        dbg="Searching Vendor dictionary failed for V",vendor_id
+        bailOut(dbg)
+    return Code
 
 # Find Command definition in dictionary: Capabilities-Exchange->257    
 def dictCOMMANDname2code(name):
-    global dict_commands
-    for command in dict_commands:
-         cName=command.getAttribute("name")
-         cCode=command.getAttribute("code")
-         if cName==name:
-            return int(cCode)
-    dbg="Searching CMD dictionary failed for N",name
-    bailOut(dbg)
+    cCode=dict_command_name2code.get(name)
+    if cCode is None:
+        dbg="Searching CMD dictionary failed for N",name
+        bailOut(dbg)
+    return cCode
 
 # Find Command definition in dictionary: 257->Capabilities-Exchange
 def dictCOMMANDcode2name(flags,code):
-    global dict_commands
-    cmd=ERROR
-    for command in dict_commands:
-         cName=command.getAttribute("name")
-         cCode=command.getAttribute("code")
-         if code==int(cCode):
-            cmd=cName
+    cmd=dict_command_code2name.get(code,ERROR)
     if cmd==ERROR:
         return cmd
     if flags&DIAMETER_HDR_REQUEST==DIAMETER_HDR_REQUEST:
@@ -356,8 +472,6 @@ def decode_IP(data):
     
 def decode_OctetString(data,dlen):
     fs="!"+str(dlen-8)+"s"
-    dbg="Deconding String with format:",fs
-    # logging.debug(dbg)
     ret=struct.unpack(fs,data.decode("hex")[0:dlen-8])[0]
     return ret
 
@@ -370,14 +484,11 @@ def decode_OctetString(data,dlen):
 #Note:0xF5-0xFF cannot occur    
 def decode_UTF8String(data,dlen):
     fs="!"+str(dlen-8)+"s"
-    dbg="Decoding UTF8 format:",fs
-    # logging.debug(dbg)
     ret=struct.unpack(fs,data.decode("hex")[0:dlen-8])[0]
     utf8=utf8decoder(ret)
     return utf8[0]
 
 def decode_Grouped(data):
-    dbg="Decoding Grouped:"
     ret=[]
     for gmsg in splitMsgAVPs(data):
         ret.append(decodeAVP(gmsg))
@@ -388,7 +499,73 @@ def decode_Time(data):
     seconds_between_1900_and_1970 = ((70*365)+17)*86400
     ret=struct.unpack("!I",data.decode("hex"))[0]
     return int(ret)-seconds_between_1900_and_1970
-    
+
+#----------------------------------------------------------------------
+#
+# Binary decoding section
+# Input: buffer (str, bytearray or memoryview) with AVP data at msg[start:end]
+#
+
+def decode_Integer32Bin(msg,start,end):
+    ret=struct.unpack_from("!I",msg,start)[0]
+    return int(ret)
+
+def decode_Integer64Bin(msg,start,end):
+    ret=struct.unpack_from("!Q",msg,start)[0]
+    return int(ret)
+
+def decode_Unsigned32Bin(msg,start,end):
+    ret=struct.unpack_from("!I",msg,start)[0]
+    return int(ret)
+
+def decode_Unsigned64Bin(msg,start,end):
+    ret=struct.unpack_from("!Q",msg,start)[0]
+    return int(ret)
+
+def decode_Float32Bin(msg,start,end):
+    return struct.unpack_from("!f",msg,start)[0]
+
+def decode_Float64Bin(msg,start,end):
+    return struct.unpack_from("!d",msg,start)[0]
+
+# Skip 2 bytes of address family
+def decode_AddressBin(msg,start,end):
+    if end-start<=8:
+        ret=inet_ntop(socket.AF_INET,struct.unpack_from("!4s",msg,start+2)[0])
+    else:
+        ret=inet_ntop(socket.AF_INET6,struct.unpack_from("!16s",msg,start+2)[0])
+    return ret
+
+def decode_IPBin(msg,start,end):
+    if end-start<=8:
+        ret=inet_ntop(socket.AF_INET,struct.unpack_from("!4s",msg,start)[0])
+    else:
+        ret=inet_ntop(socket.AF_INET6,struct.unpack_from("!16s",msg,start)[0])
+    return ret
+
+def decode_OctetStringBin(msg,start,end):
+    fs="!"+str(end-start)+"s"
+    return struct.unpack_from(fs,msg,start)[0]
+
+def decode_UTF8StringBin(msg,start,end):
+    fs="!"+str(end-start)+"s"
+    ret=struct.unpack_from(fs,msg,start)[0]
+    return utf8decoder(ret)[0]
+
+def decode_GroupedBin(msg,start,end):
+    ret=[]
+    for (offset,plen) in indexAVPsBin(msg,start,end):
+        ret.append(decodeAVPBin(msg,offset))
+    return ret
+
+def decode_EnumeratedBin(msg,start,end):
+    return struct.unpack_from("!I",msg,start)[0]
+
+def decode_TimeBin(msg,start,end):
+    seconds_between_1900_and_1970 = ((70*365)+17)*86400
+    ret=struct.unpack_from("!I",msg,start)[0]
+    return int(ret)-seconds_between_1900_and_1970
+
 #----------------------------------------------------------------------
     
 # Quit program with error
@@ -422,93 +599,139 @@ def encode_finish(A,flags,pktlen,data):
        ret=("%08X" % int(A.vendor)) + ret
        flags|=DIAMETER_FLAG_VENDOR
        pktlen+=4
-    dbg="Packing","C:",A.code,"F:",flags,"V:",A.vendor,"L:",pktlen,"D:",ret
-    # logging.debug(dbg)
     ret=("%08X"%int(A.code))+("%02X"%int(flags))+("%06X"%pktlen)+ret
     return ret
-    
+
+# Common start routine for all binary encoded AVPs
+# Allocates buffer for AVP with <dlen> bytes of data (padding included)
+# and packs AVP header into it
+# Result is (buffer,offset of data in buffer)
+def encode_start(A,flags,dlen):
+    hlen=8
+    if A.vendor!=0:
+        flags|=DIAMETER_FLAG_VENDOR
+        hlen=12
+    pktlen=hlen+dlen
+    ret=bytearray(calc_padding(pktlen))
+    struct.pack_into("!II",ret,0,int(A.code),(int(flags)<<24)|pktlen)
+    if hlen==12:
+        struct.pack_into("!I",ret,8,int(A.vendor))
+    return (ret,hlen)
+
+# Encode fixed size value using struct format <fs>
+def encode_packBin(A,flags,fs,data):
+    (ret,offset)=encode_start(A,flags,struct.calcsize(fs))
+    struct.pack_into(fs,ret,offset,data)
+    return ret
+
+def encode_OctetStringBin(A,flags,data):
+    (ret,offset)=encode_start(A,flags,len(data))
+    ret[offset:offset+len(data)]=data
+    return ret
+
+def encode_UTF8StringBin(A,flags,data):
+    utf8data=utf8encoder(data)[0]
+    return encode_OctetStringBin(A,flags,utf8data)
+
+def encode_Integer32Bin(A,flags,data):
+    return encode_packBin(A,flags,"!I",data)
+
+def encode_Unsigned32Bin(A,flags,data):
+    return encode_packBin(A,flags,"!I",int(data))
+
+def encode_Float32Bin(A,flags,data):
+    return encode_packBin(A,flags,"!f",data)
+
+def encode_Integer64Bin(A,flags,data):
+    return encode_packBin(A,flags,"!Q",data)
+
+def encode_Unsigned64Bin(A,flags,data):
+    return encode_packBin(A,flags,"!Q",data)
+
+def encode_Float64Bin(A,flags,data):
+    return encode_packBin(A,flags,"!d",data)
+
+def encode_AddressBin(A,flags,data):
+    return encode_OctetStringBin(A,flags,pack_address(data))
+
+def encode_IPBin(A,flags,data):
+    return encode_OctetStringBin(A,flags,pack_address(data)[2:])
+
+def encode_EnumeratedBin(A,flags,data):
+    if isinstance(data,str):
+        # Replace with enum code value
+        code=dict_enum_byname.get(A.name,{}).get(data)
+        if code is None:
+            dbg="Enum name=",data,"not found for AVP",A.name
+            bailOut(dbg)
+        return encode_Integer32Bin(A,flags,code)
+    else:
+        return encode_Integer32Bin(A,flags,data)
+
+#AVP_Time contains a second count since 1900    
+#But unix counts time from EPOCH (1.1.1970)
+def encode_TimeBin(A,flags,data):
+    seconds_between_1900_and_1970 = ((70*365)+17)*86400 
+    return encode_packBin(A,flags,"!I",data+seconds_between_1900_and_1970)
+
+# Grouped AVP from list of binary encoded AVPs
+# Children are copied directly into AVP buffer (padding added)
+def encode_GroupedBin(A,flags,data):
+    dlen=0
+    for avp in data:
+        dlen+=calc_padding(len(avp))
+    (ret,offset)=encode_start(A,flags,dlen)
+    copyAVPs(ret,offset,data)
+    return ret
+
+# Hex versions of encoding routines
+# Result is encoded AVP as hex string (padding is added separately)
 def encode_OctetString(A,flags,data):
-    fs="!"+str(len(data))+"s"
-    dbg="Encoding String format:",fs
-    # logging.debug(dbg)
-    ret=struct.pack(fs,data).encode("hex")
-    pktlen=8+len(ret)/2
-    return encode_finish(A,flags,pktlen,ret)
+    return hexAVP(encode_OctetStringBin(A,flags,data))
 
 def encode_UTF8String(A,flags,data):
-    utf8data=utf8encoder(data)[0]
-    fs="!"+str(len(utf8data))+"s"
-    dbg="Encoding UTF8",utf8data,"L",len(utf8data),"F",fs
-    # logging.debug(dbg)
-    ret=struct.pack(fs,utf8data).encode("hex")
-    pktlen=8+len(ret)/2
-    return encode_finish(A,flags,pktlen,ret)
+    return hexAVP(encode_UTF8StringBin(A,flags,data))
     
 def encode_Integer32(A,flags,data):
-    r=struct.pack("!I",data)
-    ret=r.encode("hex")
-    pktlen=12
-    return encode_finish(A,flags,pktlen,ret)
+    return hexAVP(encode_Integer32Bin(A,flags,data))
 
 def encode_Unsigned32(A,flags,data):
-    r=struct.pack("!I",int(data))
-    ret=r.encode("hex")
-    pktlen=12
-    return encode_finish(A,flags,pktlen,ret)
+    return hexAVP(encode_Unsigned32Bin(A,flags,data))
 
 def encode_Float32(A,flags,data):
-    ret=struct.pack("!f",data).encode("hex")
-    pktlen=12
-    return encode_finish(A,flags,pktlen,ret)
+    return hexAVP(encode_Float32Bin(A,flags,data))
     
 def encode_Integer64(A,flags,data):
-    ret=struct.pack("!Q",data).encode("hex")
-    pktlen=16
-    return encode_finish(A,flags,pktlen,ret)
+    return hexAVP(encode_Integer64Bin(A,flags,data))
 
 def encode_Unsigned64(A,flags,data):
-    ret=struct.pack("!Q",data).encode("hex")
-    pktlen=16
-    return encode_finish(A,flags,pktlen,ret)
+    return hexAVP(encode_Unsigned64Bin(A,flags,data))
 
 def encode_Float64(A,flags,data):
-    ret=struct.pack("!d",data).encode("hex")
-    pktlen=16
-    return encode_finish(A,flags,pktlen,ret)
+    return hexAVP(encode_Float64Bin(A,flags,data))
 
 def encode_Address(A,flags,data):
-    ret=pack_address(data).encode("hex")
-    pktlen=8+len(ret)/2
-    return encode_finish(A,flags,pktlen,ret)
+    return hexAVP(encode_AddressBin(A,flags,data))
     
 def encode_IP(A,flags,data):
-    ret=pack_address(data).encode("hex")[4:]
-    pktlen=8+len(ret)/2
-    return encode_finish(A,flags,pktlen,ret)    
+    return hexAVP(encode_IPBin(A,flags,data))
 
 def encode_Enumerated(A,flags,data):
-    global dict_avps
-    if isinstance(data,str):
-        # Replace with enum code value
-        for avp in dict_avps:
-            Name = avp.getAttribute("name")
-            if Name==A.name:
-                for e in avp.getElementsByTagName("enum"):
-                    if data==e.getAttribute("name"):
-                        return encode_Integer32(A,flags,int(e.getAttribute("code")))
-                dbg="Enum name=",data,"not found for AVP",A.name
-                bailOut(dbg)
-    else:
-        return encode_Integer32(A,flags,data)
+    return hexAVP(encode_EnumeratedBin(A,flags,data))
     
-#AVP_Time contains a second count since 1900    
-#But unix counts time from EPOCH (1.1.1970)
 def encode_Time(A,flags,data):
-    seconds_between_1900_and_1970 = ((70*365)+17)*86400 
-    r=struct.pack("!I",data+seconds_between_1900_and_1970)
-    ret=r.encode("hex")
-    pktlen=12
-    return encode_finish(A,flags,pktlen,ret)
+    return hexAVP(encode_TimeBin(A,flags,data))
+
+# Binary AVP (padded or not) to hex string without padding
+def hexAVP(avp):
+    pktlen=struct.unpack_from("!I",avp,4)[0]&0x00FFFFFF
+    return bufferBytes(avp[:pktlen]).encode("hex")
+
+# Contents of binary buffer as str
+def bufferBytes(buf):
+    if isinstance(buf,memoryview):
+        return buf.tobytes()
+    return str(buf)
 
 #----------------------------------------------------------------------     
 #Set mandatory flag as specified in dictionary
@@ -518,70 +741,332 @@ def checkMandatory(mandatory):
         flags|=DIAMETER_FLAG_MANDATORY
     return flags
     
+def do_encodeBin(A,flags,data):
+    return dict_type_encoders.get(A.type,encode_OctetStringBin)(A,flags,data)
+
 def do_encode(A,flags,data):
-    if A.type in asUTF8:
-        return encode_UTF8String(A,flags,data)
-    if A.type in asI32:
-        return encode_Integer32(A,flags,data)
-    if A.type in asU32:
-        return encode_Unsigned32(A,flags,data)
-    if A.type in asI64:
-        return encode_Integer64(A,flags,data)
-    if A.type in asU64:
-        return encode_Unsigned64(A,flags,data)
-    if A.type in asF32:
-        return encode_Float32(A,flags,data)
-    if A.type in asF64:
-        return encode_Float64(A,flags,data)
-    if A.type in asIPAddress:
-        return encode_Address(A,flags,data)
-    if A.type in asIP:
-        return encode_IP(A,flags,data)        
-    if A.type in asTime:
-        return encode_Time(A,flags,data)
-    if A.type=="Enumerated":
-        return encode_Enumerated(A,flags,data)
-    # default is OctetString  
-    return encode_OctetString(A,flags,data) 
+    return hexAVP(do_encodeBin(A,flags,data))
+
+#----------------------------------------------------------------------
+# Specialized codecs per AVP definition
+# Every AVP gets an encoder with AVP header (code, flags, vendor) and
+# struct format already bound, and a decoder entry (name,type,decode
+# function) by (code,vendor), so encoding or decoding an AVP is a single
+# dict lookup and call, without testing type lists
+
+# Fixed size values: struct format and value conversion, by encode routine
+def encodeUTF8(data):
+    return utf8encoder(data)[0]
+
+def encodeIP(data):
+    return pack_address(data)[2:]
+
+def encodeTime(data):
+    seconds_between_1900_and_1970 = ((70*365)+17)*86400
+    return data+seconds_between_1900_and_1970
+
+packFormats={
+    encode_Integer32Bin:("I",None),
+    encode_Unsigned32Bin:("I",int),
+    encode_Float32Bin:("f",None),
+    encode_Integer64Bin:("Q",None),
+    encode_Unsigned64Bin:("Q",None),
+    encode_Float64Bin:("d",None),
+    encode_TimeBin:("I",encodeTime),
+    encode_EnumeratedBin:("I",None)}
+
+# Variable size values: value conversion to bytes, by encode routine
+octetConversions={
+    encode_OctetStringBin:None,
+    encode_UTF8StringBin:encodeUTF8,
+    encode_AddressBin:pack_address,
+    encode_IPBin:encodeIP}
+
+# Decoded value of Enumerated AVPs:
+# ENUM_RAW as raw 4 bytes (OctetString), ENUM_CODE as integer code,
+# ENUM_NAME as enum name from dictionary (integer code if not defined)
+ENUM_RAW=0
+ENUM_CODE=1
+ENUM_NAME=2
+enumDecoding=ENUM_RAW
+
+# Select how Enumerated AVPs are decoded (ENUM_RAW by default)
+def setEnumDecoding(mode):
+    global enumDecoding
+    if mode not in (ENUM_RAW,ENUM_CODE,ENUM_NAME):
+        dbg="Invalid Enumerated decoding",mode
+        bailOut(dbg)
+    enumDecoding=mode
+    if "dict_type_decoders" in globals():
+        buildCodecs()
+
+# Build type dispatch tables and per-AVP codecs for loaded dictionary
+# Type lists are tested in the order do_encodeBin/decodeAVPDataBin used
+def buildCodecs():
+    global dict_type_encoders
+    global dict_type_decoders
+    global dict_avp_encoders
+    global dict_avp_decoders
+    dict_type_encoders={}
+    for (types,encode) in ((asUTF8,encode_UTF8StringBin),
+                           (asI32,encode_Integer32Bin),
+                           (asU32,encode_Unsigned32Bin),
+                           (asI64,encode_Integer64Bin),
+                           (asU64,encode_Unsigned64Bin),
+                           (asF32,encode_Float32Bin),
+                           (asF64,encode_Float64Bin),
+                           (asIPAddress,encode_AddressBin),
+                           (asIP,encode_IPBin),
+                           (asTime,encode_TimeBin),
+                           (["Enumerated"],encode_EnumeratedBin)):
+        for t in types:
+            dict_type_encoders.setdefault(t,encode)
+    dict_type_decoders={}
+    for (types,decode) in ((asI32,decode_Integer32Bin),
+                           (asI64,decode_Integer64Bin),
+                           (asU32,decode_Unsigned32Bin),
+                           (asU64,decode_Unsigned64Bin),
+                           (asF32,decode_Float32Bin),
+                           (asF64,decode_Float64Bin),
+                           (asUTF8,decode_UTF8StringBin),
+                           (asIPAddress,decode_AddressBin),
+                           (asIP,decode_IPBin),
+                           (asTime,decode_TimeBin),
+                           (["Grouped"],decode_GroupedBin)):
+        for t in types:
+            dict_type_decoders.setdefault(t,decode)
+    if enumDecoding!=ENUM_RAW:
+        dict_type_decoders.setdefault("Enumerated",decode_EnumeratedBin)
+    # Codecs are made on first use of each AVP, few AVPs being used
+    dict_avp_encoders={}
+    dict_avp_decoders={}
+
+# Encoders of AVP definition A: (value encoder, Grouped value encoder)
+# Result is also kept in dict_avp_encoders, by AVP name
+def makeAVPEncoders(A):
+    if A.name=="" or A.code==0 or A.type=="":
+        encoders=(encodeNothing,encodeNothing)
+        dict_avp_encoders[A.name]=encoders
+        return encoders
+    mflags=checkMandatory(A.mandatory)
+    code=int(A.code)
+    vendor=int(A.vendor)
+    flags=mflags
+    hfmt="!II"
+    if vendor!=0:
+        flags|=DIAMETER_FLAG_VENDOR
+        hfmt="!III"
+    encode=dict_type_encoders.get(A.type,encode_OctetStringBin)
+    if encode in packFormats:
+        (vfmt,convert)=packFormats[encode]
+        if encode==encode_EnumeratedBin:
+            convert=makeEnumConversion(A)
+        encoder=makePackEncoder(struct.Struct(hfmt+vfmt),code,flags,
+                                vendor,convert)
+    else:
+        encoder=makeOctetEncoder(struct.Struct(hfmt),code,flags,vendor,
+                                 octetConversions[encode])
+    def encodeGrouped(data):
+        return encode_GroupedBin(A,mflags,data)
+    encoders=(encoder,encodeGrouped)
+    dict_avp_encoders[A.name]=encoders
+    return encoders
+
+def encodeNothing(data):
+    return ""
+
+# Whole AVP packed at once: header and fixed size value (no padding needed)
+def makePackEncoder(S,code,flags,vendor,convert):
+    flagsLen=(flags<<24)|S.size
+    if vendor!=0:
+        if convert is None:
+            return lambda data: bytearray(S.pack(code,flagsLen,vendor,data))
+        return lambda data: bytearray(S.pack(code,flagsLen,vendor,convert(data)))
+    if convert is None:
+        return lambda data: bytearray(S.pack(code,flagsLen,data))
+    return lambda data: bytearray(S.pack(code,flagsLen,convert(data)))
+
+# Header packed into buffer sized for value and padding, value copied after
+def makeOctetEncoder(H,code,flags,vendor,convert):
+    hlen=H.size
+    flags=flags<<24
+    def encoder(data):
+        if convert is not None:
+            data=convert(data)
+        dlen=len(data)
+        pktlen=hlen+dlen
+        ret=bytearray((pktlen+3)&~3)
+        if vendor!=0:
+            H.pack_into(ret,0,code,flags|pktlen,vendor)
+        else:
+            H.pack_into(ret,0,code,flags|pktlen)
+        ret[hlen:pktlen]=data
+        return ret
+    return encoder
+
+# Enum names of AVP replaced with their code
+def makeEnumConversion(A):
+    enums=dict_enum_byname.get(A.name,{})
+    def convert(data):
+        if isinstance(data,str):
+            code=enums.get(data)
+            if code is None:
+                dbg="Enum name=",data,"not found for AVP",A.name
+                bailOut(dbg)
+            return code
+        return data
+    return convert
+
+# Enum codes of AVP replaced with their name when decoding
+def makeEnumDecoder(A):
+    names=dict_enum_bycode.get(A.name,{})
+    unpack=struct.Struct("!I").unpack_from
+    def decoder(msg,start,end):
+        code=unpack(msg,start)[0]
+        return names.get(code,code)
+    return decoder
+
+# Decoder of AVP with <code> and <vendor> code: (name,type,decode function)
+# Result is kept in dict_avp_decoders, except for AVPs missing from
+# dictionary (decoded as OctetString), as peers may send any code
+def getAVPDecoder(code,vendor):
+    decoder=dict_avp_decoders.get((code,vendor))
+    if decoder is None:
+        A=AVPItem()
+        dictAVPcode2name(A,code,vendor)
+        if enumDecoding==ENUM_NAME and A.type=="Enumerated":
+            decoder=(A.name,A.type,makeEnumDecoder(A))
+        else:
+            decoder=(A.name,A.type,
+                dict_type_decoders.get(A.type,decode_OctetStringBin))
+        if (code,vendor) in dict_avp_bycode:
+            dict_avp_decoders[(code,vendor)]=decoder
+    return decoder
+
+# Find AVP Definition in dictionary and encode it as binary
+def getAVPDefBin(AVP_Name,AVP_Value):
+    encoders=dict_avp_encoders.get(AVP_Name)
+    if encoders is None:
+        A=AVPItem()
+        dictAVPname2code(A,AVP_Name,AVP_Value)
+        encoders=makeAVPEncoders(A)
+    if isinstance(AVP_Value,list):
+        return encoders[1](AVP_Value)
+    return encoders[0](AVP_Value)
 
 # Find AVP Definition in dictionary and encode it
 def getAVPDef(AVP_Name,AVP_Value):
-    A=AVPItem()
-    dictAVPname2code(A,AVP_Name,AVP_Value)
-    if A.name=="":
-       # logging.error("AVP with that name not found")
-       return ""
-    if A.code==0:
-       # logging.error("AVP Code not found")
-       return ""
-    if A.type=="":
-       # logging.error("AVP type not defined")
-       return ""
-    if A.vendor<0:
-       # logging.error("Vendor ID does not match")
-       return ""
-    else:
-        data=AVP_Value
-    dbg="AVP dictionary def","N",A.name,"C",A.code,"M",A.mandatory,"T",A.type,"V",A.vendor,"D",data
-    # logging.debug(dbg)
-    flags=checkMandatory(A.mandatory)
-    return do_encode(A,flags,data)
+    ret=getAVPDefBin(AVP_Name,AVP_Value)
+    if ret=="":
+        return ret
+    return hexAVP(ret)
+
+#----------------------------------------------------------------------
+# Memoized encoding of constant AVP values
+# Same (AVP name, value) pairs are encoded on every message (Origin-Host,
+# Origin-Realm, Result-Code...), so scalar values are encoded once and
+# cached. Cache is bounded: entries live in two generations, a hit in the
+# previous generation moves the entry to the current one, and once the
+# current generation holds half the entries it replaces the previous one,
+# dropping entries not used for a whole generation (approximated LRU,
+# without reordering anything on hits)
+
+# Values of these exact types are cached (not bool, nor lists of Grouped)
+AVP_CACHE_TYPES=frozenset([int,long,str,unicode])
+AVP_CACHE_SIZE=4096
+
+class AVPCache:
+    def __init__(self,maxsize=AVP_CACHE_SIZE):
+        self.maxsize=maxsize
+        self.current={}
+        self.previous={}
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+    # Cached value for key, None if not cached
+    def get(self,key):
+        value=self.current.get(key)
+        if value is None:
+            value=self.previous.pop(key,None)
+            if value is None:
+                self.misses+=1
+                return None
+            self.store(key,value)
+        self.hits+=1
+        return value
+
+    def store(self,key,value):
+        if self.maxsize<=0:
+            return
+        if len(self.current)>=(self.maxsize+1)//2:
+            self.evictions+=len(self.previous)
+            self.previous=self.current
+            self.current={}
+        self.current[key]=value
+
+    def clear(self):
+        self.current={}
+        self.previous={}
+
+    def stats(self):
+        return {"hits":self.hits,"misses":self.misses,
+                "evictions":self.evictions,"maxsize":self.maxsize,
+                "size":len(self.current)+len(self.previous)}
+
+# Hex encoded AVPs (str) and binary encoded AVPs (immutable copies)
+avpCacheHex=AVPCache()
+avpCacheBin=AVPCache()
+
+# Set max number of cached values per encoding, 0 disables caching
+def setAVPCacheSize(maxsize):
+    for cache in (avpCacheHex,avpCacheBin):
+        cache.maxsize=maxsize
+        cache.clear()
+
+# Drop cached values, e.g. when loading another dictionary
+def clearAVPCache():
+    avpCacheHex.clear()
+    avpCacheBin.clear()
+    groupHeaders.clear()
+    avpPaths.clear()
+
+# Hit/miss statistics, per encoding
+def getAVPCacheStats():
+    return {"hex":avpCacheHex.stats(),"bin":avpCacheBin.stats()}
 
 ################################
 # Main encoding routine  
+# Value of Grouped AVP is list of hex encoded AVPs
 def encodeAVP(AVP_Name,AVP_Value):
+    if type(AVP_Value) in AVP_CACHE_TYPES:
+        key=(AVP_Name,AVP_Value)
+        ret=avpCacheHex.get(key)
+        if ret is None:
+            ret=getAVPDef(AVP_Name,AVP_Value)
+            if ret!="":
+                avpCacheHex.store(key,ret)
+        return ret
     if type(AVP_Value).__name__=='list':
-        p=''
-        for x in AVP_Value:
-            while len(x)/2<calc_padding(len(x)/2):
-                x=x+'00'
-            p=p+x
-        msg=getAVPDef(AVP_Name,p.decode("hex"))
-    else:
-        msg=getAVPDef(AVP_Name,AVP_Value)
-    dbg="AVP",AVP_Name,AVP_Value,"Encoded as:",msg
-    # logging.info(dbg)
-    return msg
+        AVP_Value=[x.decode("hex") for x in AVP_Value]
+    return getAVPDef(AVP_Name,AVP_Value)
+
+################################
+# Main binary encoding routine  
+# Value of Grouped AVP is list of binary encoded AVPs
+# Result is bytearray with encoded AVP, padding included
+def encodeAVPBin(AVP_Name,AVP_Value):
+    if type(AVP_Value) in AVP_CACHE_TYPES:
+        key=(AVP_Name,AVP_Value)
+        ret=avpCacheBin.get(key)
+        if ret is None:
+            ret=getAVPDefBin(AVP_Name,AVP_Value)
+            if len(ret)>0:
+                avpCacheBin.store(key,bytes(ret))
+            return ret
+        # Copy, as callers may modify the returned bytearray
+        return bytearray(ret)
+    return getAVPDefBin(AVP_Name,AVP_Value)
 
 # Calculate message padding
 def calc_padding(msg_len):
@@ -592,88 +1077,144 @@ def calc_padding(msg_len):
 # Main decoding routine  
 # Input: single AVP as HEX string
 def decodeAVP(msg):
-    (scode,msg)=chop_msg(msg,8)
-    (sflag,msg)=chop_msg(msg,2)
-    (slen,msg)=chop_msg(msg,6)
-    dbg="Decoding ","C",scode,"F",sflag,"L",slen,"D",msg
-    # logging.debug(dbg)
-    mcode=struct.unpack("!I",scode.decode("hex"))[0]
-    mflags=ord(sflag.decode("hex"))
-    data_len=struct.unpack("!I","\00"+slen.decode("hex"))[0]
+    return decodeAVPBin(msg.decode("hex"))
+
+################################
+# Main binary decoding routine  
+# Input: buffer holding single AVP at <offset>
+def decodeAVPBin(msg,offset=0):
+    (mcode,mlen)=struct.unpack_from("!II",msg,offset)
+    start=offset+8
+    mvid=0
+    if mlen & (DIAMETER_FLAG_VENDOR<<24):
+        mvid=struct.unpack_from("!I",msg,start)[0]
+        start+=4
+    decoder=dict_avp_decoders.get((mcode,mvid))
+    if decoder is None:
+        decoder=getAVPDecoder(mcode,mvid)
+    return (decoder[0],decoder[2](msg,start,offset+(mlen&0x00FFFFFF)))
+
+# Decode header of AVP at <offset> in binary buffer
+# on finish A contains dictionary data
+# Result: (start,end) of AVP data in buffer
+def decodeAVPHdrBin(A,msg,offset):
+    (mcode,mlen)=struct.unpack_from("!II",msg,offset)
+    mflags=mlen>>24
+    start=offset+8
+    end=offset+(mlen&0x00FFFFFF)
     mvid=0
     if mflags & DIAMETER_FLAG_VENDOR:
-        (svid,msg)=chop_msg(msg,8)
-        mvid=struct.unpack("!I",svid.decode("hex"))[0]
-        data_len-=4
-    A=AVPItem()
+        mvid=struct.unpack_from("!I",msg,start)[0]
+        start+=4
     dictAVPcode2name(A,mcode,mvid)
-    dbg="Read","N",A.name,"T",A.type,"C",A.code,"F",mflags,"L",data_len,"V",A.vendor,mvid,"D",msg
-    # logging.debug(dbg)
-    ret=""
-    decoded=False
-    if A.type in asI32:
-        # logging.debug("Decoding Integer32")
-        ret= decode_Integer32(msg)
-        decoded=True
-    if A.type in asI64:
-        decoded=True
-        # logging.debug("Decoding Integer64")
-        ret= decode_Integer64(msg)
-    if A.type in asU32:
-        decoded=True
-        # logging.debug("Decoding Unsigned32")
-        ret= decode_Unsigned32(msg)
-    if A.type in asU64:
-        decoded=True
-        # logging.debug("Decoding Unsigned64")
-        ret= decode_Unsigned64(msg)
-    if A.type in asF32:
-        decoded=True
-        # logging.debug("Decoding Float32")
-        ret= decode_Float32(msg)
-    if A.type in asF64:
-        decoded=True
-        # logging.debug("Decoding Float64")
-        ret= decode_Float64(msg)        
-    if A.type in asUTF8:
-        decoded=True
-        # logging.debug("Decoding UTF8String")
-        ret= decode_UTF8String(msg,data_len)
-    if A.type in asIPAddress:
-        decoded=True
-        # logging.debug("Decoding IPAddress")
-        ret= decode_Address(msg)
-    if A.type in asIP:
-        decoded=True
-        # logging.debug("Decoding IP")
-        ret= decode_IP(msg)        
-    if A.type in asTime:
-        decoded=True
-        # logging.debug("Decoding Time")
-        ret= decode_Time(msg)
-    if A.type=="Grouped":
-        decoded=True
-        # logging.debug("Decoding Grouped")
-        ret= decode_Grouped(msg)
-    if not decoded:
-      # default is OctetString
-      # logging.debug("Decoding OctetString")
-      ret= decode_OctetString(msg,data_len)
-    dbg="Decoded as",A.name,ret
-    # logging.info(dbg)
-    return (A.name,ret)
+    return (start,end)
+
+# Decode AVP data of dictionary type <atype> found at msg[start:end]
+def decodeAVPDataBin(atype,msg,start,end):
+    return dict_type_decoders.get(atype,decode_OctetStringBin)(msg,start,end)
 
 # Search for AVP in undecoded list
+# Names of encoded AVPs are found from their header, so only the
+# matching AVP is decoded
 # Return value if exist, ERROR if not    
 def findAVP(what,list):
     for avp in list:
         if isinstance(avp,tuple):
            (Name,Value)=avp
-        else:
-           (Name,Value)=decodeAVP(avp)
-        if Name==what:
-           return Value
+           if Name==what:
+              return Value
+           continue
+        if isinstance(avp,str):
+           avp=avp.decode("hex")
+        (mcode,mlen)=struct.unpack_from("!II",avp)
+        mvid=0
+        if mlen & (DIAMETER_FLAG_VENDOR<<24):
+           mvid=struct.unpack_from("!I",avp,8)[0]
+        if getAVPDecoder(mcode,mvid)[0]==what:
+           return decodeAVPBin(avp)[1]
+    return ERROR
+
+#----------------------------------------------------------------------
+# AVP path queries
+# Path: AVP names separated by "/", each one a child of the previous
+# Grouped AVP, e.g. Multiple-Services-Credit-Control/Used-Service-Unit/
+# CC-Total-Octets. Paths are compiled once into (code,vendor) keys,
+# and evaluated over the raw buffer: AVPs not on the path are skipped
+# by their length field, and only the values at the end are decoded
+AVPPath=collections.namedtuple("AVPPath","path keys")
+
+# Compiled paths, by path
+avpPaths={}
+
+# AVP header: code, flags and length
+avpHeader=struct.Struct("!II")
+
+# Compile AVP path (cached), names must be in dictionary
+def compileAVPPath(path):
+    compiled=avpPaths.get(path)
+    if compiled is not None:
+        return compiled
+    keys=[]
+    for name in path.split("/"):
+        A=AVPItem()
+        dictAVPname2code(A,name,"")
+        keys.append((int(A.code),int(A.vendor)))
+    compiled=AVPPath(path,tuple(keys))
+    avpPaths[path]=compiled
+    return compiled
+
+# Values of every AVP at <path> (name or compiled) in binary buffer,
+# holding AVPs at msg[start:end] (e.g. stripHdrBin msg), in message order
+def findAllAVPsBin(path,msg,start=0,end=None):
+    if not isinstance(path,AVPPath):
+        path=compileAVPPath(path)
+    if end is None:
+        end=len(msg)
+    ret=[]
+    scanAVPPath(path,0,msg,start,end,ret,False)
+    return ret
+
+# Value of first AVP at <path> in binary buffer, ERROR if not found
+def findAVPBin(path,msg,start=0,end=None):
+    if not isinstance(path,AVPPath):
+        path=compileAVPPath(path)
+    if end is None:
+        end=len(msg)
+    ret=[]
+    if scanAVPPath(path,0,msg,start,end,ret,True):
+        return ret[0]
     return ERROR
+
+# Walk AVPs at msg[start:end] matching step <depth> of path,
+# appending decoded values at the end of the path to <ret>
+# Result: True if stopped on first value found
+def scanAVPPath(path,depth,msg,start,end,ret,first):
+    (code,vendor)=path.keys[depth]
+    last=depth==len(path.keys)-1
+    unpackHeader=avpHeader.unpack_from
+    while start+8<=end:
+        (mcode,mlen)=unpackHeader(msg,start)
+        alen=mlen&0x00FFFFFF
+        if alen<8:
+            # Malformed AVP, stop instead of looping forever
+            break
+        if mcode==code:
+            dstart=start+8
+            mvid=0
+            if mlen & (DIAMETER_FLAG_VENDOR<<24):
+                mvid=struct.unpack_from("!I",msg,dstart)[0]
+                dstart+=4
+            if mvid==vendor:
+                if last:
+                    decode=getAVPDecoder(code,vendor)[2]
+                    ret.append(decode(msg,dstart,start+alen))
+                    if first:
+                        return True
+                elif scanAVPPath(path,depth+1,msg,dstart,start+alen,ret,
+                                 first):
+                    return True
+        start+=(alen+3)&~3
+    return False
     
 #---------------------------------------------------------------------- 
 
@@ -695,12 +1236,25 @@ def findAVP(what,list):
 
 # Join AVPs (add padding)
 def joinAVPs(avps):
-    data=""
+    return bufferBytes(joinAVPsBin([avp.decode("hex") for avp in avps])).encode("hex")
+
+# Join binary AVPs (add padding) into single bytearray
+def joinAVPsBin(avps):
+    dlen=0
+    for avp in avps:
+        dlen+=calc_padding(len(avp))
+    ret=bytearray(dlen)
+    copyAVPs(ret,0,avps)
+    return ret
+
+# Copy binary AVPs into <buf> starting at <offset>, padding each one
+# Result: offset after last AVP
+def copyAVPs(buf,offset,avps):
     for avp in avps:
-        while len(avp)/2<calc_padding(len(avp)/2):
-            avp=avp+"00"
-        data=data+avp
-    return data
+        alen=len(avp)
+        buf[offset:offset+alen]=avp
+        offset+=calc_padding(alen)
+    return offset
 
 # Set flags to desired state    
 def setFlags(H,flag):
@@ -714,18 +1268,117 @@ def createReq(H,avps):
 
 # Create diameter Response from <avps> and fields from Header H     
 def createRes(H,avps):
-    # first add all avps into single string
-    data=joinAVPs(avps)
-    # since all data is hex ecoded, divide by 2 and add header length
-    H.len=len(data)/2+20
-    ret="01"+"%06X" % H.len+"%02X"%int(H.flags) + "%06X"%int(H.cmd)
-    ret=ret+"%08X"%H.appId+"%08X"%H.HopByHop+ "%08X"%H.EndToEnd+data
-    dbg="Header fields","L",H.len,"F",H.flags,"C",H.cmd,"A",H.appId,"H",H.HopByHop,"E",H.EndToEnd
-    # logging.debug(dbg)
-    dbg="Diameter hdr+data",ret
-    # logging.debug(dbg)
+    ret=createResBin(H,[avp.decode("hex") for avp in avps])
+    return bufferBytes(ret).encode("hex")
+
+# Create binary diameter Request from binary <avps> and fields from Header H    
+def createReqBin(H,avps):
+    H.flags|=DIAMETER_HDR_REQUEST
+    return createResBin(H,avps)
+
+# Create binary diameter Response from binary <avps> and fields from Header H
+# Result is bytearray, allocated once and filled in place
+def createResBin(H,avps):
+    H.len=20
+    for avp in avps:
+        H.len+=calc_padding(len(avp))
+    ret=bytearray(H.len)
+    struct.pack_into("!IIIII",ret,0,
+        0x01000000|H.len,(int(H.flags)<<24)|int(H.cmd),
+        H.appId,H.HopByHop,H.EndToEnd)
+    copyAVPs(ret,20,avps)
     return ret
 
+# Incremental binary encoder: AVPs are appended into a single buffer.
+# Grouped AVP is opened with beginGroup, its children are appended right
+# after its header, and endGroup back-patches its length, so nested
+# groups are written once, without copying children into their parents
+# With header H, buffer starts with the message header and finish()
+# fills it in, returning the whole message (as createResBin would)
+class AVPBuilder:
+    def __init__(self,H=None):
+        self.H=H
+        self.groups=[]
+        self.buf=bytearray()
+        if H is not None:
+            self.buf.extend(bytearray(20))
+
+    # Encode and append AVP (value of Grouped AVP is list of binary AVPs)
+    def add(self,AVP_Name,AVP_Value):
+        if type(AVP_Value) in AVP_CACHE_TYPES:
+            # Same as encodeAVPBin, cached encoding being appended as is
+            key=(AVP_Name,AVP_Value)
+            avp=avpCacheBin.get(key)
+            if avp is None:
+                avp=getAVPDefBin(AVP_Name,AVP_Value)
+                if len(avp)>0:
+                    avpCacheBin.store(key,bytes(avp))
+            self.buf+=avp
+            return
+        self.addBin(encodeAVPBin(AVP_Name,AVP_Value))
+
+    # Append already encoded binary AVP, padding it
+    def addBin(self,avp):
+        alen=len(avp)
+        self.buf+=avp
+        if alen&3:
+            self.buf.extend(bytearray(4-(alen&3)))
+
+    # Start Grouped AVP: following AVPs are its children until endGroup
+    def beginGroup(self,AVP_Name):
+        hdr=groupHeaders.get(AVP_Name)
+        if hdr is None:
+            hdr=groupHeader(AVP_Name)
+        self.groups.append(len(self.buf))
+        self.buf+=hdr
+
+    # Close last started Grouped AVP, setting its length
+    def endGroup(self):
+        offset=self.groups.pop()
+        struct.pack_into("!I",self.buf,offset+4,
+            (self.buf[offset+4]<<24)|(len(self.buf)-offset))
+
+    # Same as beginGroup/endGroup, in a with statement:
+    #   with builder.group("Service-Information"):
+    #       builder.add("Node-Functionality",0)
+    def group(self,AVP_Name):
+        self.beginGroup(AVP_Name)
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.endGroup()
+
+    # Result is bytearray with encoded AVPs (padding included),
+    # or with whole message if built with header
+    def finish(self):
+        if len(self.groups)>0:
+            bailOut("Grouped AVP not ended")
+        H=self.H
+        if H is not None:
+            H.len=len(self.buf)
+            struct.pack_into("!IIIII",self.buf,0,
+                0x01000000|H.len,(int(H.flags)<<24)|int(H.cmd),
+                H.appId,H.HopByHop,H.EndToEnd)
+        return self.buf
+
+# Header of Grouped AVP (length left 0), by AVP name
+groupHeaders={}
+
+def groupHeader(AVP_Name):
+    A=AVPItem()
+    dictAVPname2code(A,AVP_Name,"")
+    flags=checkMandatory(A.mandatory)
+    if A.vendor!=0:
+        hdr=struct.pack("!III",int(A.code),
+            (int(flags)|DIAMETER_FLAG_VENDOR)<<24,int(A.vendor))
+    else:
+        hdr=struct.pack("!II",int(A.code),int(flags)<<24)
+    groupHeaders[AVP_Name]=hdr
+    return hdr
+
 # Set Hop-by-Hop and End-to-End fields to sane values    
 def initializeHops(H):
     # Not by RFC, but close enough
@@ -746,49 +1399,61 @@ def initializeHops(H):
 # Result: class H with splitted message (header+message)
 # AVPs in message are NOT splitted
 def stripHdr(H,msg):
-    dbg="Incoming Diameter msg",msg
-    # logging.info(dbg)
     if len(msg)==0:
         return ERROR
-    (sver,msg)=chop_msg(msg,2)
-    (slen,msg)=chop_msg(msg,6)
-    (sflag,msg)=chop_msg(msg,2)
-    (scode,msg)=chop_msg(msg,6)
-    (sapp,msg)=chop_msg(msg,8)
-    (shbh,msg)=chop_msg(msg,8)
-    (sete,msg)=chop_msg(msg,8)
-    dbg="Split hdr","V",sver,"L",slen,"F",sflag,"C",scode,"A",sapp,"H",shbh,"E",sete,"D",msg
-    # logging.debug(dbg)
-    H.ver=ord(sver.decode("hex"))
-    H.flags=ord(sflag.decode("hex"))
-    H.len=struct.unpack("!I","\00"+slen.decode("hex"))[0]
-    H.cmd=struct.unpack("!I","\00"+scode.decode("hex"))[0]
-    H.appId=struct.unpack("!I",sapp.decode("hex"))[0]
-    H.HopByHop=struct.unpack("!I",shbh.decode("hex"))[0]
-    H.EndToEnd=struct.unpack("!I",sete.decode("hex"))[0]
-    dbg="Read","V",H.ver,"L",H.len,"F",H.flags,"C",H.cmd,"A",H.appId,"H",H.HopByHop,"E",H.EndToEnd
-    # logging.debug(dbg)
-    dbg=dictCOMMANDcode2name(H.flags,H.cmd)
-    # logging.info(dbg)
-    H.msg=msg
+    stripHdrBin(H,msg[0:40].decode("hex"))
+    H.msg=msg[40:]
     return 
 
+# Main binary message decoding routine
+# Input: diameter message as str, bytearray or memoryview
+# Result: class H with header fields, H.msg is memoryview of AVPs (no copy)
+def stripHdrBin(H,msg):
+    if len(msg)==0:
+        return ERROR
+    msg=memoryview(msg)
+    (vlen,fcode,H.appId,H.HopByHop,H.EndToEnd)=struct.unpack_from("!IIIII",msg,0)
+    H.ver=vlen>>24
+    H.len=vlen&0x00FFFFFF
+    H.flags=fcode>>24
+    H.cmd=fcode&0x00FFFFFF
+    H.msg=msg[20:H.len]
+    return
+
 # Split AVPs from message
 # Input: H.msg as hex string
 # Result: list of undecoded AVPs
 def splitMsgAVPs(msg):
     ret=[]
-    dbg="Incoming avps",msg
-    # logging.debug(dbg)
-    while len(msg)<>0:
-      slen="00"+msg[10:16]
-      mlen=struct.unpack("!I",slen.decode("hex"))[0]
-      #Increase to boundary
-      plen=calc_padding(mlen)
-      (avp,msg)=chop_msg(msg,2*plen)
-      dbg="Single AVP","L",mlen,plen,"D",avp
-      # logging.info(dbg)
-      ret.append(avp)
+    for (offset,plen) in indexAVPsBin(msg.decode("hex")):
+        ret.append(msg[2*offset:2*(offset+plen)])
+    return ret
+
+# Split AVPs from binary message
+# Input: H.msg as str, bytearray or memoryview
+# Result: list of undecoded AVPs as memoryview slices (no copy)
+def splitMsgAVPsBin(msg):
+    msg=memoryview(msg)
+    ret=[]
+    for (offset,plen) in indexAVPsBin(msg):
+        ret.append(msg[offset:offset+plen])
+    return ret
+
+# Walk AVPs in binary buffer from <start> to <end>, reading length fields
+# Result: list of (offset,length) of each AVP, length includes padding
+def indexAVPsBin(msg,start=0,end=None):
+    if end is None:
+        end=len(msg)
+    ret=[]
+    while start<end:
+        mlen=struct.unpack_from("!I",msg,start+4)[0]&0x00FFFFFF
+        if mlen<8:
+            # Malformed AVP, stop instead of looping forever
+            break
+        #Increase to boundary
+        plen=calc_padding(mlen)
+        ret.append((start,plen))
+        start+=plen
     return ret
 
 #---------------------------------------------------------------------- 
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Diameter load generator, used to qualify a Diameter server under load.
+
+Opens the given number of connections to the peer, exchanges the
+capabilities, then sends the scenario's session flows at the target
+rate (open-loop) and reports the answered rate, the result codes and
+the latency distribution, corrected for coordinated omission.
+
+Example, 2000 ACR/s with one INTERIM per session, over 4 connections:
+
+    python load_generator.py --scenario acr --rate 2000 --connections 4
+"""
+
+import argparse
+import json
+import sys
+from diameter_load import *
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Diameter load generator')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='host of the peer')
+    parser.add_argument('--port', type=int, default=3868,
+                        help='port of the peer')
+    parser.add_argument('--scenario', choices=sorted(scenarios),
+                        default='acr', help='session flow to send')
+    parser.add_argument('--rate', type=float, default=1000.0,
+                        help='target rate, in requests per second')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds of recorded load')
+    parser.add_argument('--warmup', type=float, default=0.0,
+                        help='seconds of load sent before recording')
+    parser.add_argument('--connections', type=int, default=1,
+                        help='number of connections sharing the rate')
+    parser.add_argument('--open-sessions', type=int, default=100,
+                        help='sessions kept open by each connection')
+    parser.add_argument('--session-requests', type=int, default=1,
+                        help='intermediate requests (INTERIM, UPDATE) '
+                             'of each session')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds to wait for each answer')
+    parser.add_argument('--origin-host', default='client.asn.test')
+    parser.add_argument('--origin-realm', default='asn.test')
+    parser.add_argument('--destination-realm', default='asn.test')
+    parser.add_argument('--hgrm',
+                        help='file to write the latency percentile '
+                             'distribution to, in milliseconds '
+                             '(HdrHistogram format, - for stdout)')
+    parser.add_argument('--output',
+                        help='file to write the JSON summary to')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    """
+    Runs the load generator with the command line options,
+    then prints the summary of the run.
+    """
+
+    arguments = parse_arguments()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    generator = LoadGenerator(
+        host=arguments.host,
+        port=arguments.port,
+        scenario=arguments.scenario,
+        rate=arguments.rate,
+        duration=arguments.duration,
+        warmup=arguments.warmup,
+        connections=arguments.connections,
+        open_sessions=arguments.open_sessions,
+        session_requests=arguments.session_requests,
+        origin_host=arguments.origin_host,
+        origin_realm=arguments.origin_realm,
+        destination_realm=arguments.destination_realm,
+        request_timeout=arguments.timeout)
+    results = generator.run()
+
+    latency = results['latency_ms']
+    print 'Scenario %s: %d sent, %d answered, %d errors, %d sessions' % (
+        results['scenario'], results['sent'], results['answered'],
+        results['errors'], results['sessions'])
+    print 'Rate: %.1f/s achieved, %.1f/s targeted' % (
+        results['achieved_rate'], results['target_rate'])
+    print 'Result codes: %s' % results['result_codes']
+    print 'Latency (ms): p50 %.3f, p90 %.3f, p99 %.3f, p99.9 %.3f, ' \
+          'max %.3f' % (latency['percentiles']['p50'],
+                        latency['percentiles']['p90'],
+                        latency['percentiles']['p99'],
+                        latency['percentiles']['p99_9'],
+                        latency['max'])
+
+    if arguments.hgrm:
+        histogram = generator.histograms()[0]
+        if arguments.hgrm == '-':
+            histogram.output_percentile_distribution(sys.stdout, 1000.0)
+        else:
+            with open(arguments.hgrm, 'w') as hgrm_file:
+                histogram.output_percentile_distribution(hgrm_file, 1000.0)
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True,
+                      separators=(',', ': '))
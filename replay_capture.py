@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+Replays the Diameter requests of a pcap or pcapng capture to a server.
+
+The TCP streams of the Diameter connections are reassembled from the
+capture, memory mapped so that captures larger than memory can be
+replayed, and every captured connection is replayed over its own
+connection to the target. Requests are sent at their captured timing,
+divided by the speed factor (0 sending them as fast as possible).
+
+Example, replaying a trace ten times faster than captured:
+
+    python replay_capture.py trace.pcapng --port 3868 --speed 10
+"""
+
+import argparse
+import json
+import logging
+from diameter_pcap import *
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Replay the Diameter requests of a capture')
+    parser.add_argument('capture', help='pcap or pcapng capture file')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='host of the target')
+    parser.add_argument('--port', type=int, default=3868,
+                        help='port of the target')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='timing multiplier, 0 for as fast as possible')
+    parser.add_argument('--capture-port', type=int, action='append',
+                        help='TCP port of the captured Diameter '
+                             'connections (default 3868), repeatable')
+    parser.add_argument('--answer-timeout', type=float, default=5.0,
+                        help='seconds to wait for the last answers')
+    parser.add_argument('--output',
+                        help='file to write the JSON summary to')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    """
+    Replays the capture with the command line options,
+    then prints the summary of the replay.
+    """
+
+    arguments = parse_arguments()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = replay(
+        read_capture(arguments.capture,
+                     tuple(arguments.capture_port or [DIAMETER_PORT])),
+        host=arguments.host,
+        port=arguments.port,
+        speed=arguments.speed,
+        answer_timeout=arguments.answer_timeout)
+
+    print 'Replayed %d requests over %d connections in %.3fs, ' \
+          '%d answered' % (results['sent'], results['connections'],
+                           results['duration'], results['answered'])
+    print 'Most late send: %.3fs' % results['max_late_seconds']
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True,
+                      separators=(',', ': '))
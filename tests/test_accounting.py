@@ -0,0 +1,109 @@
+"""
+Tests of the accounting session timer wheel and session store.
+"""
+
+import threading
+import time
+import unittest
+
+from diameter_accounting import *
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def test_expires_within_one_resolution_of_deadline(self):
+        base = 1000.0
+        for resolution in (1.0, 0.25, 5.0):
+            for offset in (0.0, 0.1, 0.6, 0.99, 1.0, 7.3, 100.5):
+                wheel = TimerWheel(resolution=resolution, now=base)
+                session = AccountingSession('s', 'h', base)
+                deadline = base + offset
+                wheel.schedule(session, deadline)
+                # Expiring on every partial tick, as the store does
+                now = base
+                expired_at = None
+                while expired_at is None and now < deadline + 10:
+                    now += resolution / 4.0
+                    if session in wheel.advance(now):
+                        expired_at = now
+                self.assertIsNotNone(expired_at)
+                self.assertGreaterEqual(expired_at, deadline)
+                self.assertLessEqual(expired_at, deadline + resolution)
+
+    def test_not_expired_before_deadline(self):
+        wheel = TimerWheel(resolution=1.0, now=1000.0)
+        session = AccountingSession('s', 'h', 1000.0)
+        wheel.schedule(session, 1010.6)
+        self.assertEqual(wheel.advance(1010.2), [])
+        self.assertEqual(wheel.advance(1011.0), [session])
+        self.assertEqual(len(wheel), 0)
+
+    def test_later_revolution(self):
+        wheel = TimerWheel(slots=16, resolution=1.0, now=1000.0)
+        session = AccountingSession('s', 'h', 1000.0)
+        wheel.schedule(session, 1040.5)
+        self.assertEqual(wheel.advance(1020.0), [])
+        self.assertEqual(wheel.advance(1040.0), [])
+        self.assertEqual(wheel.advance(1041.0), [session])
+
+    def test_cancel(self):
+        wheel = TimerWheel(resolution=1.0, now=1000.0)
+        session = AccountingSession('s', 'h', 1000.0)
+        wheel.schedule(session, 1005.0)
+        wheel.cancel(session)
+        self.assertEqual(wheel.advance(1100.0), [])
+
+
+class SessionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = time.time()
+        self.store = SessionStore(session_timeout=60)
+
+    def test_start_interim_stop(self):
+        self.store.start('s1', 'h', 0, now=self.now)
+        session = self.store.interim('s1', 'h', 1, now=self.now + 1)
+        self.assertEqual(session.interim_records, 1)
+        self.assertEqual(session.record_number, 1)
+        closed = self.store.stop('s1', 2, now=self.now + 2)
+        self.assertIs(closed, session)
+        self.assertNotIn('s1', self.store)
+        self.assertIsNone(self.store.stop('s1', now=self.now + 3))
+
+    def test_interim_without_start_is_recovered(self):
+        self.store.interim('s1', 'h', 1, now=self.now)
+        stats = self.store.stats()
+        self.assertEqual(stats['opened'], 0)
+        self.assertEqual(stats['recovered'], 1)
+
+    def test_stale_session_expires_on_time(self):
+        self.store.start('s1', 'h', 0, interim_interval=10, now=self.now)
+        # Expired after interim_grace (2) interim intervals
+        self.assertEqual(self.store.expire(self.now + 19.5), [])
+        self.assertEqual(len(self.store.expire(self.now + 21.0)), 1)
+        self.assertNotIn('s1', self.store)
+
+    def test_concurrent_interims_are_counted(self):
+        self.store.start('s1', 'h', 0, now=self.now)
+
+        def interims():
+            for _ in range(2000):
+                self.store.interim('s1', 'h', now=self.now)
+
+        threads = [threading.Thread(target=interims) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.store.get('s1').interim_records, 8000)
+
+    def test_bounded(self):
+        store = SessionStore(max_sessions=2)
+        store.start('s1', 'h', now=self.now)
+        store.start('s2', 'h', now=self.now)
+        self.assertIsNone(store.start('s3', 'h', now=self.now))
+        self.assertEqual(store.stats()['rejected'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Tests of the CDR record formats and the CDR writer.
+"""
+
+import errno
+import glob
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from diameter_cdr import *
+
+
+def record(session_id='s1', origin_host='host.example'):
+    return CDRecord(2, session_id, origin_host, 1000.0, 1010.0, 3, 1)
+
+
+class CDRWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def written(self, writer):
+        records = []
+        for path in sorted(glob.glob(os.path.join(
+                self.directory, '*' + writer.extension))):
+            records.extend(read_cdr_file(path))
+        return records
+
+    def test_text_and_binary_round_trip(self):
+        for binary in (False, True):
+            writer = CDRWriter(self.directory, prefix='b%d' % binary,
+                               binary=binary, flush_interval=0.05)
+            for index in range(10):
+                self.assertTrue(writer.submit(record('s%d' % index)))
+            writer.stop()
+            self.assertEqual(writer.stats()['written'], 10)
+            self.assertEqual([cdr.session_id for cdr in self.written(writer)],
+                             [u's%d' % index for index in range(10)])
+
+    def test_non_utf8_values(self):
+        for binary in (False, True):
+            writer = CDRWriter(self.directory, prefix='u%d' % binary,
+                               binary=binary, flush_interval=0.05)
+            writer.submit(record('s\xff\xfe', 'host\x80'))
+            writer.submit(record('after'))
+            writer.stop()
+            self.assertEqual(writer.stats()['failed'], 0)
+            cdrs = self.written(writer)
+            self.assertEqual(cdrs[0].session_id, u's\ufffd\ufffd')
+            self.assertEqual(cdrs[0].origin_host, u'host\ufffd')
+            self.assertEqual(cdrs[1].session_id, u'after')
+
+    def test_failed_batch_keeps_writer_running(self):
+        writer = CDRWriter(self.directory, batch_size=1, flush_interval=0.05)
+        encode = writer.encode
+        failures = [IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))]
+
+        def failing_encode(cdr):
+            if failures:
+                raise failures.pop()
+            return encode(cdr)
+
+        writer.encode = failing_encode
+        logging.disable(logging.ERROR)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        writer.submit(record('lost'))
+        writer.submit(record('kept'))
+        writer.stop()
+        stats = writer.stats()
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['written'], 1)
+        self.assertEqual([cdr.session_id for cdr in self.written(writer)],
+                         [u'kept'])
+
+    def test_backpressure(self):
+        writer = CDRWriter(self.directory, max_queue=1)
+        # Not started: nothing takes the records from the queue
+        writer.pid = os.getpid()
+        self.assertTrue(writer.submit(record()))
+        self.assertTrue(writer.congested())
+        self.assertFalse(writer.submit(record()))
+        self.assertEqual(writer.stats()['dropped'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Tests of the client's pipelined requests, over a socket pair.
+"""
+
+import os
+import socket
+import threading
+import unittest
+
+from diameter_base import *
+from diameter_client import *
+
+DICTIONARY = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'dictDiameter.xml')
+
+
+class PipelinedClientTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        LoadDictionary(DICTIONARY)
+
+    def setUp(self):
+        self.client = DiameterClient()
+        self.client.connection, self.server = socket.socketpair()
+        self.requests = []
+
+    def tearDown(self):
+        # The reader thread stops on the closed connection
+        reader = self.client.reader
+        self.server.close()
+        if reader is not None:
+            reader.join()
+        self.client.connection.close()
+
+    def serve(self, count):
+        """
+        Reads count requests, then answers them in reverse order.
+        """
+        framer = DiameterFramer()
+        while len(self.requests) < count:
+            if framer.recv_from(self.server) == 0:
+                return
+            for message in framer.messages():
+                request = HDRItem()
+                stripHdrBin(request, memoryview(message).tobytes())
+                self.requests.append(request)
+        for request in reversed(self.requests):
+            request.flags = 0
+            self.server.sendall(createResBin(request, [
+                encodeAVPBin('Origin-Host', 'server.test'),
+                encodeAVPBin('Result-Code', 2001),
+            ]))
+
+    def send(self, timeout=None):
+        header = HDRItem()
+        header.cmd = cmd_codes['Device-Watchdog']
+        return self.client.send_request(
+            header, [encodeAVPBin('Origin-Host', 'client.test')],
+            timeout=timeout)
+
+    def test_answers_matched_by_hop_by_hop(self):
+        server = threading.Thread(target=self.serve, args=(20,))
+        server.start()
+        pending = [self.send(timeout=30) for _ in range(20)]
+        server.join()
+        for request in pending:
+            answer = request.result(5)
+            self.assertEqual(answer.HopByHop, request.hop_by_hop)
+            self.assertEqual(answer.EndToEnd, request.end_to_end)
+            self.assertEqual(answer.avps['Result-Code'], 2001)
+        self.assertEqual(self.client.outstanding(), 0)
+        # The answered requests no longer wait for their timeout
+        self.assertEqual(self.client.deadlines, [])
+
+    def test_timeout(self):
+        request = self.send(timeout=0.05)
+        self.assertRaises(DiameterTimeout, request.result, 5)
+        self.assertEqual(self.client.outstanding(), 0)
+
+    def test_drop_finished_deadlines(self):
+        client = self.client
+        for hop_by_hop in range(10):
+            request = PendingRequest(hop_by_hop, 0, 30.0 + hop_by_hop)
+            client.pending[hop_by_hop] = request
+            heapq.heappush(client.deadlines, (request.deadline, hop_by_hop))
+        # Answered, but not on top of the heap: compacted
+        for hop_by_hop in range(3, 10):
+            del client.pending[hop_by_hop]
+        client.drop_finished_deadlines()
+        self.assertEqual(sorted(hop_by_hop for deadline, hop_by_hop
+                                in client.deadlines), [0, 1, 2])
+        # Answered on top of the heap: popped
+        del client.pending[0]
+        client.drop_finished_deadlines()
+        self.assertEqual(client.deadlines[0][1], 1)
+        self.assertEqual(len(client.deadlines), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
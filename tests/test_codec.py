@@ -0,0 +1,230 @@
+"""
+Round-trip tests of the libDiameter codec: hex and binary paths, the
+AVP builder, lazy and eager message decoding and the AVP path queries,
+checked against the encodings of the original hex encoder.
+"""
+
+import os
+import unittest
+
+from diameter_base import *
+
+DICTIONARY = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'dictDiameter.xml')
+
+# (name, value, hex encoding, decoded value) as produced by the original
+# hex string encoder, before the binary codec path
+AVPS = [
+    ('User-Name', 'alice', '000000014000000d616c696365', u'alice'),
+    ('Origin-Host', 'h.test', '000001084000000e682e74657374', 'h.test'),
+    ('Session-Id', 'abc;1;2', '000001074000000f6162633b313b32',
+     u'abc;1;2'),
+    ('Result-Code', 2001, '0000010c4000000c000007d1', 2001),
+    ('Accounting-Record-Type', 2, '000001e04000000c00000002',
+     '\x00\x00\x00\x02'),
+    ('Accounting-Record-Type', 'Stop Record', '000001e04000000c00000004',
+     '\x00\x00\x00\x04'),
+    ('CC-Total-Octets', 12345678901, '000001a54000001000000002dfdc1c35',
+     12345678901),
+    ('Host-IP-Address', '10.0.0.1', '000001014000000e00010a000001',
+     '10.0.0.1'),
+    ('Host-IP-Address', '2001:db8::1',
+     '000001014000001a000220010db8000000000000000000000001', '2001:db8::1'),
+    ('Event-Timestamp', 1500000000, '000000374000000cdd12ad80', 1500000000),
+    ('3GPP-IMSI', '001010123',
+     '00000001c0000015000028af303031303130313233', u'001010123'),
+    ('3GPP-Charging-Id', 77, '00000002c0000010000028af0000004d', 77),
+    ('Framed-IP-Address', '10.1.2.3', '000000084000000c0a010203',
+     '10.1.2.3'),
+    ('Service-Context-Id', '32251@3gpp.org',
+     '000001cd40000016333232353140336770702e6f7267', u'32251@3gpp.org'),
+]
+
+MSCC = ('000001c840000048000001b04000000c00000001000001be40000024000001a5'
+        '400000100000000000000063000001a44000000c00000003000000014000000d'
+        '6162636465000000')
+
+MSCC_VALUE = [
+    (u'Rating-Group', 1),
+    (u'Used-Service-Unit', [(u'CC-Total-Octets', 99), (u'CC-Time', 3)]),
+    (u'User-Name', u'abcde'),
+]
+
+REQUEST = ('0100002c8000010f0000000300000005000000060000000140000009'
+           '780000000000010c4000000c00000001')
+
+
+def mscc(rating_group, octets):
+    return encodeAVPBin('Multiple-Services-Credit-Control', [
+        encodeAVPBin('Rating-Group', rating_group),
+        encodeAVPBin('Used-Service-Unit', [
+            encodeAVPBin('CC-Total-Octets', octets),
+            encodeAVPBin('CC-Time', 3),
+        ]),
+    ])
+
+
+def header(command_code=271):
+    H = HDRItem()
+    H.cmd = command_code
+    H.appId = 3
+    H.HopByHop = 5
+    H.EndToEnd = 6
+    return H
+
+
+class CodecTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        LoadDictionary(DICTIONARY)
+
+
+class AVPCodecTest(CodecTest):
+
+    def test_hex_and_binary_encodings_match_baseline(self):
+        for name, value, encoded, decoded in AVPS:
+            self.assertEqual(encodeAVP(name, value).lower(), encoded)
+            binary = encodeAVPBin(name, value)
+            self.assertEqual(hexAVP(binary), encoded)
+            self.assertEqual(decodeAVP(encoded), (name, decoded))
+            self.assertEqual(decodeAVPBin(binary), (name, decoded))
+
+    def test_grouped(self):
+        children = [encodeAVP('Rating-Group', 1),
+                    encodeAVP('Used-Service-Unit', [
+                        encodeAVP('CC-Total-Octets', 99),
+                        encodeAVP('CC-Time', 3)]),
+                    encodeAVP('User-Name', 'abcde')]
+        encoded = encodeAVP('Multiple-Services-Credit-Control', children)
+        self.assertEqual(encoded.lower(), MSCC)
+        binary = encodeAVPBin('Multiple-Services-Credit-Control',
+                              [child.decode('hex') for child in children])
+        self.assertEqual(hexAVP(binary), MSCC)
+        self.assertEqual(decodeAVPBin(binary),
+                         (u'Multiple-Services-Credit-Control', MSCC_VALUE))
+
+    def test_builder_matches_nested_encoding(self):
+        builder = AVPBuilder()
+        builder.add('Session-Id', 'abc;1;2')
+        with builder.group('Multiple-Services-Credit-Control'):
+            builder.add('Rating-Group', 1)
+            with builder.group('Used-Service-Unit'):
+                builder.add('CC-Total-Octets', 99)
+                builder.add('CC-Time', 3)
+            builder.add('User-Name', 'abcde')
+        expected = (encodeAVP('Session-Id', 'abc;1;2') + '00' + MSCC)
+        self.assertEqual(str(builder.finish()).encode('hex'), expected)
+
+    def test_builder_message_matches_create_request(self):
+        avps = [encodeAVPBin('User-Name', 'x'),
+                encodeAVPBin('Result-Code', 1)]
+        H = header()
+        H.flags = DIAMETER_HDR_REQUEST
+        builder = AVPBuilder(H)
+        builder.add('User-Name', 'x')
+        builder.add('Result-Code', 1)
+        self.assertEqual(str(builder.finish()).encode('hex'), REQUEST)
+        self.assertEqual(str(createReqBin(header(), avps)).encode('hex'),
+                         REQUEST)
+        self.assertEqual(createReq(header(), [hexAVP(avp) for avp in avps]),
+                         REQUEST)
+
+    def test_find_avp(self):
+        avps = [encodeAVPBin('User-Name', 'x'),
+                encodeAVPBin('Result-Code', 2001)]
+        self.assertEqual(findAVP('Result-Code', avps), 2001)
+        self.assertEqual(findAVP('Result-Code',
+                                 [hexAVP(avp) for avp in avps]), 2001)
+        self.assertEqual(findAVP('Session-Id', avps), ERROR)
+
+
+class EnumDecodingTest(CodecTest):
+
+    def tearDown(self):
+        setEnumDecoding(ENUM_RAW)
+
+    def test_modes(self):
+        avp = encodeAVPBin('Accounting-Record-Type', 4)
+        self.assertEqual(decodeAVPBin(avp)[1], '\x00\x00\x00\x04')
+        setEnumDecoding(ENUM_CODE)
+        self.assertEqual(decodeAVPBin(avp)[1], 4)
+        setEnumDecoding(ENUM_NAME)
+        name = dictENUMcode2name('Accounting-Record-Type', 4)
+        self.assertIsNotNone(name)
+        self.assertEqual(dictENUMname2code('Accounting-Record-Type', name), 4)
+        self.assertEqual(decodeAVPBin(avp)[1], name)
+        # Codes missing from the dictionary decode as integers
+        undefined = encodeAVPBin('Accounting-Record-Type', 99)
+        self.assertEqual(decodeAVPBin(undefined)[1], 99)
+
+
+class DiameterMessageTest(CodecTest):
+
+    def setUp(self):
+        avps = [encodeAVPBin('Session-Id', 'abc;1;2'),
+                encodeAVPBin('Host-IP-Address', '10.0.0.1'),
+                encodeAVPBin('Host-IP-Address', '2001:db8::1'),
+                mscc(1, 100), mscc(2, 200),
+                encodeAVPBin('Result-Code', 2001)]
+        self.message = str(createReqBin(header(), avps))
+
+    def decode(self, lazy=False, binary=True):
+        H = HDRItem()
+        if binary:
+            stripHdrBin(H, self.message)
+        else:
+            stripHdr(H, self.message.encode('hex'))
+        return DiameterMessage(H, lazy)
+
+    def test_lazy_eager_and_hex_decoding_match(self):
+        eager = self.decode()
+        hex_decoded = self.decode(binary=False)
+        lazy = self.decode(lazy=True)
+        self.assertEqual(eager.avps.allitems(), hex_decoded.avps.allitems())
+        self.assertEqual(lazy.avps.allitems(), eager.avps.allitems())
+        for message in (hex_decoded, lazy):
+            self.assertEqual(message.command_code, eager.command_code)
+            self.assertEqual(message.length, len(self.message))
+            self.assertEqual(message.HopByHop, 5)
+            self.assertEqual(message.EndToEnd, 6)
+
+    def test_repeated_avps(self):
+        for lazy in (False, True):
+            avps = self.decode(lazy).avps
+            self.assertEqual(avps.getall('Host-IP-Address'),
+                             ['10.0.0.1', '2001:db8::1'])
+            # Indexing by name gives the last occurrence
+            self.assertEqual(avps['Host-IP-Address'], '2001:db8::1')
+            self.assertEqual(len(avps.getall(
+                'Multiple-Services-Credit-Control')), 2)
+            self.assertEqual(avps.getall('User-Name'), [])
+
+    def test_lazy_group(self):
+        group = self.decode(lazy=True).avps[
+            'Multiple-Services-Credit-Control']
+        self.assertIsInstance(group, LazyAVPGroup)
+        self.assertEqual(group.get('Rating-Group'), 2)
+        self.assertEqual(group, decodeAVPBin(mscc(2, 200))[1])
+
+    def test_path_values_match_full_decoding(self):
+        path = 'Multiple-Services-Credit-Control/Used-Service-Unit/' \
+               'CC-Total-Octets'
+        eager = self.decode()
+        expected = [dict(dict(group)['Used-Service-Unit'])['CC-Total-Octets']
+                    for group in eager.avp_values(
+                        'Multiple-Services-Credit-Control')]
+        self.assertEqual(expected, [100, 200])
+        self.assertEqual(eager.path_values(path), expected)
+        self.assertEqual(eager.path_values(compileAVPPath(path)), expected)
+        self.assertEqual(self.decode(lazy=True).path_values(path), expected)
+        self.assertEqual(findAVPBin(path, eager.raw_msg), 100)
+        self.assertEqual(findAVPBin('User-Name', eager.raw_msg), ERROR)
+        # Message built locally walks the decoded AVPs instead
+        local = DiameterMessage()
+        local.avps = decode_avp_list([mscc(1, 100), mscc(2, 200)])
+        self.assertEqual(local.path_values(path), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Tests of the credit control store: reservations, debits and expiry.
+"""
+
+import time
+import unittest
+
+from diameter_credit_control import *
+
+BALANCES = {TOTAL_OCTETS: 1000, TIME: 100}
+
+
+class CreditControlStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = time.time()
+        self.store = CreditControlStore(shards=4, default_balances=BALANCES,
+                                        validity_time=10, validity_grace=2)
+
+    def test_reserve_debit_terminate(self):
+        self.store.open('s1', 'alice', now=self.now)
+        grants = self.store.charge(
+            's1', [(1, None, 0, TOTAL_OCTETS, 300)], now=self.now)
+        self.assertEqual(grants, [(1, TOTAL_OCTETS, 300, False)])
+        self.assertEqual(self.store.balance('alice')[TOTAL_OCTETS], 700)
+        # 200 of the 300 reserved units used, the rest released
+        self.store.terminate('s1', [(1, TOTAL_OCTETS, 200, None, None)],
+                             now=self.now + 1)
+        self.assertEqual(self.store.balance('alice')[TOTAL_OCTETS], 800)
+        self.assertNotIn('s1', self.store)
+
+    def test_grant_limited_by_balance(self):
+        self.store.open('s1', 'alice', now=self.now)
+        grants = self.store.charge(
+            's1', [(1, None, 0, TIME, 500)], now=self.now)
+        self.assertEqual(grants, [(1, TIME, 100, True)])
+        self.assertEqual(self.store.balance('alice')[TIME], 0)
+
+    def test_expired_session_releases_reservation_on_time(self):
+        self.store.open('s1', 'alice', now=self.now)
+        self.store.charge('s1', [(1, None, 0, TOTAL_OCTETS, 400)],
+                          now=self.now + 0.6)
+        deadline = self.now + 0.6 + 10 * 2
+        self.assertEqual(self.store.expire(deadline - 0.5), [])
+        self.assertEqual(self.store.balance('alice')[TOTAL_OCTETS], 600)
+        # Released within one resolution (1s) of the deadline
+        self.assertEqual(len(self.store.expire(deadline + 1.0)), 1)
+        self.assertEqual(self.store.balance('alice')[TOTAL_OCTETS], 1000)
+        self.assertNotIn('s1', self.store)
+        self.assertEqual(self.store.stats()['expired'], 1)
+
+    def test_unknown_session(self):
+        with self.assertRaises(CreditControlError):
+            self.store.charge('nope', [], now=self.now)
+
+    def test_unknown_subscriber_refused(self):
+        store = CreditControlStore(shards=1, default_balances=None)
+        with self.assertRaises(CreditControlError):
+            store.open('s1', 'bob', now=self.now)
+
+    def test_event_direct_debiting(self):
+        self.store.event('alice', DIRECT_DEBITING,
+                         [(1, None, 0, TOTAL_OCTETS, 100)])
+        self.assertEqual(self.store.balance('alice')[TOTAL_OCTETS], 900)
+        with self.assertRaises(CreditControlError):
+            self.store.event('alice', DIRECT_DEBITING,
+                             [(1, None, 0, TOTAL_OCTETS, 1000)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+Tests of the metrics HTTP endpoint.
+"""
+
+import unittest
+import urllib2
+
+from diameter_metrics import *
+
+TRACES = u'Device-Watchdog \xe9\u20ac\n'
+
+
+class UnicodeTracer:
+    """
+    Tracer whose dump is unicode text, as the decoded traces are.
+    """
+
+    def dump(self, output):
+        output.write(TRACES)
+
+
+class MetricsServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MetricsServer(MetricsRegistry(), port=0,
+                                    tracer=UnicodeTracer())
+        self.server.start()
+        self.url = 'http://127.0.0.1:%d' % (
+            self.server.http_server.server_address[1])
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_traces_encoded_as_utf8(self):
+        response = urllib2.urlopen(self.url + '/traces')
+        self.assertIn('charset=utf-8', response.info()['Content-Type'])
+        body = response.read()
+        self.assertEqual(int(response.info()['Content-Length']), len(body))
+        self.assertEqual(body.decode('utf-8'), TRACES)
+
+    def test_metrics(self):
+        response = urllib2.urlopen(self.url + '/metrics')
+        self.assertIn('text/plain', response.info()['Content-Type'])
+        self.assertTrue(response.read().endswith('\n'))
+
+    def test_unknown_path(self):
+        with self.assertRaises(urllib2.HTTPError):
+            urllib2.urlopen(self.url + '/other')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Tests of the server's answers.
+"""
+
+import os
+import unittest
+
+from diameter_base import *
+from diameter_responses import *
+
+DICTIONARY = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'dictDiameter.xml')
+
+
+def request(command_code, avps):
+    header = HDRItem()
+    header.cmd = command_code
+    header.HopByHop = 11
+    header.EndToEnd = 22
+    message = createReqBin(header, avps)
+    decoded = HDRItem()
+    stripHdrBin(decoded, memoryview(message).tobytes())
+    return DiameterMessage(decoded)
+
+
+def answer(message):
+    decoded = HDRItem()
+    stripHdrBin(decoded, memoryview(message).tobytes())
+    return DiameterMessage(decoded)
+
+
+class DeviceWatchdogAnswerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        LoadDictionary(DICTIONARY)
+
+    def dwr(self, *avps):
+        return request(cmd_codes['Device-Watchdog'], [
+            encodeAVPBin('Origin-Host', 'client.test'),
+            encodeAVPBin('Origin-Realm', 'test'),
+        ] + list(avps))
+
+    def test_echoes_origin_state_id(self):
+        dwr = self.dwr(encodeAVPBin('Origin-State-Id', 7))
+        dwa = answer(generate_device_watchdog_answer(
+            dwr, 'server.test', 'test'))
+        self.assertEqual(dwa.HopByHop, 11)
+        self.assertEqual(dwa.EndToEnd, 22)
+        self.assertEqual(dwa.avps['Destination-Host'], 'client.test')
+        self.assertEqual(dwa.avps['Result-Code'],
+                         result_codes['DIAMETER_SUCCESS'])
+        self.assertEqual(dwa.avps['Origin-State-Id'], 7)
+
+    def test_without_origin_state_id(self):
+        dwa = answer(generate_device_watchdog_answer(
+            self.dwr(), 'server.test', 'test'))
+        self.assertEqual(dwa.avps['Result-Code'],
+                         result_codes['DIAMETER_SUCCESS'])
+        self.assertNotIn('Origin-State-Id', dwa.avps)
+
+
+if __name__ == '__main__':
+    unittest.main()